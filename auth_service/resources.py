@@ -0,0 +1,47 @@
+"""
+CPU and memory available to the service's container.
+
+Shared by ``gunicorn.conf.py``, which sizes workers with them, and the
+settings, which size admission-control limits by CPU.
+"""
+import math
+import os
+
+
+def available_cpus():
+    """
+    Number of CPUs this process may use, honouring cpusets and cgroup quotas.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def available_memory_mb():
+    """
+    Memory (MB) this container may use: the cgroup limit if set, else MemAvailable.
+    """
+    try:
+        with open('/sys/fs/cgroup/memory.max') as f:
+            limit = f.read().strip()
+        if limit != 'max':
+            return int(limit) // (1024 * 1024)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError):
+        pass
+    return None
@@ -1,10 +1,14 @@
 from pathlib import Path
+from importlib.util import find_spec
 import os
+import tempfile
 import environ
 from django.utils import timezone
 import dj_database_url
 from datetime import timedelta
 
+from .resources import available_cpus
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -25,6 +29,12 @@ ALLOWED_HOSTS = ['*']
 
 # Application definition
 
+# Startup-optimized mode keeps API workers lean: the OpenAPI machinery is only
+# loaded on the first request to a docs URL, the browsable API is disabled and
+# the admin is off unless ADMIN_ENABLED is set explicitly.
+STARTUP_OPTIMIZED = env.bool('STARTUP_OPTIMIZED', default=False)
+ADMIN_ENABLED = env.bool('ADMIN_ENABLED', default=not STARTUP_OPTIMIZED)
+
 INSTALLED_APPS = [
     'django.contrib.admin',
     'django.contrib.auth',
@@ -43,9 +53,19 @@ INSTALLED_APPS = [
     'users',
 ]
 
+if not ADMIN_ENABLED:
+    INSTALLED_APPS.remove('django.contrib.admin')
+
+if STARTUP_OPTIMIZED:
+    INSTALLED_APPS.remove('drf_spectacular')
+
 MIDDLEWARE = [
+    'users.eventlog.RequestIdMiddleware',
+    'users.eventlog.AccessLogMiddleware',
+    'users.admission.AdmissionControlMiddleware',
+    'users.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'users.staticfiles.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -56,6 +76,39 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'auth_service.urls'
 
+# Admission control: per-class concurrency limits and wait queues, shared by
+# all gunicorn workers on the host when the app is preloaded. Password hashing
+# is CPU-bound, so by default it may use one slot per CPU. Queued requests
+# still hold a worker while they wait, so its queue is kept short. CPUs are
+# counted like gunicorn.conf.py does, within the container's quota.
+_CPUS = available_cpus()
+ADMISSION_CONTROL = {
+    'ENABLED': env.bool('ADMISSION_ENABLED', default=True),
+    'DEFAULT_CLASS': 'light',
+    'CLASSES': {
+        'hashing': {
+            'PATHS': ['/api/users/login/', '/api/users/register/', '/api/users/reset-password/'],
+            'LIMIT': env.int('ADMISSION_HASHING_LIMIT', default=_CPUS),
+            'QUEUE': env.int('ADMISSION_HASHING_QUEUE', default=max(1, _CPUS // 2)),
+            'TIMEOUT': env.float('ADMISSION_HASHING_TIMEOUT', default=2.0),
+            'RETRY_AFTER': 2,
+        },
+        'admin': {
+            'PATHS': ['/admin/', '/api/schema/', '/api/doc/', '/api/redoc/', '/api/users/export/'],
+            'LIMIT': env.int('ADMISSION_ADMIN_LIMIT', default=2),
+            'QUEUE': env.int('ADMISSION_ADMIN_QUEUE', default=4),
+            'TIMEOUT': env.float('ADMISSION_ADMIN_TIMEOUT', default=5.0),
+            'RETRY_AFTER': 5,
+        },
+        'light': {
+            'LIMIT': env.int('ADMISSION_LIGHT_LIMIT', default=64),
+            'QUEUE': env.int('ADMISSION_LIGHT_QUEUE', default=64),
+            'TIMEOUT': env.float('ADMISSION_LIGHT_TIMEOUT', default=1.0),
+            'RETRY_AFTER': 1,
+        },
+    },
+}
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -71,6 +124,12 @@ TEMPLATES = [
     },
 ]
 
+if STARTUP_OPTIMIZED:
+    # drf_spectacular is not an installed app here, but the Swagger UI / ReDoc
+    # templates are still needed; locate them without importing the package.
+    TEMPLATES[0]['DIRS'].append(
+        Path(next(iter(find_spec('drf_spectacular').submodule_search_locations))) / 'templates'
+    )
 
 
 WSGI_APPLICATION = 'auth_service.wsgi.application'
@@ -80,12 +139,29 @@ AUTH_USER_MODEL = 'users.User'
 
 # Redis cache configuration
 REDIS_URL = env('REDIS_URL', default='redis://127.0.0.1:6379/1')
+# Several servers (comma separated) shard keys over a consistent hash ring.
+REDIS_URLS = env.list('REDIS_URLS', default=[])
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
-        "LOCATION": REDIS_URL,
+        "LOCATION": REDIS_URLS or REDIS_URL,
         "OPTIONS": {
-            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            "CLIENT_CLASS": "users.cache.ShardedClient" if REDIS_URLS else "users.cache.ResilientClient",
+            "VIRTUAL_NODES": env.int('REDIS_VIRTUAL_NODES', default=160),
+            # Fail fast so a slow or unreachable Redis cannot stall requests.
+            "SOCKET_CONNECT_TIMEOUT": env.float('REDIS_CONNECT_TIMEOUT', default=0.1),
+            "SOCKET_TIMEOUT": env.float('REDIS_SOCKET_TIMEOUT', default=0.25),
+            "CIRCUIT_BREAKER": {
+                "FAILURE_RATE": env.float('REDIS_BREAKER_FAILURE_RATE', default=0.5),
+                "MIN_REQUESTS": env.int('REDIS_BREAKER_MIN_REQUESTS', default=10),
+                "WINDOW": env.int('REDIS_BREAKER_WINDOW', default=10),
+                "RESET_TIMEOUT": env.float('REDIS_BREAKER_RESET_TIMEOUT', default=5),
+            },
+            # Keys with these prefixes are also kept in a per-process LRU
+            # (hot, rarely changing data only; never throttle history).
+            "LOCAL_CACHE_PREFIXES": env.list('CACHE_LOCAL_PREFIXES', default=[]),
+            "LOCAL_CACHE_MAX_ENTRIES": env.int('CACHE_LOCAL_MAX_ENTRIES', default=1024),
+            "LOCAL_CACHE_TIMEOUT": env.int('CACHE_LOCAL_TIMEOUT', default=30),
         }
     }
 }
@@ -110,29 +186,90 @@ else:
 }
 
 
+# User export (GET /api/users/export/, `manage.py export_users`). Users
+# updated in the last SAFETY_LAG seconds are left for the next run, so that
+# saves whose transactions commit late are not skipped by a continuation
+# token; keep it above the longest transaction that saves users.
+USER_EXPORT = {
+    'SAFETY_LAG': env.float('USER_EXPORT_SAFETY_LAG', default=60),
+}
+
+
+# Optional sharding of users across databases (see users.sharding). Each URL
+# in USER_SHARD_DATABASE_URLS becomes a database alias users_<n>; users are
+# placed by a hash of their email address, and their ids encode it. Only
+# ever append shards: an alias's position is part of the ids allocated on
+# it. While `manage.py rebalance_user_shards` moves users after a change,
+# list the previous shard aliases (or `default`, when first enabling
+# sharding) in USER_SHARDS_PREVIOUS so lookups fall back to them.
+USER_SHARD_DATABASE_URLS = env.list('USER_SHARD_DATABASE_URLS', default=[])
+for _index, _url in enumerate(USER_SHARD_DATABASE_URLS):
+    DATABASES[f'users_{_index}'] = dj_database_url.parse(_url, conn_max_age=600)
+USER_SHARDING = {
+    'SHARDS': [f'users_{index}' for index in range(len(USER_SHARD_DATABASE_URLS))],
+    'PREVIOUS_SHARDS': env.list('USER_SHARDS_PREVIOUS', default=[]),
+    'VIRTUAL_NODES': env.int('USER_SHARD_VIRTUAL_NODES', default=160),
+    'ID_BLOCK_SIZE': env.int('USER_ID_BLOCK_SIZE', default=100),
+    'FAN_OUT_WORKERS': env.int('USER_SHARD_FAN_OUT_WORKERS', default=8),
+}
+if USER_SHARDING['SHARDS']:
+    DATABASE_ROUTERS = ['users.sharding.UserShardRouter']
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
+# Password hashing profile. PASSWORD_HASHER picks the hasher for new hashes;
+# the others stay listed so existing hashes still verify and are upgraded on
+# login. Run `manage.py calibrate_hashers` to pick costs for this hardware.
+PASSWORD_HASHER_PROFILE = {
+    'ALGORITHM': env('PASSWORD_HASHER', default='pbkdf2_sha256'),
+    'PBKDF2_ITERATIONS': env.int('PASSWORD_PBKDF2_ITERATIONS', default=None),
+    'SCRYPT_WORK_FACTOR': env.int('PASSWORD_SCRYPT_WORK_FACTOR', default=None),
+}
+_PASSWORD_HASHERS = {
+    'pbkdf2_sha256': 'users.hashers.PBKDF2PasswordHasher',
+    'scrypt': 'users.hashers.ScryptPasswordHasher',
+    'argon2': 'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'bcrypt_sha256': 'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'pbkdf2_sha1': 'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+}
+PASSWORD_HASHERS = [_PASSWORD_HASHERS[PASSWORD_HASHER_PROFILE['ALGORITHM']]] + [
+    hasher for algorithm, hasher in _PASSWORD_HASHERS.items() if algorithm != PASSWORD_HASHER_PROFILE['ALGORITHM']
+]
+
+# How outdated hashes are upgraded on login: 'deferred' (background thread,
+# off the response path), 'sync' (inline, Django's behaviour) or 'off'.
+# Deferred upgrades hold the plaintext password until they run, so at most
+# PASSWORD_REHASH_MAX_PENDING wait per process, one per user; the rest are
+# dropped and retried at the user's next login.
+PASSWORD_REHASH = env('PASSWORD_REHASH', default='deferred')
+PASSWORD_REHASH_MAX_PENDING = env.int('PASSWORD_REHASH_MAX_PENDING', default=1000)
+
 AUTH_PASSWORD_VALIDATORS = [
     {
-        'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
+        'NAME': 'users.password_policy.UserAttributeSimilarityValidator',
     },
     {
         'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator',
     },
     {
-        'NAME': 'django.contrib.auth.password_validation.CommonPasswordValidator',
+        'NAME': 'users.password_policy.CommonPasswordValidator',
     },
     {
         'NAME': 'django.contrib.auth.password_validation.NumericPasswordValidator',
     },
 ]
 
+# Compiled, memory-mapped list of common and breached passwords, built by
+# `manage.py build_password_blocklist`. Without it Django's list of 20,000
+# common passwords is compiled in memory per process.
+PASSWORD_BLOCKLIST = env('PASSWORD_BLOCKLIST', default=str(BASE_DIR / 'password-blocklist.bin'))
+
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
         'rest_framework.renderers.JSONRenderer',
-        'rest_framework.renderers.BrowsableAPIRenderer',
-    ],
+    ] + ([] if STARTUP_OPTIMIZED else ['rest_framework.renderers.BrowsableAPIRenderer']),
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework_simplejwt.authentication.JWTAuthentication',
@@ -176,6 +313,7 @@ SIMPLE_JWT = {
     'AUTH_TOKEN_CLASSES': ('rest_framework_simplejwt.tokens.AccessToken',),
     'TOKEN_TYPE_CLAIM': 'token_type',
     'TOKEN_USER_CLASS': 'rest_framework_simplejwt.models.TokenUser',
+    'TOKEN_OBTAIN_SERIALIZER': 'users.serializers.TokenObtainPairSerializer',
 
     'JTI_CLAIM': 'jti',
 
@@ -184,6 +322,101 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
 }
 
+# Login token issuance (see users.tokens.TokenIssuer). HMAC-signed pairs are
+# built from a pre-encoded header and a pre-keyed HMAC; other algorithms use
+# simplejwt's path. With WRITE_BEHIND, OutstandingToken rows are queued per
+# process and written in batches after responses are sent and, with
+# FLUSH_THREAD, by a background thread per process, so a token may be missing
+# from the outstanding list for up to FLUSH_INTERVAL seconds. A worker killed
+# with SIGKILL or by the OOM killer loses the rows it still holds, at most
+# about FLUSH_INTERVAL seconds of logins; those tokens stay valid and can
+# still be blacklisted. The test settings turn the thread off: its own
+# database connection would bypass test transactions.
+TOKEN_ISSUER = {
+    'ENABLED': env.bool('TOKEN_ISSUER_ENABLED', default=True),
+    'WRITE_BEHIND': env.bool('TOKEN_WRITE_BEHIND', default=True),
+    'BATCH_SIZE': env.int('TOKEN_WRITE_BATCH_SIZE', default=200),
+    'FLUSH_INTERVAL': env.float('TOKEN_WRITE_FLUSH_INTERVAL', default=1.0),
+    'FLUSH_THREAD': env.bool('TOKEN_WRITE_FLUSH_THREAD', default=True),
+    'MAX_PENDING': env.int('TOKEN_WRITE_MAX_PENDING', default=10000),
+}
+
+# Sampled request profiling. Profiles land in a ring buffer under DIR; see
+# `manage.py profile_report`. Requests with a valid X-Profile-Token header are
+# always profiled.
+PROFILING = {
+    'ENABLED': env.bool('PROFILING_ENABLED', default=True),
+    'SAMPLE_RATE': env.float('PROFILING_SAMPLE_RATE', default=0.0),
+    'PATH_PREFIXES': ['/api/users/'],
+    'MODE': env('PROFILING_MODE', default='sample'),  # 'sample' or 'cprofile'
+    'INTERVAL': env.float('PROFILING_INTERVAL', default=0.005),
+    'DIR': env('PROFILING_DIR', default=os.path.join(tempfile.gettempdir(), 'auth-service-profiles')),
+    'MAX_FILES': env.int('PROFILING_MAX_FILES', default=500),
+    'TOKEN_MAX_AGE': env.int('PROFILING_TOKEN_MAX_AGE', default=3600),
+}
+
+# Structured logging. Records are JSON lines, queued by the request thread and
+# written in batches by a background thread per process; when the queue is
+# full they are dropped and counted instead of blocking (see users.eventlog).
+EVENT_LOG = {
+    'ACCESS_LOG': env.bool('ACCESS_LOG_ENABLED', default=True),
+    'ACCESS_SAMPLE_RATE': env.float('ACCESS_LOG_SAMPLE_RATE', default=1.0),
+    # Per URL name, e.g. ACCESS_LOG_SAMPLE_RATES=user-login=1.0,schema=0.01
+    'ACCESS_SAMPLE_RATES': env.dict('ACCESS_LOG_SAMPLE_RATES', cast={'value': float}, default={}),
+}
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'users.eventlog.JSONFormatter'},
+    },
+    'handlers': {
+        'events': {
+            'class': 'users.eventlog.EventQueueHandler',
+            'filename': env('EVENT_LOG_FILE', default='') or None,
+            'capacity': env.int('EVENT_LOG_QUEUE_SIZE', default=10000),
+            'batch_size': env.int('EVENT_LOG_BATCH_SIZE', default=256),
+            'formatter': 'json',
+        },
+    },
+    'loggers': {
+        'users.access': {'handlers': ['events'], 'level': env('ACCESS_LOG_LEVEL', default='INFO'), 'propagate': False},
+        'users.auth': {'handlers': ['events'], 'level': env('AUTH_LOG_LEVEL', default='INFO'), 'propagate': False},
+    },
+    'root': {'handlers': ['events'], 'level': env('LOG_LEVEL', default='WARNING')},
+}
+
+# Audit trail of registrations, logins, reset requests and password changes.
+# Events are buffered per process ('memory') or in a Redis list shared by the
+# workers ('redis') and written in batches (COPY on PostgreSQL) after responses
+# are sent. `manage.py audit_partitions` creates upcoming monthly partitions and
+# drops those older than RETENTION_DAYS; run it daily. FLUSH_THREAD also writes
+# due events from a background thread per process, so a worker killed with
+# SIGKILL or by the OOM killer loses at most about FLUSH_INTERVAL seconds of
+# events from the memory buffer (none from the Redis buffer). The test settings
+# turn it off: its own database connection would bypass test transactions.
+AUDIT_LOG = {
+    'ENABLED': env.bool('AUDIT_LOG_ENABLED', default=True),
+    'BUFFER': env('AUDIT_LOG_BUFFER', default='memory'),
+    'BATCH_SIZE': env.int('AUDIT_LOG_BATCH_SIZE', default=500),
+    'FLUSH_INTERVAL': env.float('AUDIT_LOG_FLUSH_INTERVAL', default=5.0),
+    'FLUSH_THREAD': env.bool('AUDIT_LOG_FLUSH_THREAD', default=True),
+    'MAX_BUFFERED': env.int('AUDIT_LOG_MAX_BUFFERED', default=100000),
+    'RETENTION_DAYS': env.int('AUDIT_LOG_RETENTION_DAYS', default=400),
+    'PARTITIONS_AHEAD': env.int('AUDIT_LOG_PARTITIONS_AHEAD', default=3),
+}
+
+# Idempotency-Key support on register / forgot-password / reset-password:
+# how long responses are kept for replay, how long the in-flight lock lives,
+# and how long a duplicate waits for the first request before getting 409.
+IDEMPOTENCY_KEY_TTL = env.int('IDEMPOTENCY_KEY_TTL', default=86400)
+IDEMPOTENCY_LOCK_TIMEOUT = env.int('IDEMPOTENCY_LOCK_TIMEOUT', default=30)
+IDEMPOTENCY_WAIT_TIMEOUT = env.float('IDEMPOTENCY_WAIT_TIMEOUT', default=10)
+
+# Budgets enforced by `manage.py benchmark_startup`
+STARTUP_IMPORT_BUDGET_MS = env.int('STARTUP_IMPORT_BUDGET_MS', default=1500)
+STARTUP_FIRST_REQUEST_BUDGET_MS = env.int('STARTUP_FIRST_REQUEST_BUDGET_MS', default=5000)
+
 SPECTACULAR_SETTINGS = {
     'TITLE': 'Auth Service API',
     'DESCRIPTION': 'Authentication and User Management API',
@@ -0,0 +1,33 @@
+"""
+Settings for the test suite: ``auth_service.settings`` plus what only the
+tests need.
+
+Usage:
+    python manage.py test users
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import AUDIT_LOG, BASE_DIR, DATABASES, LOGGING, TOKEN_ISSUER, USER_SHARD_DATABASE_URLS, env
+
+if not USER_SHARD_DATABASE_URLS:
+    # Two SQLite shards for the tests that shard users over real databases;
+    # they enable sharding themselves, and only they create these databases.
+    for _index in range(2):
+        DATABASES[f'users_{_index}'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / f'users_{_index}.sqlite3',
+        }
+
+# Loggers default to ERROR, so test output is not buried in access-log lines
+# and the warnings of expected 4xx responses; tests that check log records
+# use assertLogs, which lowers the level itself.
+LOGGING['loggers']['users.access']['level'] = env('ACCESS_LOG_LEVEL', default='ERROR')
+LOGGING['loggers']['users.auth']['level'] = env('AUTH_LOG_LEVEL', default='ERROR')
+LOGGING['root']['level'] = env('LOG_LEVEL', default='ERROR')
+# django.request logs 4xx responses at WARNING through Django's own "django"
+# logger, whatever the root level.
+LOGGING['loggers']['django'] = {'handlers': [], 'level': 'ERROR'}
+
+# Background flush threads would write through their own database
+# connections, outside the test transactions.
+AUDIT_LOG['FLUSH_THREAD'] = env.bool('AUDIT_LOG_FLUSH_THREAD', default=False)
+TOKEN_ISSUER['FLUSH_THREAD'] = env.bool('TOKEN_WRITE_FLUSH_THREAD', default=False)
@@ -1,19 +1,22 @@
-from django.contrib import admin
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView, SpectacularRedocView
+from users.schema import lazy_view
 
 router = DefaultRouter()
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
-
-    # Schema & docs
-    path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
-    path('api/doc/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
-    path('api/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
+    # Schema & docs (drf-spectacular is imported on first use)
+    path('api/schema/', lazy_view('drf_spectacular.views.SpectacularAPIView'), name='schema'),
+    path('api/doc/', lazy_view('drf_spectacular.views.SpectacularSwaggerView', url_name='schema'), name='swagger-ui'),
+    path('api/redoc/', lazy_view('drf_spectacular.views.SpectacularRedocView', url_name='schema'), name='redoc'),
 
     # API endpoints
     path('api/', include(router.urls)),
     path('api/users/', include('users.urls')),
 ]
+
+if settings.ADMIN_ENABLED:
+    from django.contrib import admin
+
+    urlpatterns.insert(0, path('admin/', admin.site.urls))
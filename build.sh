@@ -8,4 +8,7 @@ pip install -r requirements.txt
 # Convert static asset files
 python manage.py collectstatic --no-input
 
+# Compile the password blocklist shared by all workers
+python manage.py build_password_blocklist
+
 python manage.py migrate
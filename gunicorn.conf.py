@@ -0,0 +1,171 @@
+"""
+Gunicorn runtime configuration for the auth service.
+
+Pick a worker model with ``GUNICORN_PROFILE``:
+
+- ``sync``: one request per process; simplest, most memory per request.
+- ``gthread`` (default): threaded workers; password hashing releases the GIL,
+  so threads overlap hashing with I/O.
+- ``uvicorn``: ASGI workers serving ``auth_service.asgi:application``.
+
+Worker and thread counts are derived from the CPUs available to the
+container and the memory it may use. ``GUNICORN_WORKERS`` and
+``GUNICORN_THREADS`` override them.
+
+Usage:
+    gunicorn -c gunicorn.conf.py
+"""
+import gc
+import os
+import resource
+import sys
+import threading
+import time
+
+from auth_service.resources import available_cpus, available_memory_mb
+
+PROFILES = {
+    'sync': {
+        'worker_class': 'sync',
+        'wsgi_app': 'auth_service.wsgi:application',
+        'workers_per_cpu': 2,
+        'threads': 1,
+    },
+    'gthread': {
+        'worker_class': 'gthread',
+        'wsgi_app': 'auth_service.wsgi:application',
+        'workers_per_cpu': 1,
+        'threads': 4,
+    },
+    'uvicorn': {
+        'worker_class': 'uvicorn.workers.UvicornWorker',
+        'wsgi_app': 'auth_service.asgi:application',
+        'workers_per_cpu': 1,
+        'threads': 1,
+    },
+}
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def size_workers(profile, cpus, memory_mb, worker_memory_mb):
+    """
+    Compute the worker count for a profile.
+
+    Args:
+        profile: Entry from ``PROFILES``
+        cpus: Available CPUs
+        memory_mb: Available memory in MB, or None if unknown
+        worker_memory_mb: Expected resident memory of one worker in MB
+
+    Returns:
+        int: Number of workers, at least 1
+    """
+    workers = cpus * profile['workers_per_cpu'] + (1 if profile['worker_class'] == 'sync' else 0)
+    if memory_mb:
+        # Leave a fifth of the memory for the master, page cache and spikes.
+        workers = min(workers, int(memory_mb * 0.8 // worker_memory_mb))
+    return max(1, workers)
+
+
+PROFILE_NAME = os.environ.get('GUNICORN_PROFILE', 'gthread')
+if PROFILE_NAME not in PROFILES:
+    raise RuntimeError(f'Unknown GUNICORN_PROFILE {PROFILE_NAME!r}; choose from {", ".join(PROFILES)}')
+PROFILE = PROFILES[PROFILE_NAME]
+
+bind = os.environ.get('GUNICORN_BIND', f'0.0.0.0:{os.environ.get("PORT", "8080")}')
+wsgi_app = PROFILE['wsgi_app']
+worker_class = PROFILE['worker_class']
+workers = _env_int('GUNICORN_WORKERS', size_workers(
+    PROFILE,
+    available_cpus(),
+    available_memory_mb(),
+    _env_int('GUNICORN_WORKER_MEMORY_MB', 150),
+))
+threads = _env_int('GUNICORN_THREADS', PROFILE['threads'])
+
+# Load Django once in the master so workers share its pages copy-on-write.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+# Recycle workers periodically; jitter keeps them from restarting together.
+max_requests = _env_int('GUNICORN_MAX_REQUESTS', 10000)
+max_requests_jitter = _env_int('GUNICORN_MAX_REQUESTS_JITTER', max_requests // 10)
+
+timeout = _env_int('GUNICORN_TIMEOUT', 30)
+graceful_timeout = _env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+keepalive = _env_int('GUNICORN_KEEPALIVE', 5)
+
+# Log per-worker stats every N requests (0 disables periodic reports).
+STATS_INTERVAL = _env_int('GUNICORN_STATS_INTERVAL', 1000)
+
+# Dump a tracemalloc snapshot of every worker at this interval (seconds)
+# into GUNICORN_TRACEMALLOC_DIR; used by ``manage.py soak_test``. Tracing
+# slows workers down, so leave it unset in production.
+TRACEMALLOC_DIR = os.environ.get('GUNICORN_TRACEMALLOC_DIR')
+TRACEMALLOC_INTERVAL = float(os.environ.get('GUNICORN_TRACEMALLOC_INTERVAL') or 60)
+TRACEMALLOC_FRAMES = _env_int('GUNICORN_TRACEMALLOC_FRAMES', 10)
+
+_stats = {'requests': 0, 'busy_seconds': 0.0, 'started': 0.0}
+_stats_lock = threading.Lock()
+
+
+def _worker_stats(worker):
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    uptime = time.monotonic() - _stats['started']
+    return (
+        f'worker {worker.pid}: requests={_stats["requests"]} '
+        f'busy={_stats["busy_seconds"]:.1f}s uptime={uptime:.0f}s '
+        f'max_rss={usage.ru_maxrss // 1024}MB'
+    )
+
+
+def when_ready(server):
+    server.log.info(
+        'profile=%s worker_class=%s workers=%s threads=%s preload=%s',
+        PROFILE_NAME, worker_class, workers, threads, preload_app,
+    )
+
+
+def pre_fork(server, worker):
+    # Move everything the master has allocated (Django, settings, URLconf)
+    # out of the collector's reach so that GC passes in workers don't touch,
+    # and therefore copy, the shared pages.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    _stats.update(requests=0, busy_seconds=0.0, started=time.monotonic())
+    if TRACEMALLOC_DIR:
+        from users.soak import HeapSnapshotter
+        HeapSnapshotter(TRACEMALLOC_DIR, TRACEMALLOC_INTERVAL, TRACEMALLOC_FRAMES).start()
+
+
+# pre_request/post_request are not called by uvicorn workers.
+def pre_request(worker, req):
+    req._started = time.monotonic()
+
+
+def post_request(worker, req, environ, resp):
+    with _stats_lock:
+        _stats['requests'] += 1
+        _stats['busy_seconds'] += time.monotonic() - getattr(req, '_started', time.monotonic())
+        report = STATS_INTERVAL and _stats['requests'] % STATS_INTERVAL == 0
+    if report:
+        worker.log.info(_worker_stats(worker))
+
+
+def child_exit(server, worker):
+    # Admission-control slots live in memory shared with the workers; free
+    # the ones held by a worker that died mid-request (e.g. timeout kill).
+    admission = sys.modules.get('users.admission')
+    if admission is not None:
+        freed = admission.reap(worker.pid)
+        if freed:
+            server.log.warning('freed %s admission slots held by worker %s', freed, worker.pid)
+
+
+def worker_exit(server, worker):
+    server.log.info('exiting %s', _worker_stats(worker))
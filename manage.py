@@ -6,7 +6,10 @@ import sys
 
 def main():
     """Run administrative tasks."""
-    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'auth_service.settings')
+    # The test suite has its own settings module; other runners select it
+    # with DJANGO_SETTINGS_MODULE.
+    default_settings = 'auth_service.test_settings' if sys.argv[1:2] == ['test'] else 'auth_service.settings'
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', default_settings)
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc:
@@ -3,8 +3,8 @@
 
 echo "Running Django tests for users app..."
 
-# Set Django settings module
-export DJANGO_SETTINGS_MODULE=auth_service.settings
+# Test settings: the base settings plus the databases the sharding tests use
+export DJANGO_SETTINGS_MODULE=auth_service.test_settings
 
 # Run tests
 python manage.py test users --verbosity=2
@@ -1,3 +1,280 @@
-from django.contrib import admin
+import json
+from itertools import chain
 
-# Register your models here.
+from django.contrib import admin, messages
+from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.contrib.auth import forms as auth_forms
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _, ngettext
+
+from . import sharding
+from .eventlog import log_auth_event
+from .models import User
+
+CURSOR_VAR = 'after'
+
+# Below this many rows an exact COUNT(*) is cheap enough to run.
+EXACT_COUNT_THRESHOLD = 10000
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that takes its count from planner statistics on PostgreSQL.
+
+    Unfiltered querysets use ``pg_class.reltuples``; filtered ones use the row
+    estimate from ``EXPLAIN``. Small estimates, and other database backends,
+    fall back to an exact ``COUNT(*)``.
+    """
+
+    is_estimate = False
+
+    @cached_property
+    def count(self):
+        estimate = self.estimate()
+        if estimate is None or estimate < EXACT_COUNT_THRESHOLD:
+            self.is_estimate = False
+            return super().count
+        self.is_estimate = True
+        return estimate
+
+    def estimate(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+        if not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                    [queryset.model._meta.db_table],
+                )
+                row = cursor.fetchone()
+            # reltuples is -1 for tables that were never analyzed.
+            return row[0] if row and row[0] >= 0 else None
+        plan = json.loads(queryset.explain(format='json'))
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Change list paginated by primary key instead of OFFSET.
+
+    Pages are addressed with ``?after=<id>``, the last id of the previous
+    page, so every page is an index range scan regardless of depth. The list
+    is always ordered by descending id.
+
+    When users are sharded, each page and the count are queried on all
+    shards in parallel and merged; ids are unique across shards, so the same
+    cursor works on every shard.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        try:
+            self.cursor = int(request.GET.get(CURSOR_VAR, ''))
+        except ValueError:
+            self.cursor = None
+        self.next_cursor = None
+        super().__init__(request, *args, **kwargs)
+        self.params.pop(CURSOR_VAR, None)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_queryset(self, request, exclude_parameters=None):
+        queryset = super().get_queryset(request, exclude_parameters)
+        return queryset.only(*self.model_admin.list_only_fields).order_by('-pk')
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        page = self.queryset
+        if self.cursor is not None:
+            page = page.filter(pk__lt=self.cursor)
+        if sharding.needs_fan_out(page):
+            result_list, paginator.count, paginator.is_estimate = self.get_sharded_results(request, page)
+        else:
+            result_list = list(page[:self.list_per_page + 1])
+        if len(result_list) > self.list_per_page:
+            result_list = result_list[:self.list_per_page]
+            self.next_cursor = result_list[-1].pk
+
+        self.result_count = paginator.count
+        self.result_count_is_estimate = paginator.is_estimate
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = self.next_cursor is not None or self.cursor is not None
+        self.paginator = paginator
+
+    def get_sharded_results(self, request, page):
+        """
+        Query one page and the row count on every shard.
+
+        Returns:
+            tuple: ``(rows, count, count_is_estimate)``; rows are the
+            largest ids across shards, up to one more than a page
+        """
+        def query(alias):
+            paginator = self.model_admin.get_paginator(request, self.queryset.using(alias), self.list_per_page)
+            return list(page.using(alias)[:self.list_per_page + 1]), paginator.count, paginator.is_estimate
+
+        results = sharding.fan_out(query).values()
+        rows = sorted(chain.from_iterable(rows for rows, _, _ in results), key=lambda user: user.pk, reverse=True)
+        return (
+            rows[:self.list_per_page + 1],
+            sum(count for _, count, _ in results),
+            any(is_estimate for _, _, is_estimate in results),
+        )
+
+    @property
+    def next_page_url(self):
+        if self.next_cursor is None:
+            return None
+        return self.get_query_string({CURSOR_VAR: self.next_cursor})
+
+    @property
+    def first_page_url(self):
+        return self.get_query_string(remove=[CURSOR_VAR])
+
+
+def batched_update(queryset, batch_size=1000, **values):
+    """
+    Apply ``UPDATE ... SET values`` to a queryset in primary-key batches.
+
+    Each batch is a separate short statement over at most ``batch_size`` ids,
+    so large selections never hold long row locks or build one huge
+    transaction. ``update()`` skips ``auto_now``, so callers changing exported
+    columns should pass ``updated_at`` too.
+
+    Returns:
+        int: Number of rows updated
+    """
+    ids = queryset.order_by('pk').values_list('pk', flat=True)
+    manager = queryset.model._base_manager.using(queryset.db)
+    updated = 0
+    last = None
+    while True:
+        batch_ids = ids if last is None else ids.filter(pk__gt=last)
+        batch = list(batch_ids[:batch_size])
+        if not batch:
+            return updated
+        updated += manager.filter(pk__in=batch).update(**values)
+        last = batch[-1]
+
+
+class UserCreationForm(auth_forms.AdminUserCreationForm):
+    class Meta(auth_forms.AdminUserCreationForm.Meta):
+        model = User
+        fields = ('email', 'full_name')
+        field_classes = {}
+
+
+class UserChangeForm(auth_forms.UserChangeForm):
+    class Meta(auth_forms.UserChangeForm.Meta):
+        model = User
+        field_classes = {}
+
+
+@admin.register(User)
+class UserAdmin(BaseUserAdmin):
+    """
+    Admin for the users table, built for tables with millions of rows.
+
+    - Counts come from planner statistics (``EstimatedCountPaginator``).
+    - Pages are addressed by id (``KeysetChangeList``); column sorting is off.
+    - Search is an email prefix match plus a name substring match. On
+      PostgreSQL both are backed by the indexes from migration 0003
+      (``UPPER(email)`` pattern index and ``UPPER(full_name)`` trigram index).
+    - List rows only load the displayed columns.
+    - Bulk (de)activation runs as batched UPDATEs.
+    - With sharded users, lists and bulk actions fan out to all shards, bulk
+      deletion is disabled, and changes are logged as ``admin_*`` auth
+      events: admin ``LogEntry`` rows live on ``default`` and cannot
+      reference users on other databases.
+    """
+    form = UserChangeForm
+    add_form = UserCreationForm
+    fieldsets = (
+        (None, {'fields': ('email', 'password')}),
+        (_('Personal info'), {'fields': ('full_name',)}),
+        (
+            _('Permissions'),
+            {'fields': ('is_active', 'is_staff', 'is_superuser', 'groups', 'user_permissions')},
+        ),
+        (_('Important dates'), {'fields': ('last_login', 'date_joined')}),
+    )
+    add_fieldsets = (
+        (
+            None,
+            {
+                'classes': ('wide',),
+                'fields': ('email', 'full_name', 'usable_password', 'password1', 'password2'),
+            },
+        ),
+    )
+    list_display = ('email', 'full_name', 'is_active', 'is_staff', 'date_joined')
+    list_only_fields = ('id', 'email', 'full_name', 'is_active', 'is_staff', 'date_joined')
+    list_filter = ('is_active', 'is_staff')
+    search_fields = ('^email', 'full_name')
+    ordering = ('-id',)
+    sortable_by = ()
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
+    actions = ['deactivate_users', 'activate_users']
+    update_batch_size = 1000
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        if sharding.is_enabled():
+            actions.pop('delete_selected', None)
+        return actions
+
+    def log_addition(self, request, obj, message):
+        if not sharding.is_enabled():
+            return super().log_addition(request, obj, message)
+        log_auth_event('admin_added', request, user=obj, admin_id=request.user.pk)
+
+    def log_change(self, request, obj, message):
+        if not sharding.is_enabled():
+            return super().log_change(request, obj, message)
+        log_auth_event('admin_changed', request, user=obj, admin_id=request.user.pk, changes=message)
+
+    def log_deletions(self, request, queryset):
+        if not sharding.is_enabled():
+            return super().log_deletions(request, queryset)
+        for obj in queryset:
+            log_auth_event('admin_deleted', request, user=obj, admin_id=request.user.pk)
+
+    @admin.action(description=_('Deactivate selected users'), permissions=['change'])
+    def deactivate_users(self, request, queryset):
+        self._set_active(request, queryset, False)
+
+    @admin.action(description=_('Activate selected users'), permissions=['change'])
+    def activate_users(self, request, queryset):
+        self._set_active(request, queryset, True)
+
+    def _set_active(self, request, queryset, is_active):
+        queryset = queryset.exclude(is_active=is_active)
+        values = {'is_active': is_active, 'updated_at': timezone.now()}
+        if sharding.needs_fan_out(queryset):
+            updated = sum(sharding.fan_out(
+                lambda alias: batched_update(queryset.using(alias), batch_size=self.update_batch_size, **values)
+            ).values())
+        else:
+            updated = batched_update(queryset, batch_size=self.update_batch_size, **values)
+        message = (
+            ngettext('%d user was activated.', '%d users were activated.', updated)
+            if is_active else
+            ngettext('%d user was deactivated.', '%d users were deactivated.', updated)
+        )
+        self.message_user(request, message % updated, messages.SUCCESS)
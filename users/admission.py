@@ -0,0 +1,356 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import JsonResponse
+
+from .cache import Counters
+
+ADMITTED = 'admitted'
+QUEUED = 'queued'
+REJECTED = 'rejected'
+
+
+class AdmissionStats(Counters):
+    """Per-process admission counters for one request class; ``wait_ms`` is the total queue wait."""
+
+    FIELDS = ('admitted', 'queued', 'rejected', 'timed_out', 'wait_ms')
+
+
+class SlotPool:
+    """
+    Fixed set of slots in shared memory, each holding its owner's pid or 0.
+
+    Recording the pid rather than a bare counter lets ``reap()`` reclaim the
+    slots of a worker that was killed mid-request. Callers hold the lock.
+    """
+
+    def __init__(self, size):
+        self._pids = multiprocessing.RawArray('i', size)
+
+    def take(self, pid):
+        for i, owner in enumerate(self._pids):
+            if not owner:
+                self._pids[i] = pid
+                return True
+        return False
+
+    def give_back(self, pid):
+        for i, owner in enumerate(self._pids):
+            if owner == pid:
+                self._pids[i] = 0
+                return True
+        return False
+
+    def reap(self, pid):
+        reaped = 0
+        while self.give_back(pid):
+            reaped += 1
+        return reaped
+
+    def __len__(self):
+        return sum(1 for owner in self._pids if owner)
+
+
+class AdmissionClass:
+    """
+    Concurrency limit and bounded wait queue for one class of endpoints.
+
+    State lives in shared memory guarded by a ``multiprocessing.Condition``,
+    so when the app is loaded before gunicorn forks (``preload_app``) the
+    limit applies to all workers on the host together. Without preloading
+    each worker gets its own limit.
+
+    Args:
+        name: Class name, reported in ``Server-Timing``
+        limit: Requests allowed to run at once
+        queue: Requests allowed to wait for a slot; further ones are rejected
+        timeout: Seconds a queued request waits before it is rejected
+        retry_after: ``Retry-After`` seconds sent with rejections
+    """
+
+    def __init__(self, name, limit, queue, timeout, retry_after):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.stats = AdmissionStats()
+        self._cond = multiprocessing.Condition()
+        self._active = SlotPool(limit)
+        self._waiting = SlotPool(queue)
+
+    @property
+    def active(self):
+        with self._cond:
+            return len(self._active)
+
+    @property
+    def waiting(self):
+        with self._cond:
+            return len(self._waiting)
+
+    def try_enter(self):
+        """
+        Take a slot, or a place in the queue if all slots are busy.
+
+        Returns:
+            str: ``ADMITTED``, ``QUEUED`` (call ``wait()``/``await_slot()``) or ``REJECTED``
+        """
+        pid = os.getpid()
+        with self._cond:
+            if self._active.take(pid):
+                return ADMITTED
+            if self._waiting.take(pid):
+                return QUEUED
+        return REJECTED
+
+    def _promote(self, pid, deadline):
+        # Caller holds the lock. Returns True/False when settled, None to keep waiting.
+        if self._active.take(pid):
+            self._waiting.give_back(pid)
+            return True
+        if time.monotonic() >= deadline:
+            self._waiting.give_back(pid)
+            return False
+        return None
+
+    def wait(self, deadline):
+        """
+        Block until a queued request gets a slot or ``deadline`` passes.
+
+        Returns:
+            bool: True if a slot was taken
+        """
+        pid = os.getpid()
+        with self._cond:
+            while True:
+                admitted = self._promote(pid, deadline)
+                if admitted is not None:
+                    return admitted
+                self._cond.wait(max(0.0, deadline - time.monotonic()))
+
+    async def await_slot(self, deadline):
+        """
+        Async ``wait()``. Polls with backoff instead of blocking the event loop
+        on the cross-process condition.
+        """
+        pid = os.getpid()
+        delay = 0.001
+        while True:
+            with self._cond:
+                admitted = self._promote(pid, deadline)
+            if admitted is not None:
+                return admitted
+            await asyncio.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+            delay = min(delay * 2, 0.05)
+
+    def leave(self):
+        """Release the slot taken by this process and wake one waiter."""
+        with self._cond:
+            self._active.give_back(os.getpid())
+            self._cond.notify()
+
+    def reap(self, pid):
+        """
+        Free every slot and queue place held by ``pid``.
+
+        Returns:
+            int: Number of entries freed
+        """
+        with self._cond:
+            reaped = self._active.reap(pid) + self._waiting.reap(pid)
+            if reaped:
+                self._cond.notify_all()
+        return reaped
+
+
+_classes = {}
+_classes_lock = threading.Lock()
+
+
+def get_admission_class(name, limit, queue, timeout, retry_after):
+    """
+    Return the process-wide ``AdmissionClass`` for a configuration, creating it once.
+
+    Created before a fork, the instance (and its shared memory) is inherited
+    by every worker.
+    """
+    key = (name, limit, queue, timeout, retry_after)
+    with _classes_lock:
+        if key not in _classes:
+            _classes[key] = AdmissionClass(name, limit, queue, timeout, retry_after)
+        return _classes[key]
+
+
+def reap(pid):
+    """
+    Free the slots held by a dead worker. Called from gunicorn's ``child_exit`` hook.
+
+    Returns:
+        int: Number of entries freed
+    """
+    with _classes_lock:
+        classes = list(_classes.values())
+    return sum(admission.reap(pid) for admission in classes)
+
+
+class SlotRelease:
+    """Leaves an admission class once, however many times it is called."""
+
+    def __init__(self, admission):
+        self.admission = admission
+        self._lock = threading.Lock()
+        self._released = False
+
+    def __call__(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self.admission.leave()
+
+
+class AdmissionControlMiddleware:
+    """
+    Admission control per endpoint class, configured by ``ADMISSION_CONTROL``.
+
+    Each request is classed by path prefix. It runs immediately if its class
+    has a free slot, waits up to the class timeout if the queue has room,
+    and is otherwise rejected at once with 503 and ``Retry-After``, before
+    any other middleware runs. Time spent queued is reported in the
+    ``Server-Timing`` header and in each class's ``stats``.
+
+    Works with both WSGI and ASGI handlers.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        config = settings.ADMISSION_CONTROL
+        if not config.get('ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.routes = []
+        self.classes = {}
+        for name, options in config['CLASSES'].items():
+            admission = get_admission_class(
+                name,
+                options['LIMIT'],
+                options.get('QUEUE', 0),
+                options.get('TIMEOUT', 1.0),
+                options.get('RETRY_AFTER', 1),
+            )
+            self.classes[name] = admission
+            self.routes.extend((prefix, admission) for prefix in options.get('PATHS', ()))
+        # Longest prefix wins.
+        self.routes.sort(key=lambda route: len(route[0]), reverse=True)
+        self.default = self.classes[config['DEFAULT_CLASS']]
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def classify(self, path):
+        for prefix, admission in self.routes:
+            if path.startswith(prefix):
+                return admission
+        return self.default
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        admission = self.classify(request.path_info)
+        started = time.monotonic()
+        state = admission.try_enter()
+        if state == QUEUED:
+            state = ADMITTED if admission.wait(started + admission.timeout) else REJECTED
+            admission.stats.incr('queued')
+            if state == REJECTED:
+                admission.stats.incr('timed_out')
+        if state == REJECTED:
+            return self.reject(admission)
+        waited_ms = self.admitted(admission, started)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            admission.leave()
+            raise
+        return self.report(self.release_after(response, admission), admission, waited_ms)
+
+    async def __acall__(self, request):
+        admission = self.classify(request.path_info)
+        started = time.monotonic()
+        state = admission.try_enter()
+        if state == QUEUED:
+            state = ADMITTED if await admission.await_slot(started + admission.timeout) else REJECTED
+            admission.stats.incr('queued')
+            if state == REJECTED:
+                admission.stats.incr('timed_out')
+        if state == REJECTED:
+            return self.reject(admission)
+        waited_ms = self.admitted(admission, started)
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            admission.leave()
+            raise
+        return self.report(self.release_after(response, admission), admission, waited_ms)
+
+    def admitted(self, admission, started):
+        waited_ms = (time.monotonic() - started) * 1000
+        admission.stats.incr('admitted')
+        admission.stats.incr('wait_ms', waited_ms)
+        return waited_ms
+
+    def reject(self, admission):
+        admission.stats.incr('rejected')
+        response = JsonResponse(
+            {'detail': 'Server is busy, please retry later.'},
+            status=503,
+        )
+        response['Retry-After'] = str(admission.retry_after)
+        return response
+
+    def release_after(self, response, admission):
+        """
+        Leave ``admission`` once ``response`` has been sent.
+
+        That is now for ordinary responses. A streaming response (such as the
+        user export) does its work while it is iterated, after this
+        middleware has returned, so its slot is held until the stream is
+        exhausted or the server closes the response, whichever comes first.
+        """
+        if not response.streaming:
+            admission.leave()
+            return response
+        release = SlotRelease(admission)
+        content = response.streaming_content
+        if response.is_async:
+            async def streamed():
+                try:
+                    async for chunk in content:
+                        yield chunk
+                finally:
+                    release()
+        else:
+            def streamed():
+                try:
+                    yield from content
+                finally:
+                    release()
+        response.streaming_content = streamed()
+        # Runs even if the stream was never started (e.g. the client left
+        # before the first chunk), when closing the generator would not.
+        response._resource_closers.append(release)
+        return response
+
+    def report(self, response, admission, waited_ms):
+        timing = f'admission;desc="{admission.name}";dur={waited_ms:.1f}'
+        if response.has_header('Server-Timing'):
+            timing = f'{response["Server-Timing"]}, {timing}'
+        response['Server-Timing'] = timing
+        return response
@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class UsersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'users'
+
+    def ready(self):
+        from django.core.signals import request_finished
+
+        from . import audit, tokens
+
+        # Buffered audit events and outstanding tokens are written after
+        # responses are sent.
+        request_finished.connect(audit.flush_if_due, dispatch_uid='users.audit.flush_if_due')
+        request_finished.connect(tokens.flush_if_due, dispatch_uid='users.tokens.flush_if_due')
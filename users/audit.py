@@ -0,0 +1,438 @@
+import atexit
+import csv
+import io
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, connections
+from django.utils import timezone
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import RedisError
+
+from .cache import Counters, is_degraded
+from .eventlog import email_digest
+from .models import AuthAuditEvent
+
+logger = logging.getLogger(__name__)
+
+# Column order of buffered rows, COPY and bulk_create.
+COLUMNS = ('created_at', 'event', 'user_id', 'email_digest', 'ip', 'request_id')
+
+
+def make_row(event, request, user=None, email=None):
+    return (
+        timezone.now(),
+        event,
+        user.pk if user is not None else None,
+        email_digest(email) if isinstance(email, str) and email else None,
+        request.META.get('REMOTE_ADDR'),
+        getattr(request, 'request_id', None),
+    )
+
+
+def write_rows(rows, using='default'):
+    """
+    Insert audit rows in one round trip: ``COPY`` on PostgreSQL,
+    ``bulk_create`` elsewhere.
+    """
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        copy_rows(connection, rows)
+    else:
+        AuthAuditEvent.objects.using(using).bulk_create(
+            [AuthAuditEvent(**dict(zip(COLUMNS, row))) for row in rows],
+        )
+
+
+def copy_rows(connection, rows):
+    data = io.StringIO()
+    # Unquoted empty fields are NULL in COPY's CSV format, which is how
+    # csv.writer renders None.
+    csv.writer(data).writerows(rows)
+    data.seek(0)
+    sql = (
+        f'COPY {AuthAuditEvent._meta.db_table} ({", ".join(COLUMNS)}) '
+        f'FROM STDIN WITH (FORMAT csv)'
+    )
+    with connection.cursor() as cursor:
+        raw = cursor.cursor
+        if hasattr(raw, 'copy_expert'):  # psycopg2
+            raw.copy_expert(sql, data)
+        else:  # psycopg 3
+            with raw.copy(sql) as copy:
+                copy.write(data.getvalue())
+
+
+class AuditStats(Counters):
+    """Per-process audit trail counters."""
+
+    FIELDS = ('recorded', 'dropped', 'flushed', 'batches', 'flush_errors')
+
+
+class MemoryBuffer:
+    """Per-process list of pending rows, holding at most ``max_rows``."""
+
+    def __init__(self, max_rows, stats):
+        self.max_rows = max_rows
+        self.stats = stats
+        self.reset_after_fork()
+
+    def reset_after_fork(self):
+        # Rows buffered before fork are the parent's to write.
+        self._rows = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, row):
+        with self._lock:
+            if len(self._rows) >= self.max_rows:
+                self.stats.incr('dropped')
+                return
+            self._rows.append(row)
+
+    def take(self, limit):
+        with self._lock:
+            rows = self._rows[:limit]
+            del self._rows[:limit]
+        return rows
+
+    def put_back(self, rows):
+        with self._lock:
+            room = max(0, self.max_rows - len(self._rows))
+            if room < len(rows):
+                self.stats.incr('dropped', len(rows) - room)
+            self._rows[:0] = rows[:room]
+
+
+class RedisBuffer:
+    """
+    Pending rows in a Redis list shared by all workers.
+
+    Rows survive a worker crash and are written by whichever worker flushes
+    next. While Redis is degraded or fails, rows go to a per-process
+    ``MemoryBuffer`` instead, which is drained first.
+    """
+
+    key = 'audit:{events}'
+
+    def __init__(self, max_rows, stats, cache=cache):
+        self.cache = cache
+        self.local = MemoryBuffer(max_rows, stats)
+
+    def reset_after_fork(self):
+        self.local.reset_after_fork()
+
+    def __len__(self):
+        return len(self.local)
+
+    def _client(self):
+        if is_degraded(self.cache, self.key):
+            return None
+        client = self.cache.client
+        if hasattr(client, 'shard_name'):
+            return client.get_client(write=True, key=self.key)
+        return client.get_client(write=True)
+
+    @staticmethod
+    def encode(row):
+        return json.dumps([row[0].isoformat(), *row[1:]])
+
+    @staticmethod
+    def decode(value):
+        created_at, *rest = json.loads(value)
+        return (datetime.fromisoformat(created_at), *rest)
+
+    def add(self, row):
+        try:
+            client = self._client()
+            if client is not None:
+                client.rpush(self.key, self.encode(row))
+                return
+        except (ConnectionInterrupted, RedisError):
+            logger.warning('Could not buffer audit event in Redis', exc_info=True)
+        self.local.add(row)
+
+    def take(self, limit):
+        rows = self.local.take(limit)
+        if len(rows) < limit:
+            try:
+                client = self._client()
+                values = client.lpop(self.key, limit - len(rows)) if client is not None else None
+            except (ConnectionInterrupted, RedisError):
+                values = None
+            rows.extend(self.decode(value) for value in values or ())
+        return rows
+
+    def put_back(self, rows):
+        self.local.put_back(rows)
+
+
+class AuditTrail:
+    """
+    Buffered writer of ``AuthAuditEvent`` rows.
+
+    ``record()`` only appends to the buffer. ``flush_if_due()``, run when
+    each request finishes (after the response is sent), writes the buffer
+    in batches of ``batch_size`` once that many events are pending or the
+    oldest is ``flush_interval`` seconds old. Batches that fail to write go
+    back to the buffer.
+
+    With ``flush_thread``, a background thread started on the first event in
+    each process also flushes due events, so they are written even when no
+    further request finishes. Events in a memory buffer are lost if the
+    process is killed before they are written: at most ``flush_interval``
+    seconds' worth (plus the time a write takes) while the database is
+    reachable. Events in a Redis buffer survive the process.
+    """
+
+    def __init__(self, buffer, batch_size, flush_interval, stats, flush_thread=False):
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = stats
+        self.flush_thread = flush_thread
+        self.reset_after_fork()
+
+    def reset_after_fork(self):
+        # The flush thread does not survive fork; the child starts its own.
+        self.buffer.reset_after_fork()
+        self._pending = 0
+        self._oldest = None
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+
+    def record(self, event, request, user=None, email=None):
+        self.buffer.add(make_row(event, request, user=user, email=email))
+        self.stats.incr('recorded')
+        self._pending += 1
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        if self.flush_thread and self._flusher is None:
+            self.start_flusher()
+
+    def start_flusher(self):
+        with self._flusher_lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_periodically, name='audit-flush', daemon=True)
+                self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            oldest = self._oldest
+            wait = self.flush_interval if oldest is None else oldest + self.flush_interval - time.monotonic()
+            time.sleep(max(0, wait))
+            if not self.due():
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.warning('Audit flush thread failed', exc_info=True)
+            finally:
+                connections.close_all()
+
+    def due(self):
+        return self._pending >= self.batch_size or (
+            self._oldest is not None and time.monotonic() - self._oldest >= self.flush_interval
+        )
+
+    def flush_if_due(self):
+        if self.due():
+            self.flush()
+
+    def flush(self, using='default'):
+        """
+        Write all buffered rows.
+
+        Returns:
+            int: Number of rows written
+        """
+        if not self._flush_lock.acquire(blocking=False):
+            return 0  # another thread is flushing
+        written = 0
+        try:
+            self._pending = 0
+            self._oldest = None
+            while True:
+                rows = self.buffer.take(self.batch_size)
+                if not rows:
+                    break
+                try:
+                    write_rows(rows, using=using)
+                except DatabaseError:
+                    logger.warning('Could not write %d audit events', len(rows), exc_info=True)
+                    self.stats.incr('flush_errors')
+                    self.buffer.put_back(rows)
+                    self._pending = len(self.buffer)
+                    self._oldest = time.monotonic()
+                    break
+                written += len(rows)
+                self.stats.incr('flushed', len(rows))
+                self.stats.incr('batches')
+        finally:
+            self._flush_lock.release()
+        return written
+
+
+_trail = None
+_trail_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _trail_lock
+    _trail_lock = threading.Lock()
+    if _trail is not None:
+        _trail.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_audit_trail():
+    """Return the process-wide ``AuditTrail`` configured by ``AUDIT_LOG``."""
+    global _trail
+    with _trail_lock:
+        if _trail is None:
+            config = settings.AUDIT_LOG
+            stats = AuditStats()
+            buffer_class = RedisBuffer if config['BUFFER'] == 'redis' else MemoryBuffer
+            _trail = AuditTrail(
+                buffer_class(config['MAX_BUFFERED'], stats),
+                config['BATCH_SIZE'],
+                config['FLUSH_INTERVAL'],
+                stats,
+                flush_thread=config['FLUSH_THREAD'],
+            )
+            atexit.register(_trail.flush)
+        return _trail
+
+
+def record_audit_event(event, request, user=None, email=None):
+    """
+    Buffer an audit event for the current request.
+
+    Args:
+        event: An ``AuthAuditEvent.Event`` value
+        request: The request the event happened in
+        user: The user concerned, if known
+        email: The email address submitted, stored as a keyed digest
+    """
+    if settings.AUDIT_LOG['ENABLED']:
+        get_audit_trail().record(event, request, user=user, email=email)
+
+
+def flush_if_due(**kwargs):
+    """``request_finished`` receiver writing buffered events when due."""
+    if _trail is not None:
+        _trail.flush_if_due()
+
+
+def month_start(value):
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(value):
+    return month_start(month_start(value) + timedelta(days=32))
+
+
+def partition_name(start):
+    return f'{AuthAuditEvent._meta.db_table}_p{start:%Y_%m}'
+
+
+def create_partitions(connection, start, months):
+    """
+    Create the monthly partitions covering ``months`` months from ``start``
+    (PostgreSQL only).
+
+    Returns:
+        list: Names of the partitions created
+    """
+    table = AuthAuditEvent._meta.db_table
+    existing = set(list_partitions(connection))
+    created = []
+    start = month_start(start)
+    with connection.cursor() as cursor:
+        for _ in range(months):
+            end = next_month(start)
+            name = partition_name(start)
+            if name not in existing:
+                cursor.execute(
+                    f'CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} '
+                    f'FOR VALUES FROM (%s) TO (%s)',
+                    [start, end],
+                )
+                created.append(name)
+            start = end
+    return created
+
+
+def list_partitions(connection):
+    """
+    Monthly partitions of the audit table (PostgreSQL only).
+
+    Returns:
+        dict: Partition name to the first day of its month
+    """
+    table = AuthAuditEvent._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE parent.relname = %s',
+            [table],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    partitions = {}
+    for name in names:
+        try:
+            start = datetime.strptime(name[len(table):], '_p%Y_%m')
+        except ValueError:
+            continue  # the default partition
+        partitions[name] = start.replace(tzinfo=dt_timezone.utc)
+    return partitions
+
+
+def drop_partitions(connection, before):
+    """
+    Drop the monthly partitions that end on or before ``before``
+    (PostgreSQL only). Dropping a partition is instant and leaves no dead
+    rows, unlike ``DELETE``.
+
+    Returns:
+        list: Names of the partitions dropped
+    """
+    dropped = []
+    with connection.cursor() as cursor:
+        for name, start in sorted(list_partitions(connection).items(), key=lambda item: item[1]):
+            if next_month(start) <= before:
+                cursor.execute(f'DROP TABLE {name}')
+                dropped.append(name)
+    return dropped
+
+
+def delete_before(before, batch_size=10000, using='default'):
+    """
+    Delete events older than ``before`` in batches, for databases without
+    partitions.
+
+    Returns:
+        int: Number of rows deleted
+    """
+    deleted = 0
+    queryset = AuthAuditEvent.objects.using(using)
+    while True:
+        ids = list(queryset.filter(created_at__lt=before).order_by('created_at', 'id')
+                   .values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += queryset.filter(id__in=ids).delete()[0]
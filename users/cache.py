@@ -0,0 +1,1106 @@
+import bisect
+import hashlib
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, defaultdict
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django_redis.client import DefaultClient
+from django_redis.client.default import _main_exceptions
+from django.utils.module_loading import import_string
+from django_redis.exceptions import ConnectionInterrupted
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# KEYS[1] is deleted only while it holds ARGV[1] (see ``delete_if_equal``).
+DELETE_IF_EQUAL_SCRIPT = (
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+)
+
+
+class LocalCache:
+    """
+    Bounded, thread-safe LRU cache with per-entry TTL.
+
+    Used as the in-process tier in front of Redis. Entries are evicted in
+    least-recently-used order once ``max_entries`` is reached.
+    """
+
+    def __init__(self, max_entries=1024, default_timeout=30, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Look up a key.
+
+        Returns:
+            tuple: ``(True, value)`` on a hit, ``(False, None)`` on a miss
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, timeout=None):
+        """
+        Store a value, evicting the least recently used entry when full.
+
+        Args:
+            key: Cache key
+            value: Value to store
+            timeout: Lifetime in seconds, capped at ``default_timeout``
+        """
+        if timeout is None or timeout > self.default_timeout:
+            timeout = self.default_timeout
+        if timeout <= 0:
+            self.delete(key)
+            return
+        with self._lock:
+            self._data[key] = (self._clock() + timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def update(self, key, fn):
+        """
+        Atomically replace a live entry with ``fn(value)``, keeping its expiry.
+
+        Returns:
+            tuple: ``(True, new_value)`` if the key was present, ``(False, None)`` otherwise
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= self._clock():
+                self._data.pop(key, None)
+                return False, None
+            value = fn(entry[1])
+            self._data[key] = (entry[0], value)
+            return True, value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_if_equal(self, key, value):
+        """
+        Atomically delete a live entry holding ``value``.
+
+        Returns:
+            bool: True if the entry was deleted
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= self._clock() or entry[1] != value:
+                return False
+            del self._data[key]
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key into a single execution.
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight block and receive the same result (or exception).
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        Run ``fn`` once for all concurrent callers of ``key``.
+
+        Returns:
+            tuple: ``(result, shared)`` where ``shared`` is True when the
+            result came from another caller's execution
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class Counters:
+    """Thread-safe named counters; subclasses list their fields in ``FIELDS``."""
+
+    FIELDS = ()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def incr(self, field, amount=1):
+        with self._lock:
+            self._counts[field] += amount
+
+    def reset(self):
+        with self._lock:
+            self._counts = dict.fromkeys(self.FIELDS, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class TierStats(Counters):
+    """Hit/miss counters for the local and Redis tiers."""
+
+    FIELDS = ('local_hits', 'local_misses', 'redis_hits', 'redis_misses', 'coalesced', 'invalidations')
+
+    def snapshot(self):
+        """
+        Return the current counters along with per-tier hit ratios.
+
+        Returns:
+            dict: Raw counters plus ``local_hit_ratio`` and ``redis_hit_ratio``
+        """
+        counts = super().snapshot()
+        for tier in ('local', 'redis'):
+            total = counts[f'{tier}_hits'] + counts[f'{tier}_misses']
+            counts[f'{tier}_hit_ratio'] = counts[f'{tier}_hits'] / total if total else 0.0
+        return counts
+
+
+class DegradedStats(Counters):
+    """Counters describing how often Redis was bypassed."""
+
+    FIELDS = ('failures', 'short_circuited', 'fallback_reads', 'fallback_writes')
+
+
+class LocalTier:
+    """
+    Process-wide state of the in-process tier for one Redis location.
+
+    Django builds a cache backend (and therefore a client) per thread, so the
+    LRU, single-flight table, counters and invalidation listener live here and
+    are shared by every client of the same location in the process.
+    """
+
+    def __init__(self, channel, max_entries, timeout):
+        self.channel = channel
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.reset_after_fork()
+
+    def reset_after_fork(self):
+        """Give a forked worker its own identity, empty cache and listener."""
+        self.cache = LocalCache(max_entries=self.max_entries, default_timeout=self.timeout)
+        self.stats = TierStats()
+        self.flights = SingleFlight()
+        self.instance_id = uuid.uuid4().hex
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def ensure_listener(self, connect):
+        """
+        Start the pub/sub invalidation listener if it is not running.
+
+        Args:
+            connect: Callable returning a raw redis client for the subscription
+        """
+        if self._listener is not None and self._listener.is_alive():
+            return
+        with self._lock:
+            if self._listener is not None and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(
+                target=self._listen, args=(connect,), name='cache-invalidation', daemon=True,
+            )
+            self._listener.start()
+
+    def _listen(self, connect):
+        backoff = 0.5
+        while True:
+            try:
+                pubsub = connect().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Anything published while we were disconnected is lost.
+                self.cache.clear()
+                backoff = 0.5
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self._handle(message.get('data'))
+            except Exception:
+                logger.warning('Cache invalidation listener disconnected', exc_info=True)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    def _handle(self, data):
+        if isinstance(data, bytes):
+            data = data.decode()
+        if not isinstance(data, str):
+            return
+        sender, _, key = data.partition(':')
+        if sender == self.instance_id:
+            return
+        self.stats.incr('invalidations')
+        if key == '*':
+            self.cache.clear()
+        else:
+            self.cache.delete(key)
+
+    def message(self, key):
+        return f'{self.instance_id}:{key}'
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def _reset_shared_after_fork():
+    global _shared_lock
+    _shared_lock = threading.Lock()
+    for state in _shared.values():
+        state.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_shared_after_fork)
+
+
+def _process_shared(key, factory):
+    """
+    Return the process-wide object registered under ``key``, creating it once.
+
+    Registered objects must implement ``reset_after_fork()``.
+    """
+    state = _shared.get(key)
+    if state is None:
+        with _shared_lock:
+            state = _shared.get(key)
+            if state is None:
+                state = _shared[key] = factory()
+    return state
+
+
+def get_local_tier(location, channel, max_entries, timeout):
+    """
+    Return the shared ``LocalTier`` for a Redis location, creating it once per process.
+    """
+    return _process_shared(
+        ('tier', tuple(location), channel),
+        lambda: LocalTier(channel, max_entries, timeout),
+    )
+
+
+class TieredClient(DefaultClient):
+    """
+    django-redis client with a bounded in-process LRU in front of Redis.
+
+    Only keys starting with one of the ``LOCAL_CACHE_PREFIXES`` option values
+    use the local tier; everything else (throttle history, reset tokens) goes
+    straight to Redis as with ``DefaultClient``. Writes to local-tier keys are
+    broadcast over Redis pub/sub so other workers drop their copies, and
+    concurrent misses on the same key share a single Redis fetch.
+
+    Values are kept in their encoded form and decoded on every hit, so callers
+    never share mutable objects.
+    """
+
+    def __init__(self, server, params, backend):
+        super().__init__(server, params, backend)
+        self._local_prefixes = tuple(self._options.get('LOCAL_CACHE_PREFIXES', ()))
+        self._tier = get_local_tier(
+            self._server,
+            self._options.get('LOCAL_CACHE_CHANNEL', 'cache:invalidate'),
+            self._options.get('LOCAL_CACHE_MAX_ENTRIES', 1024),
+            self._options.get('LOCAL_CACHE_TIMEOUT', 30),
+        )
+
+    def _is_local(self, key):
+        return bool(self._local_prefixes) and str(key).startswith(self._local_prefixes)
+
+    def _local_key(self, key, version=None):
+        return str(self.make_key(key, version=version))
+
+    def _invalidate(self, nkey, client=None):
+        if nkey == '*':
+            self._tier.cache.clear()
+        else:
+            self._tier.cache.delete(nkey)
+        if client is None:
+            client = self.get_client(write=True)
+        try:
+            client.publish(self._tier.channel, self._tier.message(nkey))
+        except _main_exceptions as e:
+            raise ConnectionInterrupted(connection=client) from e
+
+    def _fetch(self, nkey, client):
+        if client is None:
+            client = self.get_client(write=False)
+        try:
+            return client.get(nkey)
+        except _main_exceptions as e:
+            raise ConnectionInterrupted(connection=client) from e
+
+    def tier_stats(self):
+        """
+        Hit/miss counters and hit ratios for local-tier keys, per tier.
+
+        Returns:
+            dict: Counters for this process, plus the current local tier size
+        """
+        stats = self._tier.stats.snapshot()
+        stats['local_size'] = len(self._tier.cache)
+        return stats
+
+    def get(self, key, default=None, version=None, client=None):
+        if not self._is_local(key):
+            return super().get(key, default=default, version=version, client=client)
+
+        self._tier.ensure_listener(lambda: self.connect(0))
+        nkey = self._local_key(key, version)
+        hit, raw = self._tier.cache.get(nkey)
+        if hit:
+            self._tier.stats.incr('local_hits')
+            return self.decode(raw)
+
+        self._tier.stats.incr('local_misses')
+        raw, shared = self._tier.flights.do(nkey, lambda: self._fetch(nkey, client))
+        if shared:
+            self._tier.stats.incr('coalesced')
+            return default if raw is None else self.decode(raw)
+
+        if raw is None:
+            self._tier.stats.incr('redis_misses')
+            return default
+        self._tier.stats.incr('redis_hits')
+        self._tier.cache.set(nkey, raw)
+        return self.decode(raw)
+
+    def get_many(self, keys, version=None, client=None):
+        local_keys = [k for k in keys if self._is_local(k)]
+        if not local_keys:
+            return super().get_many(keys, version=version, client=client)
+
+        remote_keys = [k for k in keys if not self._is_local(k)]
+        result = super().get_many(remote_keys, version=version, client=client) if remote_keys else {}
+        for key in local_keys:
+            value = self.get(key, default=_MISSING, version=version, client=client)
+            if value is not _MISSING:
+                result[key] = value
+        return result
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, client=None, nx=False, xx=False):
+        result = super().set(key, value, timeout=timeout, version=version, client=client, nx=nx, xx=xx)
+        if self._is_local(key) and result:
+            self._invalidate(self._local_key(key, version), client)
+        return result
+
+    def delete(self, key, version=None, prefix=None, client=None):
+        result = super().delete(key, version=version, prefix=prefix, client=client)
+        if self._is_local(key):
+            self._invalidate(str(self.make_key(key, version=version, prefix=prefix)), client)
+        return result
+
+    def delete_many(self, keys, version=None, client=None):
+        keys = list(keys)
+        result = super().delete_many(keys, version=version, client=client)
+        for key in keys:
+            if self._is_local(key):
+                self._invalidate(self._local_key(key, version), client)
+        return result
+
+    def delete_pattern(self, pattern, version=None, prefix=None, client=None, itersize=None):
+        result = super().delete_pattern(pattern, version=version, prefix=prefix, client=client, itersize=itersize)
+        if self._local_prefixes:
+            self._invalidate('*', client)
+        return result
+
+    def clear(self, client=None):
+        super().clear(client=client)
+        if self._local_prefixes:
+            self._invalidate('*', client)
+
+    def _incr(self, key, delta=1, version=None, client=None, ignore_key_check=False):
+        result = super()._incr(key, delta=delta, version=version, client=client, ignore_key_check=ignore_key_check)
+        if self._is_local(key):
+            self._invalidate(self._local_key(key, version), client)
+        return result
+
+
+class CircuitBreaker:
+    """
+    Error-rate circuit breaker over a rolling time window.
+
+    The circuit opens once at least ``min_requests`` calls were seen in the
+    last ``window`` seconds and the failure ratio reaches ``failure_rate``.
+    After ``reset_timeout`` seconds a single probe call is let through
+    (half-open); its outcome closes or re-opens the circuit.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_rate=0.5, min_requests=10, window=10, reset_timeout=5, clock=time.monotonic):
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.trips = 0
+        self.reset_after_fork()
+
+    def reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """
+        Return True if a call may be attempted now.
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._probing:
+                return False
+            if self._state == self.OPEN and self._clock() - self._opened_at < self.reset_timeout:
+                return False
+            self._state = self.HALF_OPEN
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                self._close()
+                return
+            self._bucket()[0] += 1
+
+    def record_failure(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                self._open()
+                return
+            self._bucket()[1] += 1
+            successes = failures = 0
+            for ok, failed in self._buckets.values():
+                successes += ok
+                failures += failed
+            total = successes + failures
+            if total >= self.min_requests and failures / total >= self.failure_rate:
+                self._open()
+
+    def _bucket(self):
+        now = int(self._clock())
+        while self._buckets and next(iter(self._buckets)) <= now - self.window:
+            self._buckets.popitem(last=False)
+        return self._buckets.setdefault(now, [0, 0])
+
+    def _open(self):
+        if self._state == self.CLOSED:
+            self.trips += 1
+            logger.warning('Redis circuit breaker opened')
+        self._state = self.OPEN
+        self._opened_at = self._clock()
+        self._probing = False
+
+    def _close(self):
+        logger.info('Redis circuit breaker closed')
+        self._state = self.CLOSED
+        self._buckets.clear()
+        self._probing = False
+
+
+class Resilience:
+    """
+    Process-wide circuit breaker, degraded-mode store and counters for one Redis location.
+    """
+
+    def __init__(self, breaker_options, max_entries, timeout):
+        self.breaker_options = breaker_options
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(**breaker_options)
+        self.reset_after_fork()
+
+    def reset_after_fork(self):
+        self.breaker.reset_after_fork()
+        self.store = LocalCache(max_entries=self.max_entries, default_timeout=self.timeout)
+        self.stats = DegradedStats()
+
+
+class ResilientClient(TieredClient):
+    """
+    ``TieredClient`` that keeps serving when Redis is slow or down.
+
+    Every operation goes through a per-process circuit breaker. Failed calls
+    (bounded by the ``SOCKET_CONNECT_TIMEOUT``/``SOCKET_TIMEOUT`` options) and
+    calls made while the circuit is open are answered from a per-process
+    store instead, so reset tokens issued during an outage remain usable on
+    the worker that issued them. Throttles check ``degraded`` and switch to
+    local token buckets (see ``users.throttling``).
+    """
+
+    def __init__(self, server, params, backend):
+        super().__init__(server, params, backend)
+        breaker = self._options.get('CIRCUIT_BREAKER', {})
+        self._resilience = _process_shared(
+            ('resilience', tuple(self._server)),
+            lambda: Resilience(
+                {
+                    'failure_rate': breaker.get('FAILURE_RATE', 0.5),
+                    'min_requests': breaker.get('MIN_REQUESTS', 10),
+                    'window': breaker.get('WINDOW', 10),
+                    'reset_timeout': breaker.get('RESET_TIMEOUT', 5),
+                },
+                self._options.get('DEGRADED_MAX_ENTRIES', 10000),
+                self._options.get('DEGRADED_MAX_TIMEOUT', 3600),
+            ),
+        )
+        self._calls = threading.local()
+
+    @property
+    def breaker(self):
+        return self._resilience.breaker
+
+    @property
+    def degraded(self):
+        """True while the circuit is not closed and Redis is being bypassed."""
+        return self.breaker.state != CircuitBreaker.CLOSED
+
+    def degraded_stats(self):
+        """
+        Circuit breaker state and degraded-mode counters for this process.
+
+        Returns:
+            dict: Counters plus ``state``, ``trips`` and the degraded store size
+        """
+        stats = self._resilience.stats.snapshot()
+        stats['state'] = self.breaker.state
+        stats['trips'] = self.breaker.trips
+        stats['store_size'] = len(self._resilience.store)
+        return stats
+
+    def _guard(self, op, fallback):
+        # Nested calls (e.g. set() delegating to delete()) are accounted for
+        # by the outermost operation only.
+        depth = getattr(self._calls, 'depth', 0)
+        if depth:
+            return op()
+        if not self.breaker.allow():
+            self._resilience.stats.incr('short_circuited')
+            return fallback()
+        self._calls.depth = 1
+        try:
+            result = op()
+        except (ConnectionInterrupted, *_main_exceptions):
+            self.breaker.record_failure()
+            self._resilience.stats.incr('failures')
+            return fallback()
+        finally:
+            self._calls.depth = 0
+        self.breaker.record_success()
+        return result
+
+    def _store_key(self, key, version=None, prefix=None):
+        return str(self.make_key(key, version=version, prefix=prefix))
+
+    def _store_get(self, key, default, version):
+        self._resilience.stats.incr('fallback_reads')
+        hit, raw = self._resilience.store.get(self._store_key(key, version))
+        return self.decode(raw) if hit else default
+
+    def _store_set(self, key, value, timeout, version, nx=False, xx=False):
+        self._resilience.stats.incr('fallback_writes')
+        store = self._resilience.store
+        skey = self._store_key(key, version)
+        if nx or xx:
+            exists = store.get(skey)[0]
+            if (nx and exists) or (xx and not exists):
+                return False
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self._backend.default_timeout
+        store.set(skey, self.encode(value), timeout=timeout)
+        return True
+
+    def get(self, key, default=None, version=None, client=None):
+        def op():
+            value = super(ResilientClient, self).get(key, default=_MISSING, version=version, client=client)
+            if value is _MISSING:
+                # Keys written while Redis was unavailable only exist locally.
+                return self._store_get(key, default, version) if len(self._resilience.store) else default
+            return value
+        return self._guard(op, lambda: self._store_get(key, default, version))
+
+    def get_many(self, keys, version=None, client=None):
+        def fallback():
+            values = {key: self._store_get(key, _MISSING, version) for key in keys}
+            return {key: value for key, value in values.items() if value is not _MISSING}
+        return self._guard(lambda: super(ResilientClient, self).get_many(keys, version=version, client=client), fallback)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, client=None, nx=False, xx=False):
+        return self._guard(
+            lambda: super(ResilientClient, self).set(
+                key, value, timeout=timeout, version=version, client=client, nx=nx, xx=xx,
+            ),
+            lambda: self._store_set(key, value, timeout, version, nx=nx, xx=xx),
+        )
+
+    def delete(self, key, version=None, prefix=None, client=None):
+        def op():
+            self._resilience.store.delete(self._store_key(key, version, prefix))
+            return super(ResilientClient, self).delete(key, version=version, prefix=prefix, client=client)
+
+        def fallback():
+            self._resilience.stats.incr('fallback_writes')
+            skey = self._store_key(key, version, prefix)
+            hit = self._resilience.store.get(skey)[0]
+            self._resilience.store.delete(skey)
+            return int(hit)
+        return self._guard(op, fallback)
+
+    def delete_if_equal(self, key, value, version=None, client=None):
+        """
+        Delete ``key`` only while it still holds ``value``, atomically.
+
+        Used to release locks taken with ``add``: each owner stores a unique
+        token, so an owner whose lock expired cannot delete the lock that
+        another caller has taken since. Runs as a script in Redis, or on the
+        degraded-mode store while Redis is bypassed.
+
+        Returns:
+            bool: True if the key was deleted
+        """
+        encoded = self.encode(value)
+        skey = self._store_key(key, version)
+
+        def op():
+            local = self._resilience.store.delete_if_equal(skey, encoded)
+            redis = client or self.get_client(write=True)
+            deleted = redis.eval(DELETE_IF_EQUAL_SCRIPT, 1, self.make_key(key, version=version), encoded)
+            if self._is_local(key):
+                self._invalidate(self._local_key(key, version), client)
+            return bool(deleted) or local
+
+        def fallback():
+            self._resilience.stats.incr('fallback_writes')
+            return self._resilience.store.delete_if_equal(skey, encoded)
+        return self._guard(op, fallback)
+
+    def delete_many(self, keys, version=None, client=None):
+        keys = list(keys)
+
+        def op():
+            for key in keys:
+                self._resilience.store.delete(self._store_key(key, version))
+            return super(ResilientClient, self).delete_many(keys, version=version, client=client)
+        return self._guard(op, lambda: sum(self.delete(key, version=version) for key in keys))
+
+    def delete_pattern(self, pattern, version=None, prefix=None, client=None, itersize=None):
+        def fallback():
+            self._resilience.store.clear()
+            return 0
+        return self._guard(
+            lambda: super(ResilientClient, self).delete_pattern(
+                pattern, version=version, prefix=prefix, client=client, itersize=itersize,
+            ),
+            fallback,
+        )
+
+    def clear(self, client=None):
+        from .throttling import reset_local_buckets
+
+        self._resilience.store.clear()
+        reset_local_buckets()
+        return self._guard(lambda: super(ResilientClient, self).clear(client=client), lambda: None)
+
+    def has_key(self, key, version=None, client=None):
+        return self._guard(
+            lambda: super(ResilientClient, self).has_key(key, version=version, client=client),
+            lambda: self._store_get(key, _MISSING, version) is not _MISSING,
+        )
+
+    def ttl(self, key, version=None, client=None):
+        return self._guard(lambda: super(ResilientClient, self).ttl(key, version=version, client=client), lambda: None)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None, client=None):
+        return self._guard(
+            lambda: super(ResilientClient, self).touch(key, timeout=timeout, version=version, client=client),
+            lambda: False,
+        )
+
+    def _incr(self, key, delta=1, version=None, client=None, ignore_key_check=False):
+        def fallback():
+            self._resilience.stats.incr('fallback_writes')
+            skey = self._store_key(key, version)
+            hit, raw = self._resilience.store.update(skey, lambda raw: self.encode(self.decode(raw) + delta))
+            if hit:
+                return self.decode(raw)
+            if not ignore_key_check:
+                raise ValueError(f"Key '{key!r}' not found")
+            self._resilience.store.set(skey, delta)
+            return delta
+        return self._guard(
+            lambda: super(ResilientClient, self)._incr(
+                key, delta=delta, version=version, client=client, ignore_key_check=ignore_key_check,
+            ),
+            fallback,
+        )
+
+
+def hash_tag(key):
+    """
+    Return the part of ``key`` that decides its shard.
+
+    Follows the Redis Cluster rule: if the key contains ``{...}`` with a
+    non-empty body, only the first such body is hashed, so keys sharing a
+    tag (``throttle_login_{1.2.3.4}``, ``throttle_password_reset_{1.2.3.4}``)
+    always live on the same shard.
+    """
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+class HashRing:
+    """
+    Consistent hash ring with ``vnodes`` virtual nodes per server.
+
+    Each server owns many small arcs of a 64-bit ring, so keys spread evenly
+    and adding or removing one of N servers moves only about 1/N of them.
+    """
+
+    def __init__(self, nodes=(), vnodes=160):
+        self.vnodes = vnodes
+        self.nodes = []
+        self._points = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(value):
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+    def add(self, node):
+        self.nodes.append(node)
+        self._rebuild()
+
+    def remove(self, node):
+        self.nodes.remove(node)
+        self._rebuild()
+
+    def _rebuild(self):
+        points = sorted(
+            (self.hash(f'{node}#{i}'), node) for node in self.nodes for i in range(self.vnodes)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key):
+        """Return the server owning ``key`` (after hash-tag extraction)."""
+        if not self._points:
+            raise ValueError('Hash ring has no nodes')
+        index = bisect.bisect(self._points, self.hash(hash_tag(key)))
+        return self._owners[index % len(self._owners)]
+
+    def shares(self):
+        """
+        Fraction of the hash space owned by each server.
+
+        Returns:
+            dict: Server to share, summing to 1
+        """
+        shares = dict.fromkeys(self.nodes, 0.0)
+        size = 2 ** 64
+        for i, point in enumerate(self._points):
+            # The arc ending at a point belongs to that point's owner.
+            previous = self._points[i - 1] if i else self._points[-1] - size
+            shares[self._owners[i]] += (point - previous) / size
+        return shares
+
+
+class ShardLoad:
+    """Per-process count of operations routed to each shard."""
+
+    def __init__(self):
+        self.reset_after_fork()
+
+    def reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._ops = Counter()
+
+    def incr(self, shard, amount=1):
+        with self._lock:
+            self._ops[shard] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._ops)
+
+
+def _routed(name):
+    def method(self, key, *args, **kwargs):
+        return getattr(self._shard(key), name)(key, *args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+def _pinned(name):
+    # Multi-key commands run on one shard, so all keys must share a hash tag.
+    def method(self, *keys, **kwargs):
+        return getattr(self._shard(*keys), name)(*keys, **kwargs)
+    method.__name__ = name
+    return method
+
+
+class ShardedClient:
+    """
+    Cache client spreading keys over several Redis servers.
+
+    ``LOCATION`` lists the servers; keys are assigned with a ``HashRing``
+    (``VIRTUAL_NODES`` option, default 160) on their hash tag. Every server
+    gets its own ``SHARD_CLIENT_CLASS`` client (default ``ResilientClient``),
+    so local tiers, pub/sub invalidation and circuit breakers all work per
+    shard: one server going down degrades only the keys it owns.
+
+    Single-key commands go to the key's shard. ``get_many``/``set_many``/
+    ``delete_many`` are split per shard. Commands over several keys
+    (``sinter``, ``smove``...) require the keys to share a hash tag.
+    ``clear``, ``keys``, ``iter_keys`` and ``delete_pattern`` visit every
+    shard.
+    """
+
+    def __init__(self, server, params, backend):
+        self._backend = backend
+        if isinstance(server, str):
+            server = server.split(',')
+        self._server = [url.strip() for url in server if url.strip()]
+        options = params.get('OPTIONS', {})
+        shard_class = import_string(options.get('SHARD_CLIENT_CLASS', 'users.cache.ResilientClient'))
+        self._shards = {url: shard_class([url], params, backend) for url in self._server}
+        self._ring = HashRing(self._server, options.get('VIRTUAL_NODES', 160))
+        self._load = _process_shared(('shard-load', tuple(self._server)), ShardLoad)
+
+    def shard_name(self, key):
+        """Return the server URL that owns ``key``."""
+        return self._ring.node_for(str(key))
+
+    def _shard(self, *keys):
+        names = {self.shard_name(key) for key in keys}
+        if len(names) != 1:
+            raise ValueError(f'Keys {keys!r} map to different shards; give them a common {{hash tag}}')
+        name = names.pop()
+        self._load.incr(name)
+        return self._shards[name]
+
+    def _group(self, keys):
+        groups = defaultdict(list)
+        for key in keys:
+            groups[self.shard_name(key)].append(key)
+        for name in groups:
+            self._load.incr(name)
+        return groups
+
+    @property
+    def shards(self):
+        return dict(self._shards)
+
+    @property
+    def degraded(self):
+        """True while any shard is being bypassed."""
+        return any(getattr(shard, 'degraded', False) for shard in self._shards.values())
+
+    def degraded_for(self, key):
+        """True while the shard owning ``key`` is being bypassed."""
+        return bool(getattr(self._shards[self.shard_name(key)], 'degraded', False))
+
+    def get_client(self, write=True, key=None):
+        """Raw redis-py client of ``key``'s shard (the first shard without a key)."""
+        name = self.shard_name(key) if key is not None else self._server[0]
+        return self._shards[name].get_client(write=write)
+
+    def shard_stats(self):
+        """
+        Load per shard.
+
+        Returns:
+            dict: For each server: ``ops`` routed by this process, ``keys``
+            stored (None if unreachable), ``ring_share`` of the hash space
+            and the circuit breaker ``state`` where available
+        """
+        ops = self._load.snapshot()
+        shares = self._ring.shares()
+        stats = {}
+        for name, shard in self._shards.items():
+            try:
+                keys = shard.get_client(write=False).dbsize()
+            except (ConnectionInterrupted, *_main_exceptions):
+                keys = None
+            breaker = getattr(shard, 'breaker', None)
+            stats[name] = {
+                'ops': ops.get(name, 0),
+                'keys': keys,
+                'ring_share': shares[name],
+                'state': breaker.state if breaker is not None else None,
+            }
+        return stats
+
+    get = _routed('get')
+    set = _routed('set')
+    add = _routed('add')
+    delete = _routed('delete')
+    delete_if_equal = _routed('delete_if_equal')
+    has_key = _routed('has_key')
+    incr = _routed('incr')
+    decr = _routed('decr')
+    incr_version = _routed('incr_version')
+    touch = _routed('touch')
+    ttl = _routed('ttl')
+    pttl = _routed('pttl')
+    persist = _routed('persist')
+    expire = _routed('expire')
+    expire_at = _routed('expire_at')
+    pexpire = _routed('pexpire')
+    pexpire_at = _routed('pexpire_at')
+    lock = _routed('lock')
+    sadd = _routed('sadd')
+    scard = _routed('scard')
+    sismember = _routed('sismember')
+    smembers = _routed('smembers')
+    spop = _routed('spop')
+    srandmember = _routed('srandmember')
+    srem = _routed('srem')
+    sscan = _routed('sscan')
+    sscan_iter = _routed('sscan_iter')
+    smismember = _routed('smismember')
+    hset = _routed('hset')
+    hdel = _routed('hdel')
+    hlen = _routed('hlen')
+    hkeys = _routed('hkeys')
+    hexists = _routed('hexists')
+
+    sdiff = _pinned('sdiff')
+    sinter = _pinned('sinter')
+    sunion = _pinned('sunion')
+
+    def sdiffstore(self, dest, *keys, **kwargs):
+        return self._shard(dest, *keys).sdiffstore(dest, *keys, **kwargs)
+
+    def sinterstore(self, dest, *keys, **kwargs):
+        return self._shard(dest, *keys).sinterstore(dest, *keys, **kwargs)
+
+    def sunionstore(self, dest, *keys, **kwargs):
+        return self._shard(dest, *keys).sunionstore(dest, *keys, **kwargs)
+
+    def smove(self, source, destination, member, **kwargs):
+        return self._shard(source, destination).smove(source, destination, member, **kwargs)
+
+    def get_many(self, keys, version=None, client=None):
+        result = {}
+        for name, shard_keys in self._group(keys).items():
+            result.update(self._shards[name].get_many(shard_keys, version=version))
+        return result
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, client=None):
+        for name, shard_keys in self._group(data).items():
+            self._shards[name].set_many({key: data[key] for key in shard_keys}, timeout=timeout, version=version)
+
+    def delete_many(self, keys, version=None, client=None):
+        return sum(
+            self._shards[name].delete_many(shard_keys, version=version) or 0
+            for name, shard_keys in self._group(list(keys)).items()
+        )
+
+    def clear(self, client=None):
+        for shard in self._shards.values():
+            shard.clear()
+
+    def delete_pattern(self, pattern, version=None, prefix=None, client=None, itersize=None):
+        return sum(
+            shard.delete_pattern(pattern, version=version, prefix=prefix, itersize=itersize) or 0
+            for shard in self._shards.values()
+        )
+
+    def keys(self, search, version=None):
+        return list(itertools.chain.from_iterable(
+            shard.keys(search, version=version) for shard in self._shards.values()
+        ))
+
+    def iter_keys(self, search, itersize=None, version=None):
+        return itertools.chain.from_iterable(
+            shard.iter_keys(search, itersize=itersize, version=version) for shard in self._shards.values()
+        )
+
+    def close(self, **kwargs):
+        for shard in self._shards.values():
+            shard.close(**kwargs)
+
+
+def is_degraded(cache, key=None):
+    """
+    Return True if ``cache`` is a Redis cache currently bypassing Redis.
+
+    Args:
+        cache: A Django cache backend instance
+        key: For sharded caches, only consider the shard owning this key
+    """
+    client = getattr(cache, 'client', None)
+    if key is not None and hasattr(client, 'degraded_for'):
+        return client.degraded_for(key)
+    return bool(getattr(client, 'degraded', False))
@@ -0,0 +1,348 @@
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+import weakref
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.crypto import salted_hmac
+
+from .cache import Counters
+
+access_logger = logging.getLogger('users.access')
+auth_logger = logging.getLogger('users.auth')
+
+# Attributes of every LogRecord; anything else was passed in ``extra``.
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+class JSONFormatter(logging.Formatter):
+    """Format a record as one JSON object, including its ``extra`` fields."""
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc_info'] = record.exc_text
+        return json.dumps(data, default=str, separators=(',', ':'))
+
+
+class LogStats(Counters):
+    """Per-process counters of one ``EventQueueHandler``."""
+
+    FIELDS = ('enqueued', 'dropped', 'written', 'batches')
+
+
+class BatchingQueueListener(QueueListener):
+    """
+    ``QueueListener`` writing everything queued so far (up to ``batch_size``
+    records) with one write and one flush.
+
+    Records dropped by the handler since the last batch are reported in a
+    warning record of their own.
+    """
+
+    def __init__(self, queue, handler, batch_size, stats):
+        super().__init__(queue, handler)
+        self.batch_size = batch_size
+        self.stats = stats
+        self._reported_drops = 0
+
+    def enqueue_sentinel(self):
+        # Blocks while the queue is full; the listener is draining it.
+        self.queue.put(self._sentinel)
+
+    def _monitor(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not self._sentinel]
+            self.write(records)
+            if len(records) < len(batch):
+                return
+
+    def write(self, records):
+        handler = self.handlers[0]
+        dropped = self.stats.snapshot()['dropped']
+        if dropped > self._reported_drops:
+            records.append(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': 'Dropped %d log records: queue full', 'args': (dropped - self._reported_drops,),
+            }))
+            self._reported_drops = dropped
+        lines = []
+        for record in records:
+            try:
+                lines.append(handler.format(record) + '\n')
+            except Exception:
+                handler.handleError(record)
+        if not lines:
+            return
+        handler.acquire()
+        try:
+            if isinstance(handler, WatchedFileHandler):
+                handler.reopenIfNeeded()
+            handler.stream.write(''.join(lines))
+            handler.flush()
+        except Exception:
+            handler.handleError(records[0])
+        finally:
+            handler.release()
+        self.stats.incr('written', len(lines))
+        self.stats.incr('batches')
+
+
+_handlers = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    for handler in list(_handlers):
+        handler.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def log_stats():
+    """
+    Counters of all event log handlers in this process.
+
+    Returns:
+        dict: ``enqueued``, ``dropped``, ``written`` and ``batches``
+    """
+    total = dict.fromkeys(LogStats.FIELDS, 0)
+    for handler in list(_handlers):
+        for field, value in handler.stats.snapshot().items():
+            total[field] += value
+    return total
+
+
+class EventQueueHandler(QueueHandler):
+    """
+    Logging handler that never blocks the calling thread.
+
+    Records are put on a queue of ``capacity`` entries; when it is full the
+    record is dropped and counted in ``stats`` rather than waiting. A
+    ``BatchingQueueListener`` thread, started on first use in each process,
+    formats and writes the records to ``filename`` (or stderr) in batches of
+    up to ``batch_size``. Formatting, including JSON encoding, happens on the
+    listener thread.
+    """
+
+    def __init__(self, filename=None, capacity=10000, batch_size=256):
+        self.capacity = capacity
+        self.batch_size = batch_size
+        super().__init__(queue.Queue(capacity))
+        self.target = WatchedFileHandler(filename) if filename else logging.StreamHandler(sys.stderr)
+        self.stats = LogStats()
+        self.listener = None
+        self._listener_lock = threading.Lock()
+        _handlers.add(self)
+
+    def reset_after_fork(self):
+        # The listener thread does not survive fork; records queued before it
+        # are the parent's to write.
+        self.queue = queue.Queue(self.capacity)
+        self.listener = None
+        self._listener_lock = threading.Lock()
+        self.stats = LogStats()
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Resolve the message now, since its arguments may change once the
+        # call returns, but leave formatting to the listener.
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.listener is None:
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.stats.incr('dropped')
+        else:
+            self.stats.incr('enqueued')
+
+    def start(self):
+        with self._listener_lock:
+            if self.listener is None:
+                self.listener = BatchingQueueListener(self.queue, self.target, self.batch_size, self.stats)
+                self.listener.start()
+
+    def close(self):
+        """Write out queued records and stop the listener."""
+        with self._listener_lock:
+            listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+        self.target.close()
+        super().close()
+
+
+def email_digest(email):
+    """
+    Short keyed digest of an email address, so events about one account can
+    be correlated without writing the address to the logs.
+    """
+    return salted_hmac('users.eventlog', email.strip().lower(), algorithm='sha256').hexdigest()[:16]
+
+
+def log_auth_event(event, request, user=None, email=None, **fields):
+    """
+    Record an authentication event on the ``users.auth`` logger.
+
+    Args:
+        event: Event name, e.g. ``'login_failed'``
+        request: The request the event happened in
+        user: The user concerned, if known
+        email: The email address submitted, logged as ``email_digest()``
+        **fields: Additional JSON fields
+    """
+    extra = {
+        'event': event,
+        'ip': request.META.get('REMOTE_ADDR'),
+        'path': request.path,
+        'request_id': getattr(request, 'request_id', None),
+    }
+    if user is not None:
+        extra['user_id'] = user.pk
+    if isinstance(email, str) and email:
+        extra['email_digest'] = email_digest(email)
+    extra.update(fields)
+    auth_logger.info(event, extra=extra)
+
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._:-]{1,64}')
+
+
+class RequestIdMiddleware:
+    """
+    Give every request an id, available as ``request.request_id`` and
+    returned in ``X-Request-ID``.
+
+    A well-formed ``X-Request-ID`` sent by the client or proxy is kept, so
+    ids can be followed across services; otherwise a new one is generated.
+    Access logs, auth events and audit records carry the id.
+
+    Works with both WSGI and ASGI handlers.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        self.assign(request)
+        response = self.get_response(request)
+        response[REQUEST_ID_HEADER] = request.request_id
+        return response
+
+    async def __acall__(self, request):
+        self.assign(request)
+        response = await self.get_response(request)
+        response[REQUEST_ID_HEADER] = request.request_id
+        return response
+
+    def assign(self, request):
+        request_id = request.headers.get(REQUEST_ID_HEADER, '')
+        request.request_id = request_id if REQUEST_ID_PATTERN.fullmatch(request_id) else uuid.uuid4().hex
+
+
+class AccessLogMiddleware:
+    """
+    Log every request on the ``users.access`` logger, configured by ``EVENT_LOG``.
+
+    Requests are sampled per URL name: ``ACCESS_SAMPLE_RATES`` overrides
+    ``ACCESS_SAMPLE_RATE`` for individual views, and the rate used is logged
+    as ``sample_rate`` so counts can be scaled back up. Server errors are
+    always logged. For streaming responses the duration covers producing the
+    response object, not sending its body.
+
+    Works with both WSGI and ASGI handlers.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        config = settings.EVENT_LOG
+        if not config['ACCESS_LOG']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = config['ACCESS_SAMPLE_RATE']
+        self.sample_rates = config['ACCESS_SAMPLE_RATES']
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self.log(request, response, started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.log(request, response, started)
+        return response
+
+    def log(self, request, response, started):
+        match = request.resolver_match
+        view = match.view_name if match is not None else None
+        rate = self.sample_rates.get(view, self.sample_rate)
+        if response.status_code < 500 and rate < 1 and random.random() >= rate:
+            return
+        access_logger.info(
+            '%s %s %s', request.method, request.path, response.status_code,
+            extra={
+                'method': request.method,
+                'path': request.path,
+                'view': view,
+                'status': response.status_code,
+                'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+                'ip': request.META.get('REMOTE_ADDR'),
+                'request_id': getattr(request, 'request_id', None),
+                'sample_rate': rate,
+            },
+        )
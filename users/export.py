@@ -0,0 +1,183 @@
+import datetime
+import heapq
+import json
+from operator import itemgetter
+
+from django.conf import settings
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from . import sharding
+from .models import User, UserTombstone
+
+EXPORT_FIELDS = (
+    'id', 'email', 'full_name', 'is_active', 'is_staff', 'is_superuser',
+    'date_joined', 'last_login', 'updated_at',
+)
+ID = EXPORT_FIELDS.index('id')
+UPDATED_AT = EXPORT_FIELDS.index('updated_at')
+
+DEFAULT_CHUNK_SIZE = 2000
+
+TOKEN_SALT = 'users.export'
+
+
+class InvalidExportCursor(ValueError):
+    """Raised for a malformed ``since`` value or a tampered continuation token."""
+
+
+def make_token(updated_at, pk):
+    """
+    Build a continuation token for the position after the row ``(updated_at, pk)``.
+
+    Tokens are signed so clients cannot forge positions, but carry no expiry:
+    a token from last night's run is the ``since`` of tonight's.
+    """
+    return signing.dumps({'u': updated_at.isoformat(), 'i': pk}, salt=TOKEN_SALT, compress=True)
+
+
+def parse_token(token):
+    """
+    Decode a continuation token.
+
+    Returns:
+        tuple: ``(updated_at, pk)`` of the last exported row
+
+    Raises:
+        InvalidExportCursor: If the token is malformed or its signature is invalid
+    """
+    try:
+        data = signing.loads(token, salt=TOKEN_SALT)
+        return datetime.datetime.fromisoformat(data['u']), int(data['i'])
+    except (signing.BadSignature, KeyError, TypeError, ValueError) as exc:
+        raise InvalidExportCursor('Invalid continuation token.') from exc
+
+
+def parse_since(value):
+    """
+    Parse a ``since`` value: an ISO 8601 datetime or date. Naive values are
+    taken to be in the current time zone.
+
+    Raises:
+        InvalidExportCursor: If the value is not a date or datetime
+    """
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise InvalidExportCursor(f'Invalid since value {value!r}; expected an ISO 8601 date or datetime.')
+        parsed = datetime.datetime.combine(date, datetime.time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def export_window(queryset, since=None, token=None, id_field='pk'):
+    """
+    Restrict ``queryset`` to the rows an export covers, by ``updated_at``
+    and ``id_field``.
+
+    Rows updated within the last ``USER_EXPORT['SAFETY_LAG']`` seconds are
+    left for the next run. ``updated_at`` is set when a row is saved, not
+    when its transaction commits, so a row committed late can carry an
+    earlier timestamp than rows already exported; without the lag a
+    continuation token could move past it and the change would never be
+    exported.
+
+    Args:
+        queryset: Users or tombstones
+        since: Only include rows updated at or after this datetime
+        token: Continuation token; only include rows after its position
+        id_field: Field that breaks ``updated_at`` ties, as in the token
+    """
+    lag = datetime.timedelta(seconds=settings.USER_EXPORT['SAFETY_LAG'])
+    queryset = queryset.filter(updated_at__lt=timezone.now() - lag)
+    if since is not None:
+        queryset = queryset.filter(updated_at__gte=since)
+    if token is not None:
+        updated_at, pk = parse_token(token)
+        queryset = queryset.filter(
+            Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, **{f'{id_field}__gt': pk}),
+        )
+    return queryset.order_by('updated_at', id_field)
+
+
+def export_queryset(since=None, token=None):
+    """
+    Rows to export, in ``(updated_at, id)`` order. Recent changes are held
+    back by the safety lag (see ``export_window``).
+
+    Args:
+        since: Only include users updated at or after this datetime
+        token: Continuation token; only include users after its position
+
+    Returns:
+        QuerySet: ``values_list`` of ``EXPORT_FIELDS``
+    """
+    return export_window(User.objects.all(), since, token).values_list(*EXPORT_FIELDS)
+
+
+def tombstone_queryset(since=None, token=None):
+    """
+    Ids retired by re-numbering users for sharding, in ``(updated_at,
+    user_id)`` order and over the same window as ``export_queryset``.
+
+    Returns:
+        QuerySet: ``values_list`` of ``(user_id, replaced_by, updated_at)``
+    """
+    queryset = export_window(UserTombstone.objects.all(), since, token, id_field='user_id')
+    return queryset.values_list('user_id', 'replaced_by', 'updated_at')
+
+
+def export_lines(queryset, chunk_size=DEFAULT_CHUNK_SIZE, token=None, tombstones=None):
+    """
+    Stream a queryset from ``export_queryset()`` as NDJSON.
+
+    Rows are read through a server-side cursor ``chunk_size`` at a time and
+    yielded as one string per chunk, so memory use does not grow with the
+    table. After every chunk, and at the end, a checkpoint line
+    ``{"next_token": ..., "complete": ...}`` is emitted; passing the last
+    checkpoint seen as ``token`` resumes an interrupted export, and the final
+    one starts the next incremental run. With sharded users, every shard is
+    read through its own cursor and the streams are merged in order.
+
+    Tombstones are merged in as ``{"id": ..., "deleted": true,
+    "replaced_by": ..., "updated_at": ...}`` lines, so a consumer drops the
+    row of a user that now has another id.
+
+    Args:
+        queryset: Rows from ``export_queryset()``
+        chunk_size: Rows fetched per round trip and per checkpoint
+        token: The continuation token the export started from, repeated in
+            the final checkpoint when no rows follow it
+        tombstones: Rows from ``tombstone_queryset()``, if any
+
+    Yields:
+        str: Newline-terminated JSON lines
+    """
+    encoder = DjangoJSONEncoder()
+    lines = []
+    entries = (
+        (row[UPDATED_AT], row[ID], dict(zip(EXPORT_FIELDS, row)))
+        for row in sharding.iterate(queryset, chunk_size, key=lambda row: (row[UPDATED_AT], row[ID]))
+    )
+    if tombstones is not None:
+        deleted = (
+            (updated_at, pk, {'id': pk, 'deleted': True, 'replaced_by': replaced_by, 'updated_at': updated_at})
+            for pk, replaced_by, updated_at in tombstones.iterator(chunk_size=chunk_size)
+        )
+        entries = heapq.merge(entries, deleted, key=itemgetter(0, 1))
+    for updated_at, pk, entry in entries:
+        lines.append(encoder.encode(entry) + '\n')
+        if len(lines) == chunk_size:
+            token = make_token(updated_at, pk)
+            lines.append(json.dumps({'next_token': token, 'complete': False}) + '\n')
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        token = make_token(updated_at, pk)
+    lines.append(json.dumps({'next_token': token, 'complete': True}) + '\n')
+    yield ''.join(lines)
@@ -0,0 +1,242 @@
+import logging
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.db import connections
+
+from .cache import Counters
+
+logger = logging.getLogger(__name__)
+
+
+def _profile(name, default):
+    return settings.PASSWORD_HASHER_PROFILE.get(name) or default
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    """
+    PBKDF2-SHA256 with the iteration count from ``PASSWORD_HASHER_PROFILE``.
+
+    Keeps Django's algorithm name, so existing hashes verify unchanged and
+    those with a different iteration count are upgraded on login.
+    """
+
+    @property
+    def iterations(self):
+        return _profile('PBKDF2_ITERATIONS', hashers.PBKDF2PasswordHasher.iterations)
+
+
+class ScryptPasswordHasher(hashers.ScryptPasswordHasher):
+    """
+    Scrypt with the work factor (N) from ``PASSWORD_HASHER_PROFILE``.
+
+    ``maxmem`` grows with N, which Django's default 32 MiB cap would
+    otherwise reject above N=2**14.
+    """
+
+    @property
+    def work_factor(self):
+        return _profile('SCRYPT_WORK_FACTOR', hashers.ScryptPasswordHasher.work_factor)
+
+    @property
+    def maxmem(self):
+        return 256 * self.work_factor * self.block_size
+
+
+# Parameter that sets the cost of each hasher and how cost scales with it.
+TUNABLE = {
+    'pbkdf2_sha256': ('iterations', 'linear'),
+    'pbkdf2_sha1': ('iterations', 'linear'),
+    'scrypt': ('work_factor', 'power_of_two'),
+    'argon2': ('time_cost', 'linear'),
+    'bcrypt_sha256': ('rounds', 'log2'),
+    'bcrypt': ('rounds', 'log2'),
+}
+
+BENCHMARK_PASSWORD = 'correct horse battery staple'
+
+
+def with_cost(hasher, value):
+    """
+    Return an instance of ``hasher``'s class with its cost parameter set to ``value``.
+    """
+    param = TUNABLE[hasher.algorithm][0]
+    return type(type(hasher).__name__, (type(hasher),), {param: value})()
+
+
+def time_verify(hasher, runs=3):
+    """
+    Median seconds for one ``verify()`` of a hash made with ``hasher``'s parameters.
+    """
+    encoded = hasher.encode(BENCHMARK_PASSWORD, hasher.salt())
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        hasher.verify(BENCHMARK_PASSWORD, encoded)
+        timings.append(time.perf_counter() - started)
+    return sorted(timings)[len(timings) // 2]
+
+
+def recommend_cost(hasher, target, runs=3):
+    """
+    Find the cost parameter value whose verify time is closest to ``target`` seconds.
+
+    Returns:
+        tuple: ``(current_seconds, value, seconds)``: the verify time at the
+        current parameters, the recommended value and its verify time
+    """
+    param, scale = TUNABLE[hasher.algorithm]
+    current = getattr(hasher, param)
+    current_seconds = time_verify(hasher, runs)
+    ratio = target / current_seconds
+    if scale == 'linear':
+        value = max(1, round(current * ratio))
+        if param == 'iterations':
+            value = max(1000, round(value, -3))
+    elif scale == 'power_of_two':
+        value = max(2, int(current * 2.0 ** round(math.log2(ratio))))
+    else:
+        value = max(4, current + round(math.log2(ratio)))
+    return current_seconds, value, time_verify(with_cost(hasher, value), runs)
+
+
+class RehashStats(Counters):
+    """Per-process counters of deferred hash upgrades."""
+
+    FIELDS = ('queued', 'deduplicated', 'dropped', 'rehashed', 'failed')
+
+
+class RehashQueue:
+    """
+    Hash upgrades waiting for the background thread of this process.
+
+    Each job holds a plaintext password until it runs, so the queue keeps
+    at most ``max_pending`` jobs and at most one per user (counting the one
+    running). Further upgrades are dropped and counted in ``stats``; the
+    user's next login schedules them again. The thread is started on first
+    use; jobs still pending when the process exits are dropped the same way.
+    """
+
+    def __init__(self, max_pending):
+        self.max_pending = max_pending
+        self.stats = RehashStats()
+        self._pending = {}  # pk -> (user_model, old_encoded, raw_password)
+        self._running = None
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        with self._condition:
+            return len(self._pending) + (self._running is not None)
+
+    def submit(self, user_model, pk, old_encoded, raw_password):
+        """
+        Queue an upgrade of user ``pk``'s hash.
+
+        Returns:
+            bool: False if it was dropped as a duplicate or because the queue is full
+        """
+        with self._condition:
+            if pk in self._pending or pk == self._running:
+                self.stats.incr('deduplicated')
+                return False
+            if len(self._pending) >= self.max_pending:
+                self.stats.incr('dropped')
+                return False
+            self._pending[pk] = (user_model, old_encoded, raw_password)
+            self.stats.incr('queued')
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='password-rehash', daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+        return True
+
+    def join(self, timeout=None):
+        """
+        Wait until every queued upgrade has run.
+
+        Returns:
+            bool: False if ``timeout`` seconds passed first
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and self._running is None, timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending)
+                self._running = next(iter(self._pending))
+                user_model, old_encoded, raw_password = self._pending.pop(self._running)
+            try:
+                rehash_password(user_model, self._running, old_encoded, raw_password)
+                self.stats.incr('rehashed')
+            except Exception:
+                self.stats.incr('failed')
+                logger.warning('Could not upgrade the password hash of user %s', self._running, exc_info=True)
+            finally:
+                del raw_password
+                connections.close_all()
+                with self._condition:
+                    self._running = None
+                    self._condition.notify_all()
+
+
+_rehash_queue = None
+_rehash_queue_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _rehash_queue, _rehash_queue_lock
+    # The thread does not survive fork; the parent's pending jobs are its own.
+    _rehash_queue = None
+    _rehash_queue_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_rehash_queue():
+    """Return this process's ``RehashQueue``, sized by ``PASSWORD_REHASH_MAX_PENDING``."""
+    global _rehash_queue
+    with _rehash_queue_lock:
+        if _rehash_queue is None:
+            _rehash_queue = RehashQueue(settings.PASSWORD_REHASH_MAX_PENDING)
+        return _rehash_queue
+
+
+def rehash_password(user_model, pk, old_encoded, raw_password):
+    """
+    Store a hash of ``raw_password`` made with the preferred hasher.
+
+    The update only applies while the stored hash is still ``old_encoded``,
+    so a password change that lands first is never overwritten. ``updated_at``
+    is left alone: the hash is not exported, so a fleet-wide upgrade should
+    not make every user look modified.
+
+    Returns:
+        bool: True if the row was updated
+    """
+    encoded = hashers.make_password(raw_password)
+    return bool(user_model._base_manager.filter(pk=pk, password=old_encoded).update(password=encoded))
+
+
+def schedule_rehash(user, raw_password):
+    """
+    Upgrade ``user``'s hash according to ``PASSWORD_REHASH``.
+
+    ``'deferred'`` hashes and writes on a background thread after the
+    response (see ``RehashQueue``), ``'sync'`` does it inline (as Django
+    does by default) and ``'off'`` skips upgrades.
+    """
+    mode = settings.PASSWORD_REHASH
+    if mode == 'off' or user.pk is None:
+        return
+    if mode == 'sync':
+        rehash_password(type(user), user.pk, user.password, raw_password)
+        return
+    get_rehash_queue().submit(type(user), user.pk, user.password, raw_password)
@@ -0,0 +1,117 @@
+import functools
+import json
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.crypto import salted_hmac
+from rest_framework import status
+from rest_framework.response import Response
+
+MAX_KEY_LENGTH = 255
+
+
+def storage_key(request, route, key):
+    """
+    Cache key for a request: an HMAC of the route, the ``Idempotency-Key``
+    and the canonical JSON body, so neither keys nor bodies (which may hold
+    passwords) appear in Redis. The digest is a hash tag, so on a sharded
+    cache the response and its lock live on the same shard.
+    """
+    data = request.data
+    if hasattr(data, 'lists'):
+        data = dict(data.lists())
+    body = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+    digest = salted_hmac('users.idempotency', f'{route}\0{key}\0{body}', algorithm='sha256').hexdigest()
+    return f'idempotency:{route}:{{{digest}}}'
+
+
+def replay(stored):
+    response = Response(stored['data'], status=stored['status'])
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def run_idempotent(key, handler):
+    """
+    Run ``handler`` at most once per ``key`` and serve its response to duplicates.
+
+    The first caller takes a lock with ``cache.add`` and stores the response
+    for ``IDEMPOTENCY_KEY_TTL`` seconds. Duplicates arriving meanwhile poll
+    for the stored response for up to ``IDEMPOTENCY_WAIT_TIMEOUT`` seconds and
+    get 409 if it does not appear. If the handler raises or returns a 5xx,
+    nothing is stored and the next duplicate runs it again. The lock holds a
+    token unique to its owner and is released with a compare-and-delete, so
+    a handler that outlives ``IDEMPOTENCY_LOCK_TIMEOUT`` cannot release the
+    lock of a duplicate that took it over.
+
+    Args:
+        key: Storage key from ``storage_key()``
+        handler: Callable returning a DRF ``Response``
+
+    Returns:
+        Response: The handler's response or a replay of the stored one
+    """
+    stored = cache.get(key)
+    if stored is not None:
+        return replay(stored)
+
+    lock = f'{key}:lock'
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+    delay = 0.01
+    while not cache.add(lock, token, timeout=settings.IDEMPOTENCY_LOCK_TIMEOUT):
+        stored = cache.get(key)
+        if stored is not None:
+            return replay(stored)
+        if time.monotonic() >= deadline:
+            response = Response(
+                {'error': 'A request with this Idempotency-Key is still being processed.'},
+                status=status.HTTP_409_CONFLICT,
+            )
+            response['Retry-After'] = '1'
+            return response
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+    try:
+        # The first request may have finished between our lookup and taking the lock.
+        stored = cache.get(key)
+        if stored is not None:
+            return replay(stored)
+        response = handler()
+        if response.status_code < 500:
+            cache.set(
+                key,
+                {'status': response.status_code, 'data': response.data},
+                timeout=settings.IDEMPOTENCY_KEY_TTL,
+            )
+        return response
+    finally:
+        cache.client.delete_if_equal(lock, token)
+
+
+def idempotent(method):
+    """
+    Decorate a view's ``post`` to honour an ``Idempotency-Key`` header.
+
+    Retries with the same key and body get the first response back, marked
+    with ``Idempotent-Replayed: true``, without running the view again.
+    Requests without the header are handled normally.
+    """
+    @functools.wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return method(self, request, *args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return Response(
+                {'error': f'Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters.'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return run_idempotent(
+            storage_key(request, request.path, key),
+            lambda: method(self, request, *args, **kwargs),
+        )
+    return wrapper
@@ -0,0 +1,50 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from ...audit import create_partitions, delete_before, drop_partitions, get_audit_trail, list_partitions
+
+
+class Command(BaseCommand):
+    """
+    Maintain the auth audit table; run daily.
+
+    On PostgreSQL, creates the monthly partitions for the coming
+    ``--ahead`` months and drops those entirely older than
+    ``--retention-days``. Elsewhere, old rows are deleted in batches.
+    Events still buffered in this process (or in Redis, with the Redis
+    buffer) are written first.
+
+    Usage:
+        python manage.py audit_partitions
+        python manage.py audit_partitions --retention-days 90 --ahead 6
+    """
+    help = 'Create upcoming audit partitions and drop expired ones.'
+
+    def add_arguments(self, parser):
+        config = settings.AUDIT_LOG
+        parser.add_argument('--retention-days', type=int, default=config['RETENTION_DAYS'])
+        parser.add_argument('--ahead', type=int, default=config['PARTITIONS_AHEAD'], help='Months to create ahead.')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        flushed = get_audit_trail().flush(using=options['database'])
+        if flushed:
+            self.stdout.write(f'Wrote {flushed} buffered events')
+
+        now = timezone.now()
+        cutoff = now - timedelta(days=options['retention_days'])
+        if connection.vendor != 'postgresql':
+            deleted = delete_before(cutoff, using=options['database'])
+            self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} events older than {cutoff:%Y-%m-%d}'))
+            return
+
+        for name in create_partitions(connection, now, options['ahead'] + 1):
+            self.stdout.write(f'Created {name}')
+        for name in drop_partitions(connection, cutoff):
+            self.stdout.write(f'Dropped {name}')
+        self.stdout.write(self.style.SUCCESS(f'{len(list_partitions(connection))} monthly partitions'))
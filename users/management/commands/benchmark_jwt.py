@@ -0,0 +1,61 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken, BlacklistMixin, RefreshToken as SimpleJWTRefreshToken
+
+from ...models import User
+from ...tokens import get_token_issuer
+
+
+class Command(BaseCommand):
+    """
+    Measure login token issuance, in token pairs per second on one core.
+
+    Compares simplejwt's path (``RefreshToken.for_user`` and
+    ``.access_token``, both signed) with ``users.tokens.TokenIssuer``. Only
+    building and signing are timed: neither path writes its
+    ``OutstandingToken`` row here. Both pairs are checked to decode with
+    simplejwt's token classes first.
+
+    Usage:
+        python manage.py benchmark_jwt --seconds 5
+    """
+    help = "Benchmark the prepared JWT issuer against simplejwt's token classes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=2, help='Time spent on each path.')
+
+    def handle(self, *args, **options):
+        issuer = get_token_issuer()
+        if issuer is None:
+            raise CommandError('The prepared issuer is disabled or does not support the JWT settings.')
+        user = User(id=123456789, email='jane.doe@example.com', full_name='Jane Doe')
+
+        refresh, access, _, _ = issuer.issue(user)
+        for token, token_class in ((refresh, SimpleJWTRefreshToken), (access, AccessToken)):
+            token_class(token)  # raises TokenError if simplejwt rejects it
+
+        results = {}
+        for label, issue in (('simplejwt', self.simplejwt_pair), ('prepared', issuer.issue)):
+            rate = self.measure(issue, user, options['seconds'])
+            results[label] = rate
+            self.stdout.write(f'{label:<10} {rate:10,.0f} pairs/s  {1e6 / rate:7.1f} us/pair')
+        self.stdout.write(self.style.SUCCESS(f'speedup: {results["prepared"] / results["simplejwt"]:.1f}x'))
+
+    def simplejwt_pair(self, user):
+        # BlacklistMixin.for_user would write an OutstandingToken row.
+        refresh = super(BlacklistMixin, SimpleJWTRefreshToken).for_user(user)
+        return str(refresh), str(refresh.access_token)
+
+    def measure(self, issue, user, seconds):
+        """Pairs per second issued by ``issue(user)`` over ``seconds``."""
+        for _ in range(100):
+            issue(user)  # warm up
+        count = 0
+        started = time.process_time()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            for _ in range(100):
+                issue(user)
+            count += 100
+        return count / (time.process_time() - started)
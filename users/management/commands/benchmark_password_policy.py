@@ -0,0 +1,67 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth import password_validation
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+
+from ...models import User
+
+# Django's stock validators, for comparison.
+STOCK_VALIDATORS = [
+    {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
+     'OPTIONS': {'user_attributes': ('email', 'full_name')}},
+    {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
+    {'NAME': 'django.contrib.auth.password_validation.CommonPasswordValidator'},
+    {'NAME': 'django.contrib.auth.password_validation.NumericPasswordValidator'},
+]
+
+SAMPLE_PASSWORDS = ['correct horse battery staple', 'password123', 'jane.doe-1990', 'x' * 4096]
+
+
+class Command(BaseCommand):
+    """
+    Measure the per-request cost of password validation.
+
+    Reports the time to load each validator chain in a fresh process
+    (first use) and the mean time per ``validate_password`` call, per
+    validator, for the configured ``AUTH_PASSWORD_VALIDATORS`` and for
+    Django's stock validators.
+
+    Usage:
+        python manage.py benchmark_password_policy --runs 2000
+    """
+    help = 'Benchmark the configured password validators against the Django defaults.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=1000, help='Validations per password and validator.')
+
+    def handle(self, *args, **options):
+        user = User(email='jane.doe@example.com', full_name='Jane Doe')
+        for label, config in (('configured', settings.AUTH_PASSWORD_VALIDATORS), ('django', STOCK_VALIDATORS)):
+            started = time.perf_counter()
+            validators = password_validation.get_password_validators(config)
+            for validator in validators:
+                self.validate(validator, SAMPLE_PASSWORDS[0], user)  # loads lazily built state
+            load_ms = (time.perf_counter() - started) * 1000
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{label} validators (first use {load_ms:.1f} ms)'))
+            total = 0.0
+            for validator in validators:
+                mean = self.time(validator, user, options['runs'])
+                total += mean
+                self.stdout.write(f'  {type(validator).__module__}.{type(validator).__name__}: {mean * 1e6:.1f} us')
+            self.stdout.write(f'  total per validate_password: {total * 1e6:.1f} us')
+
+    def validate(self, validator, password, user):
+        try:
+            validator.validate(password, user)
+        except ValidationError:
+            pass
+
+    def time(self, validator, user, runs):
+        """Mean seconds per call over ``SAMPLE_PASSWORDS``."""
+        started = time.perf_counter()
+        for _ in range(runs):
+            for password in SAMPLE_PASSWORDS:
+                self.validate(validator, password, user)
+        return (time.perf_counter() - started) / (runs * len(SAMPLE_PASSWORDS))
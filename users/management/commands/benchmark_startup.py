@@ -0,0 +1,144 @@
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+IMPORT_SCRIPT = (
+    'import django; django.setup(); '
+    'from django.core.wsgi import get_wsgi_application; get_wsgi_application(); '
+    'from django.conf import settings; from importlib import import_module; '
+    'import_module(settings.ROOT_URLCONF)'
+)
+
+
+def parse_importtime(output):
+    """
+    Parse ``python -X importtime`` output.
+
+    Args:
+        output: Captured stderr of the interpreter
+
+    Returns:
+        tuple: ``(total_self_us, modules)`` where ``modules`` is a list of
+        ``(cumulative_us, self_us, name)`` tuples
+    """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except (ValueError, IndexError):
+            continue  # header line
+        modules.append((cumulative_us, self_us, fields[2].strip()))
+    return sum(m[1] for m in modules), modules
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Command(BaseCommand):
+    """
+    Measure cold-start cost and fail when it exceeds the configured budget.
+
+    Records ``python -X importtime`` for loading Django, the WSGI app and the
+    URLconf, then starts a single-worker gunicorn and measures wall time until
+    it serves its first response.
+
+    Usage:
+        python manage.py benchmark_startup --runs 5 --importtime-output importtime.log
+    """
+    help = 'Benchmark import time and time to first served request against a budget.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=3, help='Runs per measurement; the median is reported.')
+        parser.add_argument('--url', default='/api/users/login/', help='Path requested from the fresh server.')
+        parser.add_argument('--top', type=int, default=15, help='Number of slowest imports to list.')
+        parser.add_argument('--importtime-output', help='Write the raw -X importtime log of the last run here.')
+        parser.add_argument('--import-budget-ms', type=float, default=settings.STARTUP_IMPORT_BUDGET_MS)
+        parser.add_argument(
+            '--first-request-budget-ms', type=float, default=settings.STARTUP_FIRST_REQUEST_BUDGET_MS,
+        )
+        parser.add_argument('--skip-server', action='store_true', help='Only measure imports.')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'auth_service.settings'))
+
+        import_ms = []
+        for _ in range(options['runs']):
+            total_us, modules, raw = self.measure_imports(env)
+            import_ms.append(total_us / 1000)
+        if options['importtime_output']:
+            with open(options['importtime_output'], 'w') as f:
+                f.write(raw)
+
+        self.stdout.write('Slowest imports (cumulative ms, last run):')
+        for cumulative_us, self_us, name in sorted(modules, reverse=True)[:options['top']]:
+            self.stdout.write(f'  {cumulative_us / 1000:8.1f}  {name}')
+
+        failures = []
+        import_median = statistics.median(import_ms)
+        self.report('Import time', import_median, options['import_budget_ms'], failures)
+
+        if not options['skip_server']:
+            first_request_ms = [self.measure_first_request(env, options['url']) for _ in range(options['runs'])]
+            self.report('Time to first request', statistics.median(first_request_ms),
+                        options['first_request_budget_ms'], failures)
+
+        if failures:
+            raise CommandError('Startup budget exceeded: ' + '; '.join(failures))
+
+    def report(self, label, value_ms, budget_ms, failures):
+        line = f'{label}: {value_ms:.1f} ms (budget {budget_ms:.0f} ms)'
+        if value_ms > budget_ms:
+            failures.append(line)
+            self.stdout.write(self.style.ERROR(line))
+        else:
+            self.stdout.write(self.style.SUCCESS(line))
+
+    def measure_imports(self, env):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT],
+            env=env, cwd=settings.BASE_DIR, capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            raise CommandError(f'Importing the application failed:\n{result.stderr[-2000:]}')
+        total_us, modules = parse_importtime(result.stderr)
+        return total_us, modules, result.stderr
+
+    def measure_first_request(self, env, path, timeout=60):
+        port = free_port()
+        server_env = dict(env, GUNICORN_BIND=f'127.0.0.1:{port}', GUNICORN_WORKERS='1')
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'],
+            env=server_env, cwd=settings.BASE_DIR,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            while time.perf_counter() - started < timeout:
+                if process.poll() is not None:
+                    raise CommandError('gunicorn exited before serving a request')
+                try:
+                    urllib.request.urlopen(f'http://127.0.0.1:{port}{path}', timeout=timeout)
+                except urllib.error.HTTPError:
+                    pass  # any HTTP response counts as served
+                except OSError:
+                    time.sleep(0.01)
+                    continue
+                return (time.perf_counter() - started) * 1000
+            raise CommandError(f'No response from gunicorn within {timeout}s')
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
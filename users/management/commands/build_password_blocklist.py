@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...password_policy import default_password_list, read_passwords, write_blocklist
+
+
+class Command(BaseCommand):
+    """
+    Compile password lists into the blocklist read by
+    ``users.password_policy.CommonPasswordValidator``.
+
+    Sources are plain text or gzipped files with one password per line,
+    such as a breached-password corpus. Django's list of common passwords
+    is always included unless ``--no-default``.
+
+    Usage:
+        python manage.py build_password_blocklist
+        python manage.py build_password_blocklist rockyou.txt.gz --output /srv/password-blocklist.bin
+    """
+    help = 'Compile common and breached password lists into a memory-mappable blocklist.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='*', help='Password list files (.txt or .gz).')
+        parser.add_argument('--output', default=settings.PASSWORD_BLOCKLIST, help='File to write.')
+        parser.add_argument(
+            '--no-default', action='store_true', help="Do not include Django's common password list.",
+        )
+
+    def handle(self, *args, **options):
+        sources = list(options['sources'])
+        if not options['no_default']:
+            sources.insert(0, default_password_list())
+
+        def passwords():
+            for source in sources:
+                yield from read_passwords(source)
+
+        count = write_blocklist(passwords(), options['output'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {count} password hashes ({count * 8 / 1024:.0f} KiB) to {options["output"]}'
+        ))
@@ -0,0 +1,30 @@
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    """
+    Show how keys and load are spread over the cache shards.
+
+    Only meaningful with ``REDIS_URLS`` set (``ShardedClient``). Operation
+    counts are those routed by this process since it started.
+
+    Usage:
+        python manage.py cache_shards
+    """
+    help = 'Show key counts, ring share and breaker state of each cache shard.'
+
+    def handle(self, *args, **options):
+        client = getattr(cache, 'client', None)
+        if not hasattr(client, 'shard_stats'):
+            raise CommandError('The default cache is not sharded; set REDIS_URLS to several servers.')
+        stats = client.shard_stats()
+        total = sum(shard['keys'] or 0 for shard in stats.values())
+        for name, shard in stats.items():
+            keys = 'unreachable' if shard['keys'] is None else f'{shard["keys"]} keys'
+            if shard['keys'] is not None and total:
+                keys += f' ({100 * shard["keys"] / total:.1f}%)'
+            self.stdout.write(
+                f'{name}: {keys}, ring share {100 * shard["ring_share"]:.1f}%, '
+                f'{shard["ops"]} ops, breaker {shard["state"] or "n/a"}'
+            )
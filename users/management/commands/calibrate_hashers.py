@@ -0,0 +1,61 @@
+from django.contrib.auth.hashers import get_hashers
+from django.core.management.base import BaseCommand
+
+from ...hashers import TUNABLE, recommend_cost
+
+# Environment variables read by PASSWORD_HASHER_PROFILE.
+PROFILE_ENV = {
+    'pbkdf2_sha256': 'PASSWORD_PBKDF2_ITERATIONS',
+    'scrypt': 'PASSWORD_SCRYPT_WORK_FACTOR',
+}
+
+
+class Command(BaseCommand):
+    """
+    Benchmark the configured password hashers on this machine.
+
+    For every hasher in ``PASSWORD_HASHERS`` whose library is installed,
+    reports the verify time at the current parameters and the cost
+    parameter that brings it closest to the target, measured again.
+
+    Usage:
+        python manage.py calibrate_hashers --target-ms 250
+    """
+    help = 'Recommend password hasher parameters for a target verify latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target-ms', type=float, default=250, help='Target time for one password verify.')
+        parser.add_argument('--runs', type=int, default=3, help='Verifies per measurement; the median is used.')
+
+    def handle(self, *args, **options):
+        target = options['target_ms'] / 1000
+        recommendations = []
+        for index, hasher in enumerate(get_hashers()):
+            label = f'{hasher.algorithm}{" (preferred)" if index == 0 else ""}'
+            if hasher.algorithm not in TUNABLE:
+                self.stdout.write(f'{label}: no tunable cost parameter, skipped')
+                continue
+            if hasher.library:
+                try:
+                    hasher._load_library()
+                except ValueError:
+                    library = hasher.library[0] if isinstance(hasher.library, tuple) else hasher.library
+                    self.stdout.write(f'{label}: {library} is not installed, skipped')
+                    continue
+
+            param = TUNABLE[hasher.algorithm][0]
+            current = getattr(hasher, param)
+            current_seconds, value, seconds = recommend_cost(hasher, target, options['runs'])
+            self.stdout.write(
+                f'{label}: {param}={current} takes {current_seconds * 1000:.1f} ms; '
+                f'{param}={value} takes {seconds * 1000:.1f} ms'
+            )
+            if value != current and hasher.algorithm in PROFILE_ENV:
+                recommendations.append(f'{PROFILE_ENV[hasher.algorithm]}={value}')
+
+        if recommendations:
+            self.stdout.write(self.style.SUCCESS(
+                f'Recommended settings for {options["target_ms"]:.0f} ms per verify:'
+            ))
+            for line in recommendations:
+                self.stdout.write(f'  {line}')
@@ -0,0 +1,63 @@
+import gzip
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...export import (
+    DEFAULT_CHUNK_SIZE, InvalidExportCursor, export_lines, export_queryset, parse_since, tombstone_queryset,
+)
+
+
+class Command(BaseCommand):
+    """
+    Export users as NDJSON, optionally gzip-compressed.
+
+    Same format as ``GET /api/users/export/``: one JSON object per user in
+    ``(updated_at, id)`` order, tombstones of re-numbered ids included, with
+    ``{"next_token": ..., "complete": ...}`` checkpoint lines. The final
+    token is also printed to stderr so a nightly job can store it and pass
+    it back with ``--token``.
+
+    Usage:
+        python manage.py export_users --output users.ndjson.gz
+        python manage.py export_users --token "$(cat last_token)" --output delta.ndjson.gz
+    """
+    help = 'Stream users as NDJSON to a file or stdout.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='-', help='File to write; "-" for stdout. Gzipped if it ends in .gz.')
+        parser.add_argument('--gzip', action='store_true', help='Gzip the output regardless of file name.')
+        parser.add_argument('--since', help='Only users updated at or after this ISO 8601 date or datetime.')
+        parser.add_argument('--token', help='Continuation token from a previous export.')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        token = options['token']
+        try:
+            since = parse_since(options['since']) if options['since'] else None
+            queryset = export_queryset(since=since, token=token)
+            tombstones = tombstone_queryset(since=since, token=token)
+        except InvalidExportCursor as exc:
+            raise CommandError(str(exc))
+
+        output = options['output']
+        compress = options['gzip'] or output.endswith('.gz')
+        if output == '-':
+            stream = gzip.open(sys.stdout.buffer, 'wt') if compress else self.stdout
+        else:
+            stream = gzip.open(output, 'wt') if compress else open(output, 'w')
+
+        records = 0
+        try:
+            for chunk in export_lines(queryset, chunk_size=options['chunk_size'], token=token, tombstones=tombstones):
+                stream.write(chunk)
+                # Every chunk ends with exactly one checkpoint line.
+                records += chunk.count('\n') - 1
+                checkpoint = chunk.rsplit('\n', 2)[-2]
+        finally:
+            if stream is not self.stdout:
+                stream.close()
+
+        next_token = json.loads(checkpoint)['next_token']
+        self.stderr.write(f'Exported {records} records. next_token: {next_token}')
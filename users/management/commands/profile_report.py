@@ -0,0 +1,107 @@
+import io
+import os
+import pstats
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...profiling import make_token, parse_profile_name
+
+
+class Command(BaseCommand):
+    """
+    Aggregate profiles recorded by ``ProfilingMiddleware`` per endpoint.
+
+    Collapsed stacks from all profiles of an endpoint are summed into one
+    ``<endpoint>.folded`` file, ready for ``flamegraph.pl`` or speedscope;
+    cProfile files are merged into ``<endpoint>.pstats``. A summary with the
+    hottest frames is printed.
+
+    Usage:
+        python manage.py profile_report --output profile-report
+        python manage.py profile_report --issue-token
+    """
+    help = 'Aggregate sampled request profiles into per-endpoint flamegraph input.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=settings.PROFILING['DIR'], help='Profile ring buffer directory.')
+        parser.add_argument('--output', help='Directory to write merged per-endpoint profiles to.')
+        parser.add_argument('--endpoint', help='Only include endpoints containing this string.')
+        parser.add_argument('--top', type=int, default=10, help='Hottest frames to list per endpoint.')
+        parser.add_argument(
+            '--issue-token', action='store_true',
+            help='Print a value for the X-Profile-Token header instead of a report.',
+        )
+
+    def handle(self, *args, **options):
+        if options['issue_token']:
+            self.stdout.write(make_token())
+            return
+
+        folded = defaultdict(Counter)
+        stats = {}
+        durations = defaultdict(list)
+        for name in sorted(os.listdir(options['dir'])) if os.path.isdir(options['dir']) else ():
+            try:
+                endpoint, duration_ms, extension = parse_profile_name(name)
+            except ValueError:
+                continue
+            if options['endpoint'] and options['endpoint'] not in endpoint:
+                continue
+            path = os.path.join(options['dir'], name)
+            try:
+                if extension == 'folded':
+                    with open(path) as f:
+                        for line in f:
+                            stack, _, count = line.rstrip('\n').rpartition(' ')
+                            folded[endpoint][stack] += int(count)
+                elif extension == 'pstats':
+                    if endpoint in stats:
+                        stats[endpoint].add(path)
+                    else:
+                        stats[endpoint] = pstats.Stats(path, stream=io.StringIO())
+                else:
+                    continue
+            except FileNotFoundError:
+                continue  # rotated out while reading
+            durations[endpoint].append(duration_ms)
+
+        if not durations:
+            raise CommandError(f'No profiles found in {options["dir"]}')
+        if options['output']:
+            os.makedirs(options['output'], exist_ok=True)
+
+        for endpoint in sorted(durations, key=lambda e: -sum(durations[e])):
+            times = durations[endpoint]
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f'{endpoint}: {len(times)} profiles, mean {sum(times) / len(times):.0f} ms, max {max(times)} ms'
+            ))
+            if endpoint in folded:
+                self.report_folded(endpoint, folded[endpoint], options)
+            if endpoint in stats:
+                self.report_pstats(endpoint, stats[endpoint], options)
+
+    def report_folded(self, endpoint, counts, options):
+        total = sum(counts.values())
+        self_counts = Counter()
+        for stack, count in counts.items():
+            self_counts[stack.rsplit(';', 1)[-1]] += count
+        self.stdout.write(f'  {total} samples; hottest frames (self):')
+        for frame, count in self_counts.most_common(options['top']):
+            self.stdout.write(f'  {100 * count / total:5.1f}%  {frame}')
+        if options['output']:
+            path = os.path.join(options['output'], f'{endpoint}.folded')
+            with open(path, 'w') as f:
+                f.writelines(f'{stack} {count}\n' for stack, count in counts.most_common())
+            self.stdout.write(f'  wrote {path}')
+
+    def report_pstats(self, endpoint, stats, options):
+        stream = io.StringIO()
+        stats.stream = stream
+        stats.sort_stats('cumulative').print_stats(options['top'])
+        self.stdout.write(stream.getvalue())
+        if options['output']:
+            path = os.path.join(options['output'], f'{endpoint}.pstats')
+            stats.dump_stats(path)
+            self.stdout.write(f'  wrote {path}')
@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...sharding import get_shard_map, rebalance
+
+
+class Command(BaseCommand):
+    """
+    Move users to the shard their email address maps to.
+
+    Run after adding a shard (with ``USER_SHARDS_PREVIOUS`` listing the old
+    shard aliases, so lookups find users not moved yet), and when first
+    enabling sharding (with ``USER_SHARDS_PREVIOUS=default``; users there
+    get ids encoding their shard bucket). Once it reports nothing left to
+    move, unset ``USER_SHARDS_PREVIOUS``. Safe to interrupt and re-run.
+
+    Usage:
+        python manage.py rebalance_user_shards --dry-run
+        python manage.py rebalance_user_shards --source default --batch-size 1000
+    """
+    help = 'Move users whose email maps to another shard.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source', action='append',
+            help='Database to move users off (repeatable; default: all shards and USER_SHARDS_PREVIOUS).',
+        )
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Only count the users that would move.')
+
+    def handle(self, *args, **options):
+        shard_map = get_shard_map()
+        if shard_map is None:
+            raise CommandError('Users are not sharded; set USER_SHARD_DATABASE_URLS.')
+        sources = options['source'] or list(dict.fromkeys(
+            [*settings.USER_SHARDING['PREVIOUS_SHARDS'], *shard_map.shards]
+        ))
+        unknown = set(sources) - set(settings.DATABASES)
+        if unknown:
+            raise CommandError(f'Unknown databases: {", ".join(sorted(unknown))}')
+
+        verb = 'would move' if options['dry_run'] else 'moved'
+        total = 0
+        for source in sources:
+            moved = rebalance(source, batch_size=options['batch_size'], dry_run=options['dry_run'])
+            conflicts = moved.pop('conflicts', 0)
+            for target, count in sorted(moved.items()):
+                self.stdout.write(f'{source} -> {target}: {verb} {count} users')
+                total += count
+            if conflicts:
+                self.stdout.write(self.style.WARNING(
+                    f'{source}: {conflicts} users left in place; their email already exists on the target shard'
+                ))
+        self.stdout.write(self.style.SUCCESS(f'{total} users {verb}'))
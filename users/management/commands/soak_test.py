@@ -0,0 +1,232 @@
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...soak import (
+    DEFAULT_MIX, TrafficGenerator, child_pids, detect_growth, list_snapshots, parse_mix, rss_kb, top_growth,
+)
+from .benchmark_startup import free_port
+
+
+class Command(BaseCommand):
+    """
+    Replay mixed traffic against a local gunicorn for a long time and flag
+    workers whose memory keeps growing.
+
+    The command starts gunicorn with worker recycling disabled
+    (``GUNICORN_MAX_REQUESTS=0``) and ``GUNICORN_TRACEMALLOC_DIR`` set, so
+    every worker dumps a ``tracemalloc`` snapshot each sample interval. It
+    runs register/login/forgot/reset flows from ``--concurrency`` threads
+    and samples each worker's RSS. After the run, a worker is flagged when
+    its RSS or traced heap grew steadily by more than the threshold after
+    warmup. For flagged workers the allocation sites that grew the most are
+    listed by traceback. The command fails if any worker was flagged.
+
+    With ``--url`` an already running server is used instead. RSS is then
+    sampled only if ``--pid`` names its master process, and heap snapshots
+    are read from ``--snapshot-dir`` if that server was started with
+    ``GUNICORN_TRACEMALLOC_DIR``.
+
+    Usage:
+        python manage.py soak_test --duration 14400 --workers 2 --concurrency 8
+        python manage.py soak_test --duration 600 --mix login=8,forgot=1,reset=1
+    """
+    help = 'Soak-test the service with mixed traffic and detect memory growth in workers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=float, default=3600, help='Seconds of traffic.')
+        parser.add_argument('--warmup', type=float, default=300, help='Seconds before the growth baseline.')
+        parser.add_argument('--sample-interval', type=float, default=60, help='Seconds between memory samples.')
+        parser.add_argument('--concurrency', type=int, default=4, help='Client threads.')
+        parser.add_argument('--workers', type=int, default=2, help='gunicorn workers to start.')
+        parser.add_argument(
+            '--mix', default=','.join(f'{name}={weight}' for name, weight in DEFAULT_MIX.items()),
+            help='Scenario weights, e.g. register=1,login=6,forgot=2,reset=1.',
+        )
+        parser.add_argument('--rss-threshold-mb', type=float, default=20, help='Flag RSS growth above this.')
+        parser.add_argument('--heap-threshold-mb', type=float, default=5, help='Flag traced heap growth above this.')
+        parser.add_argument('--frames', type=int, default=10, help='Traceback depth recorded by tracemalloc.')
+        parser.add_argument('--top', type=int, default=10, help='Growing allocation sites to list per worker.')
+        parser.add_argument('--snapshot-dir', help='Heap snapshot directory (default: a new temporary one).')
+        parser.add_argument('--url', help='Base URL of a running server, e.g. http://127.0.0.1:8080/api/users.')
+        parser.add_argument('--pid', type=int, help='Master pid of the server given by --url.')
+        parser.add_argument('--seed', type=int, help='Seed for reproducible traffic.')
+
+    def handle(self, *args, **options):
+        try:
+            mix = parse_mix(options['mix'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        snapshot_dir = options['snapshot_dir'] or tempfile.mkdtemp(prefix='soak-heap-')
+
+        server = None
+        if options['url']:
+            base_url, master_pid = options['url'], options['pid']
+        else:
+            server, base_url = self.start_server(options, snapshot_dir)
+            master_pid = server.pid
+        self.stdout.write(f'Soak test against {base_url} for {options["duration"]:.0f}s; snapshots in {snapshot_dir}')
+
+        try:
+            generator, rss = self.run_traffic(base_url, master_pid, mix, options)
+        finally:
+            if server is not None:
+                self.stop_server(server)
+
+        failures = self.report(generator, rss, snapshot_dir, options)
+        if failures:
+            raise CommandError('Memory growth detected: ' + '; '.join(failures))
+        self.stdout.write(self.style.SUCCESS('No steady memory growth detected.'))
+
+    def start_server(self, options, snapshot_dir, timeout=60):
+        port = free_port()
+        env = dict(
+            os.environ,
+            DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'auth_service.settings'),
+            GUNICORN_BIND=f'127.0.0.1:{port}',
+            GUNICORN_WORKERS=str(options['workers']),
+            GUNICORN_MAX_REQUESTS='0',
+            GUNICORN_TRACEMALLOC_DIR=snapshot_dir,
+            GUNICORN_TRACEMALLOC_INTERVAL=str(options['sample_interval']),
+            GUNICORN_TRACEMALLOC_FRAMES=str(options['frames']),
+        )
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'],
+            env=env, cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL,
+        )
+        started = time.monotonic()
+        while time.monotonic() - started < timeout:
+            if server.poll() is not None:
+                raise CommandError('gunicorn exited during startup')
+            try:
+                urllib.request.urlopen(f'http://127.0.0.1:{port}/api/users/login/', timeout=timeout)
+            except urllib.error.HTTPError:
+                pass  # any HTTP response means it is serving
+            except OSError:
+                time.sleep(0.1)
+                continue
+            return server, f'http://127.0.0.1:{port}/api/users'
+        self.stop_server(server)
+        raise CommandError(f'No response from gunicorn within {timeout}s')
+
+    def stop_server(self, server):
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+    def run_traffic(self, base_url, master_pid, mix, options):
+        """
+        Run the client threads for ``--duration`` seconds, sampling worker RSS.
+
+        Returns:
+            tuple: The ``TrafficGenerator`` and a dict of pid to a list of
+            ``(elapsed seconds, rss kB)`` samples
+        """
+        generator = TrafficGenerator(base_url, mix)
+        stop = threading.Event()
+        seed = options['seed']
+        threads = [
+            threading.Thread(
+                target=generator.run,
+                args=(stop, random.Random(f'{seed}-{i}') if seed is not None else None),
+                daemon=True,
+            )
+            for i in range(options['concurrency'])
+        ]
+        for thread in threads:
+            thread.start()
+
+        rss = {}
+        started = time.monotonic()
+        try:
+            while True:
+                elapsed = time.monotonic() - started
+                if master_pid:
+                    for pid in child_pids(master_pid):
+                        value = rss_kb(pid)
+                        if value is not None:
+                            rss.setdefault(pid, []).append((elapsed, value))
+                self.progress(elapsed, generator, rss)
+                if elapsed >= options['duration']:
+                    break
+                time.sleep(min(options['sample_interval'], options['duration'] - elapsed))
+        except KeyboardInterrupt:
+            self.stdout.write('Interrupted; reporting on the samples so far.')
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join(timeout=30)
+        return generator, rss
+
+    def progress(self, elapsed, generator, rss):
+        totals = generator.totals()
+        requests = sum(totals.values())
+        errors = sum(count for (_, status), count in totals.items() if status == 'error' or status >= 500)
+        workers = ' '.join(
+            f'{pid}={samples[-1][1] // 1024}MB' for pid, samples in sorted(rss.items()) if samples[-1][0] == elapsed
+        )
+        self.stdout.write(
+            f'[{elapsed:7.0f}s] requests={requests} errors={errors} '
+            f'rps={requests / elapsed if elapsed else 0:.1f} {workers}'.rstrip()
+        )
+
+    def report(self, generator, rss, snapshot_dir, options):
+        warmup = options['warmup']
+        failures = []
+
+        self.stdout.write(self.style.MIGRATE_HEADING('Responses:'))
+        for (scenario, status), count in sorted(generator.totals().items(), key=lambda item: str(item[0])):
+            self.stdout.write(f'  {scenario:<9} {status!s:>5}  {count}')
+
+        self.stdout.write(self.style.MIGRATE_HEADING('Worker RSS after warmup:'))
+        for pid, samples in sorted(rss.items()):
+            values = [value for elapsed, value in samples if elapsed >= warmup]
+            if not values:
+                continue
+            growth = detect_growth(values, options['rss_threshold_mb'] * 1024)
+            line = f'  worker {pid}: {values[0] / 1024:.1f} -> {values[-1] / 1024:.1f} MB over {len(values)} samples'
+            if growth is not None:
+                failures.append(f'worker {pid} RSS +{growth / 1024:.1f} MB')
+                self.stdout.write(self.style.ERROR(line + ' (steady growth)'))
+            else:
+                self.stdout.write(line)
+
+        snapshots = list_snapshots(snapshot_dir)
+        if snapshots:
+            self.stdout.write(self.style.MIGRATE_HEADING('Worker heap (tracemalloc) after warmup:'))
+        run_started = min(mtime for series in snapshots.values() for mtime, _, _ in series) if snapshots else 0
+        for pid, series in sorted(snapshots.items()):
+            # Workers write their first snapshot one interval after they
+            # start, i.e. roughly one interval into the run.
+            series = [entry for entry in series if entry[0] - run_started + options['sample_interval'] >= warmup]
+            if not series:
+                continue
+            growth = detect_growth([traced for _, traced, _ in series], options['heap_threshold_mb'] * 1024 * 1024)
+            line = (
+                f'  worker {pid}: {series[0][1] / 2 ** 20:.1f} -> {series[-1][1] / 2 ** 20:.1f} MB '
+                f'over {len(series)} snapshots'
+            )
+            if growth is None:
+                self.stdout.write(line)
+                continue
+            failures.append(f'worker {pid} heap +{growth / 2 ** 20:.1f} MB')
+            self.stdout.write(self.style.ERROR(line + ' (steady growth)'))
+            self.stdout.write(f'  Largest growth by traceback ({series[0][2]} -> {series[-1][2]}):')
+            for stat in top_growth(series[0][2], series[-1][2], options['top']):
+                self.stdout.write(f'    +{stat.size_diff / 1024:.1f} KiB in {stat.count_diff:+d} blocks')
+                for line in stat.traceback.format(most_recent_first=True)[:2 * options['frames']]:
+                    self.stdout.write(f'      {line}')
+        return failures
@@ -0,0 +1,45 @@
+from django.db import migrations
+
+# Indexes matching the SQL Django generates on PostgreSQL for the admin
+# search: `email__istartswith` -> UPPER(email::text) LIKE 'X%' and
+# `full_name__icontains` -> UPPER(full_name::text) LIKE '%X%'.
+POSTGRES_INDEXES = (
+    (
+        'users_user_email_upper_prefix',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS users_user_email_upper_prefix '
+        'ON users_user (UPPER(email::text) text_pattern_ops)',
+    ),
+    (
+        'users_user_full_name_upper_trgm',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS users_user_full_name_upper_trgm '
+        'ON users_user USING gin (UPPER(full_name::text) gin_trgm_ops)',
+    ),
+)
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for _, sql in POSTGRES_INDEXES:
+        schema_editor.execute(sql)
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _ in POSTGRES_INDEXES:
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('users', '0002_alter_user_managers'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta, timezone
+
+from django.db import migrations, models
+
+TABLE = 'users_authauditevent'
+
+# On PostgreSQL the table is range-partitioned by month on created_at. The
+# primary key must include the partition key; Django only sees `id`, which the
+# sequence keeps unique. Rows outside every monthly partition land in the
+# default partition, so inserts never fail.
+POSTGRES_TABLE = f'''
+CREATE TABLE {TABLE} (
+    id bigserial NOT NULL,
+    created_at timestamp with time zone NOT NULL,
+    event varchar(32) NOT NULL,
+    user_id bigint NULL,
+    email_digest varchar(16) NULL,
+    ip inet NULL,
+    request_id varchar(64) NULL,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+CREATE INDEX users_audit_user_time_idx ON {TABLE} (user_id, created_at, id);
+CREATE INDEX users_audit_time_idx ON {TABLE} (created_at, id);
+CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT;
+'''
+
+# Partitions created up front; `manage.py audit_partitions` adds later ones.
+INITIAL_MONTHS = 3
+
+
+def create_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        schema_editor.create_model(apps.get_model('users', 'AuthAuditEvent'))
+        return
+    schema_editor.execute(POSTGRES_TABLE)
+    start = datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    for _ in range(INITIAL_MONTHS):
+        end = (start + timedelta(days=32)).replace(day=1)
+        schema_editor.execute(
+            f'CREATE TABLE {TABLE}_p{start:%Y_%m} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)',
+            [start, end],
+        )
+        start = end
+
+
+def drop_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        schema_editor.delete_model(apps.get_model('users', 'AuthAuditEvent'))
+        return
+    schema_editor.execute(f'DROP TABLE {TABLE} CASCADE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_user_updated_at'),
+    ]
+
+    # The model state is declared on its own; the table is created below.
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='AuthAuditEvent',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('created_at', models.DateTimeField(help_text='When the event happened', verbose_name='created at')),
+                        ('event', models.CharField(choices=[('registered', 'Registered'), ('login_succeeded', 'Login succeeded'), ('login_failed', 'Login failed'), ('reset_requested', 'Password reset requested'), ('password_changed', 'Password changed')], max_length=32, verbose_name='event')),
+                        ('user_id', models.BigIntegerField(blank=True, help_text='User concerned, if known', null=True, verbose_name='user id')),
+                        ('email_digest', models.CharField(blank=True, help_text='Keyed digest of the submitted email address', max_length=16, null=True, verbose_name='email digest')),
+                        ('ip', models.GenericIPAddressField(blank=True, null=True, verbose_name='IP address')),
+                        ('request_id', models.CharField(blank=True, max_length=64, null=True, verbose_name='request id')),
+                    ],
+                    options={
+                        'verbose_name': 'auth audit event',
+                        'indexes': [
+                            models.Index(fields=['user_id', 'created_at', 'id'], name='users_audit_user_time_idx'),
+                            models.Index(fields=['created_at', 'id'], name='users_audit_time_idx'),
+                        ],
+                    },
+                ),
+            ],
+        ),
+        migrations.RunPython(create_table, drop_table),
+    ]
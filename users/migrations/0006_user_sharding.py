@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-19 02:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_authauditevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserIdBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+            ],
+            options={
+                'verbose_name': 'user id block',
+            },
+        ),
+        migrations.AlterModelOptions(
+            name='user',
+            options={'base_manager_name': 'objects', 'verbose_name': 'user', 'verbose_name_plural': 'users'},
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.5 on 2026-10-19 03:28
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_user_sharding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.BigIntegerField(help_text='Id the user had before', unique=True, verbose_name='user id')),
+                ('replaced_by', models.BigIntegerField(help_text='Id the user has now', verbose_name='replaced by')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, help_text='When the id was retired', verbose_name='updated at')),
+            ],
+            options={
+                'verbose_name': 'user tombstone',
+                'indexes': [models.Index(fields=['updated_at', 'user_id'], name='users_tombstone_updated_idx')],
+            },
+        ),
+    ]
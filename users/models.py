@@ -1,12 +1,21 @@
+from asgiref.sync import sync_to_async
 from django.db import models
+from django.contrib.auth.hashers import acheck_password, check_password
 from django.contrib.auth.models import AbstractUser, UserManager
+from django.core.exceptions import ValidationError
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-class CustomUserManager(UserManager):
+from . import sharding
+from .hashers import schedule_rehash
+
+class CustomUserManager(UserManager.from_queryset(sharding.ShardedUserQuerySet)):
     """
     Custom user manager for User model.
     
     Provides methods to create regular users and superusers with email and full_name fields.
+    Lookups of one user by id or email go to that user's shard when users are
+    sharded (see ``users.sharding``).
     """
     
     def _create_user(self, email, full_name, password, **extra_fields):
@@ -80,12 +89,166 @@ class User(AbstractUser):
     username = None  # Remove username field
     full_name = models.CharField(max_length=150, verbose_name=_('Full Name'), help_text=_('User\'s full name'))
     email = models.EmailField(_('email address'), unique=True, help_text=_('User\'s email address (unique identifier)'))
+    updated_at = models.DateTimeField(_('updated at'), auto_now=True, help_text=_('When the user was last modified'))
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['full_name']
 
     objects = CustomUserManager()
 
+    class Meta(AbstractUser.Meta):
+        # Also used for related lookups and by ``rehash_password``, which
+        # must be routed to the user's shard too.
+        base_manager_name = 'objects'
+        indexes = [
+            # Serves incremental exports, which page by (updated_at, id).
+            models.Index(fields=['updated_at', 'id'], name='users_user_updated_id_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        """
+        Save the user, bumping ``updated_at`` on partial saves as well.
+
+        ``auto_now`` only writes the column when it is part of the saved
+        fields, so it is added to ``update_fields`` (e.g. the ``last_login``
+        update on login) to keep incremental exports complete.
+
+        When users are sharded, a new user is inserted on the shard of its
+        email address with an id from ``users.sharding.new_user_id``.
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'updated_at' not in update_fields:
+            kwargs['update_fields'] = [*update_fields, 'updated_at']
+        if sharding.is_enabled() and self._state.adding and self.pk is None:
+            # New users go to the shard of their email with an id encoding
+            # its bucket, whatever database the caller (e.g. createsuperuser)
+            # named.
+            kwargs['using'], self.pk = sharding.new_user_id(self.email)
+            kwargs['force_insert'] = True
+        elif self.changes_shard():
+            raise ValueError('The email address of a sharded user cannot be changed.')
+        super().save(*args, **kwargs)
+
+    def check_password(self, raw_password):
+        """
+        Check a password, upgrading an outdated hash off the request path.
+
+        Django's default re-hashes and saves inline when the hasher or its
+        parameters changed, adding a second full hash and a write to the
+        login. Here the upgrade is handed to ``schedule_rehash`` instead.
+
+        Args:
+            raw_password: Password to check
+
+        Returns:
+            bool: True if the password matches
+        """
+        return check_password(raw_password, self.password, lambda raw: schedule_rehash(self, raw))
+
+    async def acheck_password(self, raw_password):
+        """
+        Async ``check_password``, with the same off-request hash upgrade.
+
+        Args:
+            raw_password: Password to check
+
+        Returns:
+            bool: True if the password matches
+        """
+        async def setter(raw):
+            await sync_to_async(schedule_rehash)(self, raw)
+
+        return await acheck_password(raw_password, self.password, setter)
+
+    def changes_shard(self):
+        """
+        Whether this saved user's email now hashes to another bucket than the
+        one encoded in its id, which would move it to another shard.
+        """
+        shard_map = sharding.get_shard_map()
+        return (
+            shard_map is not None and not self._state.adding and self._state.db in shard_map.shards
+            and not sharding.is_sharded_id(self.pk, self.email)
+        )
+
+    def clean(self):
+        super().clean()
+        if self.changes_shard():
+            raise ValidationError({'email': _('The email address cannot be changed while users are sharded.')})
+
     def __str__(self):
         """Return string representation of the user (email)."""
         return self.email
+
+
+class AuthAuditEvent(models.Model):
+    """
+    Append-only audit record of an authentication event.
+
+    Rows are written in batches by ``users.audit``. On PostgreSQL the table
+    is range-partitioned by month on ``created_at`` (see migration 0005),
+    and old months are removed by dropping their partitions.
+    """
+
+    class Event(models.TextChoices):
+        REGISTERED = 'registered', _('Registered')
+        LOGIN_SUCCEEDED = 'login_succeeded', _('Login succeeded')
+        LOGIN_FAILED = 'login_failed', _('Login failed')
+        RESET_REQUESTED = 'reset_requested', _('Password reset requested')
+        PASSWORD_CHANGED = 'password_changed', _('Password changed')
+
+    created_at = models.DateTimeField(_('created at'), help_text=_('When the event happened'))
+    event = models.CharField(_('event'), max_length=32, choices=Event.choices)
+    user_id = models.BigIntegerField(_('user id'), null=True, blank=True, help_text=_('User concerned, if known'))
+    email_digest = models.CharField(
+        _('email digest'), max_length=16, null=True, blank=True,
+        help_text=_('Keyed digest of the submitted email address'),
+    )
+    ip = models.GenericIPAddressField(_('IP address'), null=True, blank=True)
+    request_id = models.CharField(_('request id'), max_length=64, null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('auth audit event')
+        indexes = [
+            # Serve paginated queries by user or by time range.
+            models.Index(fields=['user_id', 'created_at', 'id'], name='users_audit_user_time_idx'),
+            models.Index(fields=['created_at', 'id'], name='users_audit_time_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.event} at {self.created_at:%Y-%m-%d %H:%M:%S}'
+
+
+class UserIdBlock(models.Model):
+    """
+    A block of user id sequence numbers reserved by one process.
+
+    Only used when users are sharded: each shard's rows number the blocks
+    handed out from it (see ``users.sharding.IdAllocator``).
+    """
+
+    class Meta:
+        verbose_name = _('user id block')
+
+
+class UserTombstone(models.Model):
+    """
+    Id a user no longer has because it was re-numbered when users were
+    sharded.
+
+    Written on ``default`` by ``users.sharding.move_users`` so the user
+    export can tell consumers the old id is gone (see ``users.export``).
+    """
+    user_id = models.BigIntegerField(_('user id'), unique=True, help_text=_('Id the user had before'))
+    replaced_by = models.BigIntegerField(_('replaced by'), help_text=_('Id the user has now'))
+    updated_at = models.DateTimeField(_('updated at'), default=timezone.now, help_text=_('When the id was retired'))
+
+    class Meta:
+        verbose_name = _('user tombstone')
+        indexes = [
+            # Serves incremental exports, like the user index.
+            models.Index(fields=['updated_at', 'user_id'], name='users_tombstone_updated_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} -> {self.replaced_by}'
@@ -0,0 +1,205 @@
+import array
+import bisect
+import gzip
+import hashlib
+import logging
+import mmap
+import os
+import re
+import sys
+import threading
+from difflib import SequenceMatcher
+
+from django.conf import settings
+from django.contrib.auth import password_validation
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured, ValidationError
+from django.utils.translation import gettext as _
+
+logger = logging.getLogger(__name__)
+
+# File header: magic, format version and the byte order of the hashes.
+MAGIC = b'PWBL\x01' + sys.byteorder[0].encode() + b'\0\0'
+
+
+def password_hash(password):
+    """64-bit hash of a normalized (stripped, lowercased) password."""
+    digest = hashlib.blake2b(password.strip().lower().encode(), digest_size=8).digest()
+    return int.from_bytes(digest, sys.byteorder)
+
+
+def read_passwords(path):
+    """Yield the passwords of a text list, one per line, gzipped or not."""
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def compile_hashes(passwords):
+    """Sorted, deduplicated array of ``password_hash`` values."""
+    return array.array('Q', sorted({password_hash(password) for password in passwords}))
+
+
+def write_blocklist(passwords, path):
+    """
+    Compile ``passwords`` into a blocklist file at ``path``.
+
+    The file is written next to its destination and renamed into place,
+    so running workers keep their mapping of the old file.
+
+    Returns:
+        int: Number of distinct hashes written
+    """
+    hashes = compile_hashes(passwords)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        hashes.tofile(f)
+    os.replace(tmp, path)
+    return len(hashes)
+
+
+class Blocklist:
+    """
+    Set of password hashes backed by a sorted array of 64-bit integers.
+
+    Lookups are a binary search over the array, so a list of millions of
+    passwords costs a few microseconds to query and nothing to load. When
+    built from a file the array is memory-mapped: its pages live once in the
+    OS page cache and are shared by every worker process, instead of each
+    worker holding its own Python set.
+    """
+
+    def __init__(self, hashes):
+        self._hashes = hashes
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:len(MAGIC)] != MAGIC or (len(mapped) - len(MAGIC)) % 8:
+            mapped.close()
+            raise ImproperlyConfigured(
+                f'{path} is not a password blocklist for this platform; rebuild it with '
+                f'manage.py build_password_blocklist'
+            )
+        return cls(memoryview(mapped)[len(MAGIC):].cast('Q'))
+
+    @classmethod
+    def from_passwords(cls, passwords):
+        return cls(compile_hashes(passwords))
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, password):
+        value = password_hash(password)
+        index = bisect.bisect_left(self._hashes, value)
+        return index < len(self._hashes) and self._hashes[index] == value
+
+
+_blocklists = {}
+_blocklists_lock = threading.Lock()
+
+
+def get_blocklist(path):
+    """
+    Return the process-wide ``Blocklist`` for ``path``.
+
+    A missing file falls back to Django's bundled list of 20,000 common
+    passwords, compiled in memory, so development and tests need no build
+    step.
+    """
+    path = str(path)
+    with _blocklists_lock:
+        blocklist = _blocklists.get(path)
+        if blocklist is None:
+            if os.path.exists(path):
+                blocklist = Blocklist.open(path)
+            else:
+                logger.warning('Password blocklist %s not found; using Django\'s common password list', path)
+                blocklist = Blocklist.from_passwords(read_passwords(default_password_list()))
+            _blocklists[path] = blocklist
+        return blocklist
+
+
+def default_password_list():
+    return password_validation.CommonPasswordValidator().DEFAULT_PASSWORD_LIST_PATH
+
+
+class CommonPasswordValidator:
+    """
+    Reject passwords found in the compiled blocklist at ``PASSWORD_BLOCKLIST``.
+
+    Replaces Django's ``CommonPasswordValidator``, which decompresses its
+    list into a set in every process. Build the file with
+    ``manage.py build_password_blocklist``.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    @property
+    def blocklist(self):
+        return get_blocklist(self.path or settings.PASSWORD_BLOCKLIST)
+
+    def validate(self, password, user=None):
+        if password in self.blocklist:
+            raise ValidationError(_('This password is too common.'), code='password_too_common')
+
+    def get_help_text(self):
+        return _('Your password can’t be a commonly used password.')
+
+
+class UserAttributeSimilarityValidator:
+    """
+    Reject passwords too similar to the user's email or name.
+
+    Like Django's validator, each attribute and its parts (split on
+    non-word characters) are compared with ``SequenceMatcher.quick_ratio``.
+    The cost is bounded regardless of input: at most ``max_length``
+    characters of the password and of each part, and at most ``max_parts``
+    parts per attribute, are compared. The defaults match this project's
+    user model, which has no username or first/last name.
+    """
+
+    DEFAULT_USER_ATTRIBUTES = ('email', 'full_name')
+
+    def __init__(self, user_attributes=DEFAULT_USER_ATTRIBUTES, max_similarity=0.7, max_length=64, max_parts=8):
+        if max_similarity < 0.1:
+            raise ValueError('max_similarity must be at least 0.1')
+        self.user_attributes = user_attributes
+        self.max_similarity = max_similarity
+        self.max_length = max_length
+        self.max_parts = max_parts
+
+    def validate(self, password, user=None):
+        if not user:
+            return
+        password = password.lower()[:self.max_length]
+        matcher = SequenceMatcher(b=password, autojunk=False)
+        for attribute_name in self.user_attributes:
+            value = getattr(user, attribute_name, None)
+            if not value or not isinstance(value, str):
+                continue
+            value = value.lower()[:self.max_length]
+            parts = [part for part in re.split(r'\W+', value) if part][:self.max_parts] + [value]
+            for part in parts:
+                if password_validation.exceeds_maximum_length_ratio(password, self.max_similarity, part):
+                    continue
+                matcher.set_seq1(part)
+                if matcher.real_quick_ratio() >= self.max_similarity and matcher.quick_ratio() >= self.max_similarity:
+                    try:
+                        verbose_name = str(user._meta.get_field(attribute_name).verbose_name)
+                    except FieldDoesNotExist:
+                        verbose_name = attribute_name
+                    raise ValidationError(
+                        _('The password is too similar to the %(verbose_name)s.'),
+                        code='password_too_similar',
+                        params={'verbose_name': verbose_name},
+                    )
+
+    def get_help_text(self):
+        return _('Your password can’t be too similar to your other personal information.')
@@ -0,0 +1,308 @@
+import cProfile
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+
+HEADER = 'X-Profile-Token'
+TOKEN_SALT = 'users.profiling'
+
+
+def make_token():
+    """
+    Issue a value for the ``X-Profile-Token`` header, valid for
+    ``PROFILING['TOKEN_MAX_AGE']`` seconds.
+    """
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign('profile')
+
+
+def token_is_valid(token):
+    try:
+        signing.TimestampSigner(salt=TOKEN_SALT).unsign(token, max_age=settings.PROFILING['TOKEN_MAX_AGE'])
+    except signing.BadSignature:
+        return False
+    return True
+
+
+class StackSampler:
+    """
+    Sampling profiler for selected threads.
+
+    One daemon thread per process wakes every ``interval`` seconds while any
+    thread is registered, reads its current frame from
+    ``sys._current_frames()`` and counts the collapsed stack. The profiled
+    thread itself runs untouched, unlike with ``cProfile``, which hooks every
+    call.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.reset_after_fork()
+
+    def reset_after_fork(self):
+        self._targets = {}
+        self._names = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self, ident):
+        with self._lock:
+            self._targets[ident] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+            self._wakeup.set()
+
+    def stop(self, ident):
+        """
+        Stop sampling a thread.
+
+        Returns:
+            Counter: Sample counts by collapsed stack (``outer;...;inner``)
+        """
+        with self._lock:
+            counts = self._targets.pop(ident, Counter())
+            if not self._targets:
+                self._wakeup.clear()
+        return counts
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, counts in self._targets.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        counts[self._collapse(frame)] += 1
+            del frames
+
+    def _collapse(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            name = self._names.get(code)
+            if name is None:
+                module = frame.f_globals.get('__name__', '?')
+                name = self._names[code] = f'{module}:{getattr(code, "co_qualname", code.co_name)}'
+            names.append(name)
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+# Held while a request is profiled with cProfile. On Python 3.12+ cProfile
+# hooks the whole interpreter (sys.monitoring), so a second profile cannot be
+# enabled while one runs, and each would also record the other threads.
+_cprofile_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _sampler_lock, _cprofile_lock
+    _sampler_lock = threading.Lock()
+    _cprofile_lock = threading.Lock()
+    if _sampler is not None:
+        _sampler.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_sampler(interval):
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = StackSampler(interval)
+        return _sampler
+
+
+class ProfileStore:
+    """
+    Ring buffer of profile files in one directory.
+
+    Files are named ``<time_ns>_<pid>_<endpoint>_<ms>.<ext>``; once more than
+    ``max_files`` exist the oldest are deleted.
+    """
+
+    def __init__(self, directory, max_files):
+        self.directory = directory
+        self.max_files = max_files
+
+    def path(self, endpoint, duration_ms, extension):
+        os.makedirs(self.directory, exist_ok=True)
+        endpoint = re.sub(r'[^A-Za-z0-9.-]+', '-', endpoint).strip('-') or 'unknown'
+        name = f'{time.time_ns()}_{os.getpid()}_{endpoint}_{duration_ms:.0f}.{extension}'
+        return os.path.join(self.directory, name)
+
+    def trim(self):
+        files = sorted(self.files())
+        for name in files[:max(0, len(files) - self.max_files)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass  # removed by another worker
+
+    def files(self):
+        try:
+            return [name for name in os.listdir(self.directory) if name.endswith(('.folded', '.pstats'))]
+        except FileNotFoundError:
+            return []
+
+    def write_folded(self, endpoint, duration_ms, counts):
+        path = self.path(endpoint, duration_ms, 'folded')
+        with open(path, 'w') as f:
+            f.writelines(f'{stack} {count}\n' for stack, count in counts.items())
+        self.trim()
+        return path
+
+    def write_pstats(self, endpoint, duration_ms, profile):
+        path = self.path(endpoint, duration_ms, 'pstats')
+        profile.dump_stats(path)
+        self.trim()
+        return path
+
+
+def parse_profile_name(name):
+    """
+    Split a profile file name into ``(endpoint, duration_ms, extension)``.
+    """
+    stem, extension = name.rsplit('.', 1)
+    _, _, rest = stem.split('_', 2)
+    endpoint, duration_ms = rest.rsplit('_', 1)
+    return endpoint, int(duration_ms), extension
+
+
+def start_cprofile():
+    """
+    An enabled ``cProfile.Profile`` holding ``_cprofile_lock``, or None while
+    another request of this process, or another profiling tool (a debugger,
+    coverage), is profiling.
+    """
+    if not _cprofile_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        _cprofile_lock.release()
+        return None
+    return profiler
+
+
+class ProfilingMiddleware:
+    """
+    Profile a sample of requests, configured by ``PROFILING``.
+
+    Requests under ``PATH_PREFIXES`` are profiled with probability
+    ``SAMPLE_RATE``, and always when they carry a valid ``X-Profile-Token``
+    header (see ``manage.py profile_report --issue-token``). Profiles are
+    written to a ``ProfileStore``; the response of a profiled request names
+    its file in ``X-Profile-Id``.
+
+    ``MODE`` ``'sample'`` uses ``StackSampler`` and writes collapsed stacks;
+    ``'cprofile'`` (also used where ``sys._current_frames`` is missing) writes
+    pstats files; it profiles one request per process at a time, and requests
+    overlapping it are served unprofiled.
+
+    Works with both WSGI and ASGI handlers. Under ASGI the event loop's
+    thread is profiled, so a profile also holds the other requests the loop
+    runs meanwhile, but not sync views, which run in worker threads.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        config = settings.PROFILING
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = config['SAMPLE_RATE']
+        self.prefixes = tuple(config['PATH_PREFIXES'])
+        self.store = ProfileStore(config['DIR'], config['MAX_FILES'])
+        self.sampling = config['MODE'] == 'sample' and hasattr(sys, '_current_frames')
+        self.interval = config['INTERVAL']
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def should_profile(self, request):
+        if not request.path_info.startswith(self.prefixes):
+            return False
+        token = request.headers.get(HEADER)
+        if token is not None:
+            return token_is_valid(token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.should_profile(request):
+            return self.get_response(request)
+        with self.profile(request) as profile:
+            response = self.get_response(request)
+        return self.name_profile(response, profile)
+
+    async def __acall__(self, request):
+        if not self.should_profile(request):
+            return await self.get_response(request)
+        with self.profile(request) as profile:
+            response = await self.get_response(request)
+        return self.name_profile(response, profile)
+
+    @contextmanager
+    def profile(self, request):
+        """
+        Profile the calling thread while the block runs and write the profile.
+
+        Yields:
+            dict: Gets the profile's file as ``'path'`` once written; stays
+            empty when the request could not be profiled
+        """
+        profile = {}
+        started = time.perf_counter()
+        if self.sampling:
+            sampler = get_sampler(self.interval)
+            ident = threading.get_ident()
+            sampler.start(ident)
+            try:
+                yield profile
+            finally:
+                counts = sampler.stop(ident)
+            duration_ms = (time.perf_counter() - started) * 1000
+            profile['path'] = self.store.write_folded(self.endpoint(request), duration_ms, counts)
+            return
+
+        profiler = start_cprofile()
+        if profiler is None:
+            yield profile
+            return
+        try:
+            yield profile
+        finally:
+            profiler.disable()
+            _cprofile_lock.release()
+        duration_ms = (time.perf_counter() - started) * 1000
+        profile['path'] = self.store.write_pstats(self.endpoint(request), duration_ms, profiler)
+
+    def name_profile(self, response, profile):
+        if 'path' in profile:
+            response['X-Profile-Id'] = os.path.basename(profile['path'])
+        return response
+
+    def endpoint(self, request):
+        match = request.resolver_match
+        name = match.view_name if match is not None else request.path_info
+        return f'{request.method}-{name}'
@@ -0,0 +1,85 @@
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from django.views.decorators.csrf import csrf_exempt
+
+_deferred = []
+_lock = threading.Lock()
+
+
+def extend_schema(**kwargs):
+    """
+    Deferred version of ``drf_spectacular.utils.extend_schema``.
+
+    Applying the real decorator resolves the view's schema class, which
+    imports drf-spectacular's OpenAPI machinery. In ``STARTUP_OPTIMIZED`` mode
+    the arguments are only recorded and ``apply_deferred_schemas()`` applies
+    them on the first request to a docs URL; otherwise they are applied
+    immediately.
+
+    ``parameters`` entries may be given as argument tuples for
+    ``OpenApiParameter``, which also lives in ``drf_spectacular.utils``.
+
+    Args:
+        **kwargs: Arguments for ``drf_spectacular.utils.extend_schema``
+
+    Returns:
+        callable: Class decorator returning the view unchanged
+    """
+    def decorator(view):
+        if not settings.STARTUP_OPTIMIZED:
+            return _apply(view, kwargs)
+        with _lock:
+            _deferred.append((view, kwargs))
+        return view
+    return decorator
+
+
+def _apply(view, kwargs):
+    from drf_spectacular.utils import OpenApiParameter, extend_schema as spectacular_extend_schema
+
+    if 'parameters' in kwargs:
+        kwargs = dict(kwargs, parameters=[
+            OpenApiParameter(*param) if isinstance(param, tuple) else param for param in kwargs['parameters']
+        ])
+    return spectacular_extend_schema(**kwargs)(view)
+
+
+def apply_deferred_schemas():
+    """
+    Apply all recorded ``extend_schema`` annotations. Safe to call repeatedly.
+    """
+    if not _deferred:
+        return
+    with _lock:
+        while _deferred:
+            view, kwargs = _deferred.pop(0)
+            _apply(view, kwargs)
+
+
+def lazy_view(view_path, **initkwargs):
+    """
+    URLconf view that imports and builds a class-based view on first use.
+
+    Deferred schema annotations are applied before the view is built, so
+    docs views can be routed without importing drf-spectacular at startup.
+
+    Args:
+        view_path: Dotted path to an ``APIView`` subclass
+        **initkwargs: Arguments for ``as_view()``
+
+    Returns:
+        callable: A view function
+    """
+    resolved = []
+
+    @csrf_exempt
+    def view(request, *args, **kwargs):
+        if not resolved:
+            apply_deferred_schemas()
+            resolved.append(import_string(view_path).as_view(**initkwargs))
+        return resolved[0](request, *args, **kwargs)
+
+    view.__name__ = view_path.rsplit('.', 1)[-1]
+    return view
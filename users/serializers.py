@@ -1,5 +1,22 @@
+from django.contrib.auth.models import update_last_login
+from django.contrib.auth.password_validation import validate_password
+from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers
-from .models import User
+from rest_framework_simplejwt import serializers as jwt_serializers
+from rest_framework_simplejwt.settings import api_settings
+from .models import AuthAuditEvent, User
+from .tokens import RefreshToken, issue_pair
+
+
+def check_password_policy(password, user, field):
+    """
+    Run ``AUTH_PASSWORD_VALIDATORS`` and report failures against ``field``.
+    """
+    try:
+        validate_password(password, user)
+    except DjangoValidationError as e:
+        raise serializers.ValidationError({field: list(e.messages)})
 
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
@@ -19,6 +36,15 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
             'email': {'help_text': 'User\'s email address (must be unique)'},
         }
 
+    def validate(self, attrs):
+        """
+        Check the password against the password policy, including its
+        similarity to the new user's email and name.
+        """
+        user = User(email=attrs.get('email'), full_name=attrs.get('full_name'))
+        check_password_policy(attrs['password'], user, 'password')
+        return attrs
+
     def create(self, validated_data):
         """
         Create a new user instance.
@@ -52,10 +78,22 @@ class ResetPasswordSerializer(serializers.Serializer):
     Serializer for password reset confirmation.
     
     Validates reset token and new password for password reset.
+    The token's user, if any, is returned as ``user`` (None for an invalid
+    or expired token).
     """
     token = serializers.CharField(help_text="Password reset token received via email")
     new_password = serializers.CharField(help_text="New password for the user account")
 
+    def validate(self, attrs):
+        """
+        Resolve the token's user and check the new password against the
+        password policy for that user.
+        """
+        user_id = cache.get(f'pwd-reset-{attrs["token"]}')
+        attrs['user'] = User.objects.filter(pk=user_id).first() if user_id else None
+        check_password_policy(attrs['new_password'], attrs['user'], 'new_password')
+        return attrs
+
 
 class UserLoginSerializer(serializers.Serializer):
     """
@@ -65,3 +103,33 @@ class UserLoginSerializer(serializers.Serializer):
     """
     email = serializers.EmailField(help_text="User's email address")
     password = serializers.CharField(help_text="User's password", write_only=True)
+
+
+class TokenObtainPairSerializer(jwt_serializers.TokenObtainPairSerializer):
+    """
+    Serializer for the login view.
+
+    The token pair comes from ``users.tokens.issue_pair``, which uses the
+    prepared ``TokenIssuer`` where the JWT settings allow and
+    ``users.tokens.RefreshToken`` otherwise.
+    """
+    token_class = RefreshToken
+
+    def validate(self, attrs):
+        # Authenticate only; simplejwt's pair building is replaced below.
+        data = super(jwt_serializers.TokenObtainPairSerializer, self).validate(attrs)
+        data['refresh'], data['access'] = issue_pair(self.user)
+        if api_settings.UPDATE_LAST_LOGIN:
+            update_last_login(None, self.user)
+        return data
+
+
+class AuthAuditEventSerializer(serializers.ModelSerializer):
+    """
+    Serializer for audit trail entries.
+    """
+
+    class Meta:
+        model = AuthAuditEvent
+        fields = ['id', 'created_at', 'event', 'user_id', 'email_digest', 'ip', 'request_id']
+        read_only_fields = fields
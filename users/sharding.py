@@ -0,0 +1,473 @@
+import hashlib
+import heapq
+import os
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+
+from .cache import HashRing
+
+# User ids are ``sequence << 16 | shard number << 10 | bucket``. The bucket
+# (a hash of the email address) fixes where a user lives, the shard number
+# and sequence make the id unique across shards.
+BUCKET_BITS = 10
+SHARD_BITS = 6
+BUCKETS = 1 << BUCKET_BITS
+MAX_SHARDS = 1 << SHARD_BITS
+
+# Filters that select a single user and can be routed to its shard.
+ID_LOOKUPS = frozenset({'pk', 'pk__exact', 'id', 'id__exact'})
+EMAIL_LOOKUPS = frozenset({'email', 'email__exact', 'email__iexact'})
+
+
+def email_bucket(email):
+    """Bucket of an email address; case and surrounding spaces are ignored."""
+    digest = hashlib.blake2b(email.strip().lower().encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % BUCKETS
+
+
+def make_user_id(sequence, shard_number, bucket):
+    return (sequence << (SHARD_BITS + BUCKET_BITS)) | (shard_number << BUCKET_BITS) | bucket
+
+
+def id_bucket(pk):
+    return int(pk) & (BUCKETS - 1)
+
+
+def is_sharded_id(pk, email):
+    """Whether ``pk`` encodes the bucket of ``email``, i.e. follows the sharded id scheme."""
+    return pk is not None and id_bucket(pk) == email_bucket(email)
+
+
+class ShardMap:
+    """
+    Assignment of the ``BUCKETS`` email-hash buckets to shard databases.
+
+    Buckets are placed on a consistent hash ring of the shard aliases, so
+    adding a shard moves about 1/N of the buckets. While users are being
+    moved (``rebalance_user_shards``), ``previous`` lists the aliases of the
+    layout before the change; lookups that miss on a bucket's new shard are
+    retried on its previous one.
+    """
+
+    def __init__(self, shards, previous=(), vnodes=160):
+        if len(shards) > MAX_SHARDS:
+            raise ValueError(f'At most {MAX_SHARDS} user shards are supported')
+        self.shards = list(shards)
+        self.numbers = {alias: number for number, alias in enumerate(self.shards)}
+        self.owners = self._assign(self.shards, vnodes)
+        previous_owners = self._assign(previous, vnodes) if previous else None
+        self.previous_owners = [
+            old if previous_owners and old != new else None
+            for new, old in zip(self.owners, previous_owners or [None] * BUCKETS)
+        ]
+
+    @staticmethod
+    def _assign(aliases, vnodes):
+        ring = HashRing(aliases, vnodes)
+        return [ring.node_for(f'bucket-{bucket}') for bucket in range(BUCKETS)]
+
+    def db_for_email(self, email):
+        return self.owners[email_bucket(email)]
+
+    def db_for_id(self, pk):
+        return self.owners[id_bucket(pk)]
+
+    def route(self, lookups):
+        """
+        Databases for a filter selecting one user by id or email.
+
+        Returns:
+            tuple: ``(alias, fallback alias or None)``, or None if the
+            filter cannot be routed
+        """
+        for key, value in lookups.items():
+            if key in ID_LOOKUPS and value is not None:
+                try:
+                    bucket = id_bucket(value)
+                except (TypeError, ValueError):
+                    return None
+            elif key in EMAIL_LOOKUPS and isinstance(value, str):
+                bucket = email_bucket(value)
+            else:
+                continue
+            return self.owners[bucket], self.previous_owners[bucket]
+        return None
+
+
+_shard_maps = {}
+
+
+def get_shard_map():
+    """
+    The ``ShardMap`` configured by ``USER_SHARDING``, or None when users
+    are not sharded.
+    """
+    config = settings.USER_SHARDING
+    if not config['SHARDS']:
+        return None
+    key = (tuple(config['SHARDS']), tuple(config['PREVIOUS_SHARDS']), config['VIRTUAL_NODES'])
+    shard_map = _shard_maps.get(key)
+    if shard_map is None:
+        shard_map = _shard_maps[key] = ShardMap(*key)
+    return shard_map
+
+
+def is_enabled():
+    return bool(settings.USER_SHARDING['SHARDS'])
+
+
+def needs_fan_out(queryset):
+    """Whether ``queryset`` spans all shards rather than one database."""
+    return is_enabled() and queryset._db in (None, DEFAULT_DB_ALIAS)
+
+
+class IdAllocator:
+    """
+    Hands out user ids from blocks of sequence numbers.
+
+    Each block is reserved by inserting a ``UserIdBlock`` row on the shard,
+    so a process touches the database once per ``block_size`` new users, and
+    ids stay unique without coordination between shards or processes.
+    """
+
+    def __init__(self):
+        self.reset_after_fork()
+
+    def reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def next_id(self, alias, shard_number, bucket):
+        from .models import UserIdBlock
+
+        block_size = settings.USER_SHARDING['ID_BLOCK_SIZE']
+        with self._lock:
+            block = self._blocks.get(alias)
+            if block is None or block[0] >= block[1]:
+                start = UserIdBlock.objects.using(alias).create().pk * block_size
+                block = self._blocks[alias] = [start, start + block_size]
+            sequence = block[0]
+            block[0] += 1
+        return make_user_id(sequence, shard_number, bucket)
+
+
+id_allocator = IdAllocator()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=id_allocator.reset_after_fork)
+
+
+def new_user_id(email, alias=None):
+    """
+    Allocate an id for a new user with ``email`` on its shard (or ``alias``).
+
+    Returns:
+        tuple: ``(alias, id)``
+    """
+    shard_map = get_shard_map()
+    alias = alias or shard_map.db_for_email(email)
+    return alias, id_allocator.next_id(alias, shard_map.numbers[alias], email_bucket(email))
+
+
+class ShardedUserQuerySet(models.QuerySet):
+    """
+    QuerySet that, when users are sharded, sends filters selecting one user
+    by ``pk``/``id`` or ``email`` to that user's shard.
+
+    Only querysets not bound to a database (or bound to ``default``, which
+    holds no users once sharding is set up) are routed. While a rebalance is
+    under way, a routed query that finds nothing is retried on the bucket's
+    previous shard, which may be ``default`` itself. Querysets spanning all users stay on ``default``; use
+    ``fan_out()`` or ``iterate()`` for those.
+    """
+
+    _fallback_db = None
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._fallback_db = self._fallback_db
+        return clone
+
+    def _filter_or_exclude(self, negate, args, kwargs):
+        clone = super()._filter_or_exclude(negate, args, kwargs)
+        if not negate and clone._db in (None, DEFAULT_DB_ALIAS):
+            shard_map = get_shard_map()
+            route = shard_map.route(kwargs) if shard_map is not None else None
+            if route is not None:
+                clone._db, clone._fallback_db = route
+        return clone
+
+    def _fallback(self):
+        clone = self.using(self._fallback_db)
+        clone._fallback_db = None
+        return clone
+
+    def _fetch_all(self):
+        super()._fetch_all()
+        if not self._result_cache and self._fallback_db:
+            self._result_cache = list(self._fallback())
+
+    def exists(self):
+        return super().exists() or bool(self._fallback_db and self._fallback().exists())
+
+    def update(self, **kwargs):
+        updated = super().update(**kwargs)
+        if not updated and self._fallback_db:
+            updated = self._fallback().update(**kwargs)
+        return updated
+
+    update.alters_data = True
+
+    def _update(self, values):
+        # Used by Model.save(), e.g. for a user not yet moved off ``default``.
+        updated = super()._update(values)
+        if not updated and self._fallback_db:
+            updated = self._fallback()._update(values)
+        return updated
+
+    _update.alters_data = True
+
+
+class UserShardRouter:
+    """
+    Database router placing new users on the shard of their email address.
+
+    Saved users, and objects created through relations to them (such as
+    outstanding tokens), stay on the database they were loaded from, which
+    Django handles without a router. Every shard carries the full schema;
+    migrate each with ``manage.py migrate --database <alias>``.
+    """
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if model._meta.label == settings.AUTH_USER_MODEL and instance is not None and instance._state.db is None:
+            shard_map = get_shard_map()
+            if shard_map is not None and instance.email:
+                return shard_map.db_for_email(instance.email)
+        return None
+
+
+def fan_out(function, aliases=None):
+    """
+    Call ``function(alias)`` for every shard, in parallel threads.
+
+    Each thread uses its own database connections, which are closed when
+    its call returns.
+
+    Returns:
+        dict: Alias to the function's result
+    """
+    aliases = list(aliases or get_shard_map().shards)
+
+    def call(alias):
+        try:
+            return function(alias)
+        finally:
+            connections.close_all()
+
+    workers = min(len(aliases), settings.USER_SHARDING['FAN_OUT_WORKERS'])
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='user-shards') as pool:
+        return dict(zip(aliases, pool.map(call, aliases)))
+
+
+def iterate(queryset, chunk_size, key):
+    """
+    Iterate over a queryset that may span all shards.
+
+    Each shard is read through its own server-side cursor and the ordered
+    streams are merged on ``key``, which must match the queryset's ordering.
+    """
+    if not needs_fan_out(queryset):
+        return queryset.iterator(chunk_size=chunk_size)
+    return heapq.merge(
+        *(queryset.using(alias).iterator(chunk_size=chunk_size) for alias in get_shard_map().shards),
+        key=key,
+    )
+
+
+def rebalance(source, batch_size=500, dry_run=False):
+    """
+    Move the users stored on ``source`` that belong on another shard.
+
+    Users are read in primary-key batches. Those whose email maps to another
+    shard, or whose id predates sharding, are handed to ``move_users``.
+
+    Returns:
+        Counter: Users moved per target alias, plus ``'conflicts'`` for
+        users left in place because their email already exists on the target
+    """
+    from .models import User
+
+    shard_map = get_shard_map()
+    queryset = User.objects.using(source).order_by('pk')
+    moved = Counter()
+    last = None
+    while True:
+        batch = list((queryset.filter(pk__gt=last) if last is not None else queryset)[:batch_size])
+        if not batch:
+            return moved
+        last = batch[-1].pk
+        by_target = defaultdict(list)
+        for user in batch:
+            target = shard_map.db_for_email(user.email)
+            if target != source or not is_sharded_id(user.pk, user.email):
+                by_target[target].append(user)
+        for target, users in by_target.items():
+            if dry_run:
+                moved[target] += len(users)
+                continue
+            count = move_users(users, source, target)
+            moved[target] += count
+            moved['conflicts'] += len(users) - count
+
+
+def move_users(users, source, target):
+    """
+    Move ``users``, loaded from ``source``, to ``target`` with their
+    outstanding and blacklisted tokens.
+
+    Users whose id predates sharding get a new one on ``target``; their
+    access tokens stop working, so they have to log in again. Rows are
+    written to the target first and deleted from the source afterwards, so
+    an interrupted move leaves copies rather than losing users, and running
+    it again completes it. Group and permission memberships move too (see
+    ``copy_memberships``). Each retired id gets a ``UserTombstone`` on
+    ``default`` for the user export, and the user's audit events are moved
+    to its new id; events still buffered by a worker (see ``users.audit``)
+    are written with the old one.
+
+    Returns:
+        int: Number of users now on ``target``
+    """
+    from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+    from .models import AuthAuditEvent, User, UserTombstone
+
+    new_ids = {}
+    for user in users:
+        old_id = user.pk
+        if not is_sharded_id(user.pk, user.email):
+            user.pk = new_user_id(user.email, alias=target)[1]
+        new_ids[old_id] = user.pk
+    tokens = list(OutstandingToken.objects.using(source).filter(user_id__in=new_ids))
+    blacklisted = set(
+        BlacklistedToken.objects.using(source).filter(token__in=tokens).values_list('token__jti', flat=True)
+    )
+    # Read before a re-numbering in place deletes them with the old rows.
+    group_rows = list(User.groups.through.objects.using(source).filter(user_id__in=new_ids).select_related('group'))
+    permission_rows = list(
+        User.user_permissions.through.objects.using(source)
+        .filter(user_id__in=new_ids).select_related('permission__content_type')
+    )
+
+    with transaction.atomic(using=target):
+        if target == source:
+            # Re-numbered in place: the old rows hold the unique emails and jtis.
+            OutstandingToken.objects.using(source).filter(user_id__in=new_ids).delete()
+            User.objects.using(source).filter(pk__in=new_ids).delete()
+        User.objects.using(target).bulk_create(users, ignore_conflicts=True)
+        present = set(User.objects.using(target).filter(pk__in=new_ids.values()).values_list('pk', flat=True))
+        OutstandingToken.objects.using(target).bulk_create([
+            OutstandingToken(
+                user_id=new_ids[token.user_id], jti=token.jti, token=token.token,
+                created_at=token.created_at, expires_at=token.expires_at,
+            )
+            for token in tokens if new_ids[token.user_id] in present
+        ], ignore_conflicts=True)
+        if blacklisted:
+            BlacklistedToken.objects.using(target).bulk_create([
+                BlacklistedToken(token=token)
+                for token in OutstandingToken.objects.using(target).filter(jti__in=blacklisted)
+            ], ignore_conflicts=True)
+        moved = {old: new for old, new in new_ids.items() if new in present}
+        copy_memberships(group_rows, permission_rows, moved, target)
+
+    renumbered = {old: new for old, new in moved.items() if old != new}
+    if renumbered:
+        # Written once the target has committed, so neither names an id that
+        # was rolled back.
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            UserTombstone.objects.using(DEFAULT_DB_ALIAS).bulk_create([
+                UserTombstone(user_id=old, replaced_by=new) for old, new in renumbered.items()
+            ], ignore_conflicts=True)
+            AuthAuditEvent.objects.using(DEFAULT_DB_ALIAS).filter(user_id__in=renumbered).update(
+                user_id=models.Case(*(models.When(user_id=old, then=new) for old, new in renumbered.items())),
+            )
+
+    if target != source:
+        with transaction.atomic(using=source):
+            # Tokens would outlive their user (SET_NULL) and keep its jtis.
+            OutstandingToken.objects.using(source).filter(user_id__in=moved).delete()
+            User.objects.using(source).filter(pk__in=moved).delete()
+    return len(present)
+
+
+def copy_memberships(group_rows, permission_rows, new_ids, target):
+    """
+    Give users moved to ``target`` the group and permission memberships
+    they had on their source database.
+
+    Groups and permissions are separate rows on every database, so they are
+    matched by name and by natural key. A group missing on ``target`` is
+    created with its permissions.
+
+    Args:
+        group_rows: ``User.groups.through`` rows from the source, with ``group``
+        permission_rows: ``User.user_permissions.through`` rows from the
+            source, with ``permission__content_type``
+        new_ids: Old user id to id on ``target``, for the users moved
+        target: Database alias the users were moved to
+
+    Raises:
+        LookupError: If a permission does not exist on ``target`` (run
+            ``migrate --database <target>`` first)
+    """
+    from django.contrib.auth.models import Group
+    from .models import User
+
+    group_ids = {}
+    for row in group_rows:
+        if row.group_id not in group_ids and row.user_id in new_ids:
+            group, created = Group.objects.using(target).get_or_create(name=row.group.name)
+            if created:
+                permissions = row.group.permissions.select_related('content_type')
+                group.permissions.set(target_permission_ids(permissions, target).values())
+            group_ids[row.group_id] = group.pk
+    User.groups.through.objects.using(target).bulk_create([
+        User.groups.through(user_id=new_ids[row.user_id], group_id=group_ids[row.group_id])
+        for row in group_rows if row.user_id in new_ids
+    ], ignore_conflicts=True)
+
+    permission_ids = target_permission_ids([row.permission for row in permission_rows], target)
+    User.user_permissions.through.objects.using(target).bulk_create([
+        User.user_permissions.through(user_id=new_ids[row.user_id], permission_id=permission_ids[row.permission_id])
+        for row in permission_rows if row.user_id in new_ids
+    ], ignore_conflicts=True)
+
+
+def target_permission_ids(permissions, target):
+    """
+    Ids on ``target`` of ``permissions`` (loaded with their content type).
+
+    Returns:
+        dict: Permission id on the source to its id on ``target``
+    """
+    from django.contrib.auth.models import Permission
+
+    def natural_key(permission):
+        return permission.content_type.app_label, permission.content_type.model, permission.codename
+
+    permissions = list(permissions)
+    if not permissions:
+        return {}
+    on_target = Permission.objects.using(target).select_related('content_type').filter(
+        codename__in={permission.codename for permission in permissions},
+    )
+    ids = {natural_key(permission): permission.pk for permission in on_target}
+    try:
+        return {permission.pk: ids[natural_key(permission)] for permission in permissions}
+    except KeyError as exc:
+        raise LookupError(f'Permission {exc.args[0]} does not exist on {target}') from exc
@@ -0,0 +1,309 @@
+import http.client
+import json
+import os
+import random
+import re
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter, deque
+from urllib.parse import urlsplit
+
+# Scenarios replayed by ``TrafficGenerator`` and their default weights.
+DEFAULT_MIX = {'register': 1, 'login': 6, 'forgot': 2, 'reset': 1}
+
+SNAPSHOT_PATTERN = re.compile(r'heap-(?P<pid>\d+)-(?P<seq>\d+)-(?P<traced>\d+)\.snapshot')
+
+# Allocations made by the profiler itself or while importing modules.
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def parse_mix(value):
+    """
+    Parse a traffic mix such as ``'register=1,login=6'``.
+
+    Returns:
+        dict: Scenario name to relative weight
+    """
+    mix = {}
+    for part in filter(None, (part.strip() for part in value.split(','))):
+        name, _, weight = part.partition('=')
+        if name not in DEFAULT_MIX:
+            raise ValueError(f'Unknown scenario {name!r}; choose from {", ".join(DEFAULT_MIX)}')
+        mix[name] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError('The traffic mix needs at least one scenario with a positive weight')
+    return mix
+
+
+def rss_kb(pid):
+    """Resident set size of ``pid`` in kB, or None if it has exited."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def child_pids(pid):
+    """Pids of the live child processes of ``pid``, e.g. gunicorn workers."""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces and parentheses; the fields
+        # after it are state, then the parent pid.
+        fields = stat.rpartition(')')[2].split()
+        if len(fields) > 1 and fields[1] == str(pid):
+            children.append(int(entry))
+    return sorted(children)
+
+
+def detect_growth(values, threshold, min_rising=0.8):
+    """
+    Check a series of memory samples for steady growth.
+
+    A series is flagged when its last value exceeds its first by more than
+    ``threshold`` and it rose or held steady in at least ``min_rising`` of
+    the intervals. Noisy series that grow and shrink back, such as a cache
+    warming up and evicting, are not flagged.
+
+    Returns:
+        The growth (last minus first) if flagged, else None
+    """
+    if len(values) < 3:
+        return None
+    growth = values[-1] - values[0]
+    steps = list(zip(values, values[1:]))
+    rising = sum(1 for before, after in steps if after >= before)
+    if growth > threshold and rising >= min_rising * len(steps):
+        return growth
+    return None
+
+
+class HeapSnapshotter:
+    """
+    Dump ``tracemalloc`` snapshots of this process every ``interval`` seconds.
+
+    Files are named ``heap-<pid>-<seq>-<traced bytes>.snapshot``, so the
+    growth of a worker's heap can be followed without loading them.
+    Started in gunicorn workers when ``GUNICORN_TRACEMALLOC_DIR`` is set.
+    Tracing slows allocation-heavy code down noticeably; do not enable it in
+    production.
+    """
+
+    def __init__(self, directory, interval=60, frames=10):
+        self.directory = directory
+        self.interval = interval
+        self.frames = frames
+        self._seq = 0
+        self._stop = threading.Event()
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tracemalloc.start(self.frames)
+        threading.Thread(target=self._run, name='heap-snapshotter', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+    def dump(self):
+        """
+        Write a snapshot of the traced allocations.
+
+        Returns:
+            str: Path of the snapshot file
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+        traced = sum(trace.size for trace in snapshot.traces)
+        self._seq += 1
+        path = os.path.join(self.directory, f'heap-{os.getpid()}-{self._seq:05d}-{traced}.snapshot')
+        tmp = f'{path}.tmp'
+        snapshot.dump(tmp)
+        os.replace(tmp, path)
+        return path
+
+
+def list_snapshots(directory):
+    """
+    Snapshots written by ``HeapSnapshotter``, grouped by process.
+
+    Returns:
+        dict: Pid to a list of ``(mtime, traced_bytes, path)`` in order
+    """
+    snapshots = {}
+    for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else ():
+        match = SNAPSHOT_PATTERN.fullmatch(name)
+        if match is None:
+            continue
+        path = os.path.join(directory, name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        snapshots.setdefault(int(match['pid']), []).append((mtime, int(match['traced']), path))
+    return snapshots
+
+
+def top_growth(first_path, last_path, limit=10):
+    """
+    Allocation sites that grew the most between two snapshots.
+
+    Returns:
+        list: ``tracemalloc.StatisticDiff`` entries grouped by traceback,
+        largest growth first
+    """
+    first = tracemalloc.Snapshot.load(first_path)
+    last = tracemalloc.Snapshot.load(last_path)
+    return [stat for stat in last.compare_to(first, 'traceback') if stat.size_diff > 0][:limit]
+
+
+class TrafficGenerator:
+    """
+    Replays a weighted mix of register, login, forgot-password and
+    reset-password flows against a running server.
+
+    Each flow comes from a random client address (``X-Forwarded-For``), so
+    per-IP throttles see many clients rather than one. Accounts registered
+    along the way are reused by the other scenarios; a tenth of logins use
+    a wrong password. Like a well-behaved client, a thread that gets a 429 or
+    503 sleeps for its ``Retry-After`` (at most ``max_backoff`` seconds), so
+    shed load does not turn into a busy loop. ``results`` counts responses
+    per scenario and status (``'error'`` for connection failures).
+    """
+
+    def __init__(self, base_url, mix=None, timeout=30, seed=None, max_backoff=5):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.https = parts.scheme == 'https'
+        self.prefix = parts.path.rstrip('/') or '/api/users'
+        self.mix = mix or DEFAULT_MIX
+        self.timeout = timeout
+        self.seed = seed
+        self.max_backoff = max_backoff
+        self.results = Counter()
+        self.accounts = deque(maxlen=1000)
+        self.reset_tokens = deque(maxlen=1000)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            connection = self._local.connection = connection_class(self.host, self.port, timeout=self.timeout)
+        return connection
+
+    def post(self, scenario, path, body, ip):
+        """
+        POST JSON to ``<prefix>/<path>`` and record the outcome.
+
+        Returns:
+            tuple: ``(status, parsed body)``, or ``(None, None)`` on connection failure
+        """
+        connection = self._connection()
+        try:
+            connection.request(
+                'POST', f'{self.prefix}/{path}', body=json.dumps(body),
+                headers={'Content-Type': 'application/json', 'X-Forwarded-For': ip},
+            )
+            response = connection.getresponse()
+            raw = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self._local.connection = None
+            with self._lock:
+                self.results[scenario, 'error'] += 1
+            return None, None
+        with self._lock:
+            self.results[scenario, response.status] += 1
+        if response.status in (429, 503):
+            try:
+                retry_after = float(response.getheader('Retry-After') or 1)
+            except ValueError:
+                retry_after = 1
+            time.sleep(min(retry_after, self.max_backoff))
+        try:
+            data = json.loads(raw) if raw else None
+        except ValueError:
+            data = None
+        return response.status, data
+
+    def run(self, stop, rng=None):
+        """Run random scenarios until the ``stop`` event is set."""
+        rng = rng or random.Random(self.seed)
+        names, weights = list(self.mix), list(self.mix.values())
+        while not stop.is_set():
+            getattr(self, f'scenario_{rng.choices(names, weights)[0]}')(rng)
+
+    def _account(self, rng):
+        with self._lock:
+            if self.accounts:
+                return self.accounts[rng.randrange(len(self.accounts))]
+        return self.scenario_register(rng)
+
+    def _ip(self, rng):
+        return f'10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}'
+
+    def scenario_register(self, rng):
+        account = [f'soak-{uuid.uuid4().hex}@example.com', f'Soak-{uuid.uuid4().hex[:12]}!']
+        status, _ = self.post('register', 'register/', {
+            'full_name': 'Soak Test', 'email': account[0], 'password': account[1],
+        }, self._ip(rng))
+        if status == 201:
+            with self._lock:
+                self.accounts.append(account)
+            return account
+        return None
+
+    def scenario_login(self, rng):
+        account = self._account(rng)
+        if account is None:
+            return
+        password = account[1] if rng.random() >= 0.1 else 'wrong-password'
+        self.post('login', 'login/', {'email': account[0], 'password': password}, self._ip(rng))
+
+    def scenario_forgot(self, rng):
+        account = self._account(rng)
+        if account is None:
+            return
+        status, data = self.post('forgot', 'forgot-password/', {'email': account[0]}, self._ip(rng))
+        if status == 200 and data and data.get('reset_token'):
+            with self._lock:
+                self.reset_tokens.append((account, data['reset_token']))
+
+    def scenario_reset(self, rng):
+        with self._lock:
+            pending = self.reset_tokens.popleft() if self.reset_tokens else None
+        if pending is None:
+            self.scenario_forgot(rng)
+            return
+        account, token = pending
+        password = f'Soak-{uuid.uuid4().hex[:12]}!'
+        status, _ = self.post('reset', 'reset-password/', {'token': token, 'new_password': password}, self._ip(rng))
+        if status == 200:
+            with self._lock:
+                account[1] = password
+
+    def totals(self):
+        with self._lock:
+            return Counter(self.results)
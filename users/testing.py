@@ -0,0 +1,363 @@
+import fnmatch
+import socket
+import socketserver
+import threading
+import time
+
+
+class FakeRedisServer:
+    """
+    Minimal in-process Redis server speaking RESP2, for tests.
+
+    Supports the string, list, key-expiry, pub/sub, transaction and admin
+    commands used by django-redis and the cache clients in ``users.cache``.
+    There is no Lua: ``EVAL`` runs only the scripts of ``users.cache``,
+    emulated in Python. ``latency`` adds a
+    delay before every reply and ``down`` makes the server drop connections,
+    so timeouts and outages can be simulated without a real Redis.
+
+    Usage::
+
+        with FakeRedisServer() as server:
+            url = server.url
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.latency = latency
+        self.down = False
+        self.commands = 0
+        self._data = {}
+        self._expiry = {}
+        self._subscribers = {}
+        self._lock = threading.RLock()
+        self._server = _ThreadedTCPServer((host, port), _Handler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    @property
+    def url(self):
+        host, port = self.address
+        return f'redis://{host}:{port}/0'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def dbsize(self):
+        with self._lock:
+            self._purge()
+            return len(self._data)
+
+    def _purge(self):
+        now = time.monotonic()
+        for key in [k for k, at in self._expiry.items() if at <= now]:
+            self._data.pop(key, None)
+            del self._expiry[key]
+
+    def execute(self, handler, args):
+        """Run one command and return its reply value."""
+        name = args[0].decode().upper()
+        params = args[1:]
+        with self._lock:
+            self.commands += 1
+            self._purge()
+            if name == 'MULTI':
+                handler.queued = []
+                return SimpleString('OK')
+            if name == 'DISCARD':
+                handler.queued = None
+                return SimpleString('OK')
+            if name == 'EXEC':
+                queued, handler.queued = handler.queued or [], None
+                return [self._call(handler, *command) for command in queued]
+            if handler.queued is not None:
+                handler.queued.append((name, params))
+                return SimpleString('QUEUED')
+            return self._call(handler, name, params)
+
+    def _call(self, handler, name, params):
+        method = getattr(self, f'cmd_{name.lower()}', None)
+        if method is None:
+            return ReplyError(f"ERR unknown command '{name}'")
+        try:
+            if name in ('SUBSCRIBE', 'UNSUBSCRIBE'):
+                return method(handler, *params)
+            return method(*params)
+        except (TypeError, ValueError, IndexError):
+            return ReplyError(f"ERR wrong arguments for '{name}' command")
+
+    # Connection and admin commands.
+
+    def cmd_ping(self, message=None):
+        return SimpleString('PONG') if message is None else message
+
+    def cmd_select(self, db):
+        return SimpleString('OK')
+
+    def cmd_client(self, *args):
+        return SimpleString('OK')
+
+    def cmd_flushdb(self, *args):
+        self._data.clear()
+        self._expiry.clear()
+        return SimpleString('OK')
+
+    cmd_flushall = cmd_flushdb
+
+    def cmd_dbsize(self):
+        return len(self._data)
+
+    def cmd_info(self, *args):
+        return f'# Keyspace\r\ndb0:keys={len(self._data)},expires={len(self._expiry)}\r\n'.encode()
+
+    # Scripting.
+
+    def cmd_eval(self, script, numkeys, *args):
+        from .cache import DELETE_IF_EQUAL_SCRIPT
+
+        numkeys = int(numkeys)
+        keys, argv = args[:numkeys], args[numkeys:]
+        if script.decode() == DELETE_IF_EQUAL_SCRIPT:
+            return self.cmd_del(keys[0]) if self._data.get(keys[0]) == argv[0] else 0
+        return ReplyError('NOSCRIPT only the scripts of users.cache are emulated')
+
+    # String and key commands.
+
+    def cmd_get(self, key):
+        return self._data.get(key)
+
+    def cmd_mget(self, *keys):
+        return [self._data.get(key) for key in keys]
+
+    def cmd_set(self, key, value, *options):
+        options = [o.decode().upper() if isinstance(o, bytes) else o for o in options]
+        ttl = None
+        if 'NX' in options and key in self._data:
+            return None
+        if 'XX' in options and key not in self._data:
+            return None
+        for unit, scale in (('EX', 1.0), ('PX', 0.001)):
+            if unit in options:
+                ttl = int(options[options.index(unit) + 1]) * scale
+        self._data[key] = value
+        self._expiry.pop(key, None)
+        if ttl is not None:
+            self._expiry[key] = time.monotonic() + ttl
+        return SimpleString('OK')
+
+    def cmd_setex(self, key, seconds, value):
+        return self.cmd_set(key, value, b'EX', seconds)
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._data.pop(key, None) is not None:
+                removed += 1
+            self._expiry.pop(key, None)
+        return removed
+
+    cmd_unlink = cmd_del
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if key in self._data)
+
+    def cmd_incrby(self, key, delta):
+        value = int(self._data.get(key, b'0')) + int(delta)
+        self._data[key] = str(value).encode()
+        return value
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, 1)
+
+    def cmd_decrby(self, key, delta):
+        return self.cmd_incrby(key, -int(delta))
+
+    def cmd_decr(self, key):
+        return self.cmd_incrby(key, -1)
+
+    def cmd_expire(self, key, seconds, *options):
+        return self.cmd_pexpire(key, int(seconds) * 1000)
+
+    def cmd_pexpire(self, key, milliseconds, *options):
+        if key not in self._data:
+            return 0
+        self._expiry[key] = time.monotonic() + int(milliseconds) / 1000
+        return 1
+
+    def cmd_persist(self, key):
+        return 1 if self._expiry.pop(key, None) is not None else 0
+
+    def cmd_pttl(self, key):
+        if key not in self._data:
+            return -2
+        if key not in self._expiry:
+            return -1
+        return max(0, int((self._expiry[key] - time.monotonic()) * 1000))
+
+    def cmd_ttl(self, key):
+        ttl = self.cmd_pttl(key)
+        return ttl if ttl < 0 else (ttl + 999) // 1000
+
+    def cmd_keys(self, pattern):
+        pattern = pattern.decode()
+        return [key for key in self._data if fnmatch.fnmatchcase(key.decode(), pattern)]
+
+    def cmd_scan(self, cursor, *options):
+        options = [o.decode() if isinstance(o, bytes) else o for o in options]
+        pattern = '*'
+        if 'MATCH' in options or 'match' in options:
+            index = [o.upper() for o in options].index('MATCH')
+            pattern = options[index + 1]
+        keys = [key for key in self._data if fnmatch.fnmatchcase(key.decode(), pattern)]
+        return [b'0', keys]
+
+    # List commands.
+
+    def cmd_rpush(self, key, *values):
+        if not values:
+            raise ValueError
+        items = self._data.setdefault(key, [])
+        items.extend(values)
+        return len(items)
+
+    def cmd_lpop(self, key, count=None):
+        items = self._data.get(key)
+        if not items:
+            return None
+        popped = items[:1 if count is None else int(count)]
+        del items[:len(popped)]
+        if not items:
+            self._data.pop(key)
+            self._expiry.pop(key, None)
+        return popped[0] if count is None else popped
+
+    def cmd_llen(self, key):
+        return len(self._data.get(key, ()))
+
+    # Pub/sub.
+
+    def cmd_publish(self, channel, message):
+        receivers = list(self._subscribers.get(channel, ()))
+        for handler in receivers:
+            handler.push([b'message', channel, message])
+        return len(receivers)
+
+    def cmd_subscribe(self, handler, *channels):
+        for channel in channels:
+            self._subscribers.setdefault(channel, set()).add(handler)
+            handler.channels.add(channel)
+            handler.push([b'subscribe', channel, len(handler.channels)])
+        return NO_REPLY
+
+    def cmd_unsubscribe(self, handler, *channels):
+        for channel in channels or tuple(handler.channels):
+            self._subscribers.get(channel, set()).discard(handler)
+            handler.channels.discard(channel)
+            handler.push([b'unsubscribe', channel, len(handler.channels)])
+        return NO_REPLY
+
+    def disconnect(self, handler):
+        with self._lock:
+            for channel in handler.channels:
+                self._subscribers.get(channel, set()).discard(handler)
+
+
+class SimpleString(str):
+    pass
+
+
+class ReplyError(str):
+    pass
+
+
+NO_REPLY = object()
+
+
+def encode_reply(value):
+    if isinstance(value, ReplyError):
+        return f'-{value}\r\n'.encode()
+    if isinstance(value, SimpleString):
+        return f'+{value}\r\n'.encode()
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return f':{value}\r\n'.encode()
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+    if isinstance(value, (list, tuple)):
+        return b'*%d\r\n' % len(value) + b''.join(encode_reply(item) for item in value)
+    raise TypeError(f'Cannot encode {value!r}')
+
+
+class _ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.channels = set()
+        self.queued = None
+        self._write_lock = threading.Lock()
+
+    def push(self, value):
+        try:
+            with self._write_lock:
+                self.wfile.write(encode_reply(value))
+                self.wfile.flush()
+        except OSError:
+            pass
+
+    def handle(self):
+        fake = self.server.fake
+        try:
+            while True:
+                args = self._read_command()
+                if args is None or fake.down:
+                    break
+                if fake.latency:
+                    time.sleep(fake.latency)
+                reply = fake.execute(self, args)
+                if reply is not NO_REPLY:
+                    self.push(reply)
+        except (OSError, ValueError):
+            pass
+        finally:
+            fake.disconnect(self)
+            try:
+                self.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
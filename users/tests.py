@@ -1,9 +1,62 @@
-from django.test import TestCase
-from django.urls import reverse
+import asyncio
+import datetime
+import gzip
+import io
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from unittest import mock as unittest_mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.http import HttpResponse, StreamingHttpResponse
+from django.contrib.auth.hashers import get_hasher, make_password
+from django.contrib.auth.models import Group, Permission
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import path, reverse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
 from django.core.cache import cache
 from rest_framework import status
-from rest_framework.test import APITestCase
-from .models import User
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, APITestCase
+from rest_framework.views import APIView
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import BlacklistMixin, RefreshToken as SimpleJWTRefreshToken
+from django_redis.cache import RedisCache
+from .models import AuthAuditEvent, User
+from . import schema
+from .admission import ADMITTED, QUEUED, REJECTED, AdmissionClass, AdmissionControlMiddleware
+from .eventlog import EventQueueHandler, JSONFormatter
+from .audit import AuditStats, AuditTrail, MemoryBuffer, RedisBuffer, delete_before, get_audit_trail, make_row, write_rows
+from .export import parse_token
+from .hashers import PBKDF2PasswordHasher, RehashQueue, rehash_password, with_cost
+from .idempotency import run_idempotent
+from .password_policy import Blocklist, write_blocklist
+from .profiling import ProfileStore, ProfilingMiddleware, StackSampler, make_token
+from .sharding import (
+    ShardMap, UserShardRouter, email_bucket, fan_out, get_shard_map, id_bucket, is_sharded_id, make_user_id, rebalance,
+)
+from .soak import HeapSnapshotter, child_pids, detect_growth, list_snapshots, parse_mix, rss_kb, top_growth
+from .cache import CircuitBreaker, HashRing, LocalCache, SingleFlight, TierStats, hash_tag
+from .management.commands.benchmark_startup import parse_importtime
+from .testing import FakeRedisServer
+from .throttling import DegradableRateThrottle, TokenBucket
+from .tokens import IssuerStats, OutstandingTokenQueue, RefreshToken, get_outstanding_queue, get_token_issuer
+from .views import UserExportView
 
 
 class UserRegistrationTestCase(APITestCase):
@@ -272,3 +325,1534 @@ class ResetPasswordTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn('token', response.data)
         self.assertIn('new_password', response.data)
+
+
+class LocalCacheTestCase(SimpleTestCase):
+    """Test cases for the in-process LRU cache tier."""
+
+    def setUp(self):
+        self.now = 0.0
+        self.cache = LocalCache(max_entries=2, default_timeout=10, clock=lambda: self.now)
+
+    def test_evicts_least_recently_used(self):
+        """Test the least recently used entry is evicted when full."""
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(self.cache.get('a'), (True, 1))
+        self.assertEqual(self.cache.get('b'), (False, None))
+        self.assertEqual(self.cache.get('c'), (True, 3))
+
+    def test_entries_expire(self):
+        """Test entries expire after their timeout, capped at the default."""
+        self.cache.set('short', 1, timeout=1)
+        self.cache.set('long', 2, timeout=3600)
+        self.now = 5
+        self.assertEqual(self.cache.get('short'), (False, None))
+        self.assertEqual(self.cache.get('long'), (True, 2))
+        self.now = 11
+        self.assertEqual(self.cache.get('long'), (False, None))
+
+
+class SingleFlightTestCase(SimpleTestCase):
+    """Test cases for request coalescing."""
+
+    def test_concurrent_calls_share_one_execution(self):
+        """Test concurrent callers for the same key run the function once."""
+        flights = SingleFlight()
+        calls = []
+        release = threading.Event()
+        results = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return 'value'
+
+        threads = [threading.Thread(target=lambda: results.append(flights.do('key', fetch))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result == 'value' for result, _ in results))
+        self.assertEqual(sum(1 for _, shared in results if shared), 4)
+
+    def test_errors_propagate_to_waiters(self):
+        """Test the leader's exception is raised and the key is released."""
+        flights = SingleFlight()
+        with self.assertRaises(ValueError):
+            flights.do('key', lambda: (_ for _ in ()).throw(ValueError('boom')))
+        self.assertEqual(flights.do('key', lambda: 1), (1, False))
+
+
+class TierStatsTestCase(SimpleTestCase):
+    """Test cases for per-tier cache statistics."""
+
+    def test_hit_ratios(self):
+        """Test hit ratios are computed per tier."""
+        stats = TierStats()
+        stats.incr('local_hits', 3)
+        stats.incr('local_misses')
+        stats.incr('redis_misses')
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['local_hit_ratio'], 0.75)
+        self.assertEqual(snapshot['redis_hit_ratio'], 0.0)
+
+
+class CircuitBreakerTestCase(SimpleTestCase):
+    """Test cases for the Redis circuit breaker."""
+
+    def setUp(self):
+        self.now = 100.0
+        self.breaker = CircuitBreaker(
+            failure_rate=0.5, min_requests=4, window=10, reset_timeout=5, clock=lambda: self.now,
+        )
+
+    def test_opens_on_error_rate(self):
+        """Test the circuit opens once the failure ratio is reached."""
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.trips, 1)
+
+    def test_old_failures_leave_the_window(self):
+        """Test failures older than the window do not count."""
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now += 20
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_probe(self):
+        """Test a single probe is allowed after the reset timeout."""
+        for _ in range(4):
+            self.breaker.record_failure()
+        self.now += 5
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+
+class TokenBucketTestCase(SimpleTestCase):
+    """Test cases for the local token bucket."""
+
+    def test_consume_and_refill(self):
+        """Test tokens are consumed and refilled at the configured rate."""
+        bucket = TokenBucket(capacity=2, duration=60, now=0)
+        self.assertTrue(bucket.consume(0))
+        self.assertTrue(bucket.consume(0))
+        self.assertFalse(bucket.consume(0))
+        self.assertAlmostEqual(bucket.wait(), 30)
+        self.assertTrue(bucket.consume(30))
+
+
+class ResilientClientTestCase(SimpleTestCase):
+    """Test cases for degraded mode against a slow fake Redis."""
+
+    def setUp(self):
+        self.server = FakeRedisServer(latency=0.5).start()
+        self.addCleanup(self.server.stop)
+        self.cache = RedisCache(self.server.url, {
+            'OPTIONS': {
+                'CLIENT_CLASS': 'users.cache.ResilientClient',
+                'SOCKET_CONNECT_TIMEOUT': 0.05,
+                'SOCKET_TIMEOUT': 0.05,
+                'CIRCUIT_BREAKER': {'MIN_REQUESTS': 3, 'RESET_TIMEOUT': 0.5},
+            },
+        })
+
+    def trip(self):
+        for _ in range(3):
+            self.cache.get('warmup')
+        self.assertTrue(self.cache.client.degraded)
+
+    def test_slow_redis_trips_breaker(self):
+        """Test slow calls open the circuit and later calls skip Redis."""
+        self.trip()
+        start = time.monotonic()
+        for _ in range(50):
+            self.cache.get('anything')
+        self.assertLess(time.monotonic() - start, 0.1)
+        stats = self.cache.client.degraded_stats()
+        self.assertEqual(stats['state'], CircuitBreaker.OPEN)
+        self.assertEqual(stats['failures'], 3)
+        self.assertEqual(stats['short_circuited'], 50)
+
+    def test_reset_tokens_survive_outage(self):
+        """Test values written while degraded stay readable after recovery."""
+        self.trip()
+        self.cache.set('pwd-reset-123456', 42, timeout=600)
+        self.assertEqual(self.cache.get('pwd-reset-123456'), 42)
+
+        self.server.latency = 0
+        time.sleep(0.6)
+        self.assertEqual(self.cache.get('pwd-reset-123456'), 42)
+        self.assertFalse(self.cache.client.degraded)
+        self.cache.delete('pwd-reset-123456')
+        self.assertIsNone(self.cache.get('pwd-reset-123456'))
+
+    def test_delete_if_equal_in_both_modes(self):
+        """Test compare-and-delete only removes a key holding the given value, in Redis or degraded."""
+        def check():
+            self.cache.set('lock', 'mine', timeout=60)
+            self.assertFalse(self.cache.client.delete_if_equal('lock', 'theirs'))
+            self.assertTrue(self.cache.client.delete_if_equal('lock', 'mine'))
+            self.assertIsNone(self.cache.get('lock'))
+
+        self.trip()
+        check()
+        self.server.latency = 0
+        time.sleep(0.6)
+        check()
+        self.assertFalse(self.cache.client.degraded)
+
+    def test_throttle_uses_local_token_bucket(self):
+        """Test throttles fall back to local token buckets while degraded."""
+        self.trip()
+        backend = self.cache
+
+        class Throttle(DegradableRateThrottle):
+            cache = backend
+            scope = 'test'
+            rate = '2/minute'
+
+            def get_cache_key(self, request, view):
+                return self.get_ident(request)
+
+        request = APIRequestFactory().post('/', REMOTE_ADDR='10.0.0.1')
+        self.assertTrue(Throttle().allow_request(request, None))
+        self.assertTrue(Throttle().allow_request(request, None))
+        throttle = Throttle()
+        self.assertFalse(throttle.allow_request(request, None))
+        self.assertGreater(throttle.wait(), 0)
+        self.assertEqual(self.server.dbsize(), 0)
+
+        self.cache.clear()
+        self.assertTrue(Throttle().allow_request(request, None))
+
+
+class HashRingTestCase(SimpleTestCase):
+    """Test cases for the consistent hash ring."""
+
+    def test_hash_tag(self):
+        """Test only the first non-empty {...} section is hashed."""
+        self.assertEqual(hash_tag('throttle_login_{1.2.3.4}'), '1.2.3.4')
+        self.assertEqual(hash_tag('a{b}{c}'), 'b')
+        self.assertEqual(hash_tag('a{}b'), 'a{}b')
+        self.assertEqual(hash_tag('plain'), 'plain')
+
+    def test_balanced_and_stable(self):
+        """Test keys spread evenly and adding a node moves about 1/N of them."""
+        ring = HashRing(['a', 'b', 'c'])
+        keys = [f'key{i}' for i in range(6000)]
+        before = {key: ring.node_for(key) for key in keys}
+        for node in 'abc':
+            self.assertAlmostEqual(list(before.values()).count(node) / len(keys), 1 / 3, delta=0.06)
+        self.assertAlmostEqual(sum(ring.shares().values()), 1)
+
+        ring.add('d')
+        moved = [key for key in keys if ring.node_for(key) != before[key]]
+        self.assertAlmostEqual(len(moved) / len(keys), 1 / 4, delta=0.06)
+        self.assertTrue(all(ring.node_for(key) == 'd' for key in moved))
+
+
+class ShardedClientTestCase(SimpleTestCase):
+    """Test cases for the consistent-hash sharded cache client."""
+
+    def setUp(self):
+        self.servers = [FakeRedisServer().start() for _ in range(3)]
+        for server in self.servers:
+            self.addCleanup(server.stop)
+        self.cache = RedisCache([server.url for server in self.servers], {
+            'OPTIONS': {
+                'CLIENT_CLASS': 'users.cache.ShardedClient',
+                'SOCKET_CONNECT_TIMEOUT': 0.05,
+                'SOCKET_TIMEOUT': 0.05,
+                'CIRCUIT_BREAKER': {'MIN_REQUESTS': 3, 'RESET_TIMEOUT': 60},
+            },
+        })
+        self.by_url = {server.url: server for server in self.servers}
+
+    def test_keys_live_on_their_shard(self):
+        """Test single and batched operations land on the owning server."""
+        data = {f'key{i}': i for i in range(60)}
+        self.cache.set_many(data)
+        self.assertEqual(sum(server.dbsize() for server in self.servers), 60)
+        self.assertTrue(all(server.dbsize() for server in self.servers))
+        self.assertEqual(self.cache.get_many(list(data)), data)
+
+        client = self.cache.client
+        owner = self.by_url[client.shard_name('key7')]
+        self.cache.delete('key7')
+        self.assertEqual(owner.dbsize(), sum(key != 'key7' and client.shard_name(key) == owner.url for key in data))
+        self.assertEqual(self.cache.delete_many(list(data)), 59)
+        self.assertEqual(sum(server.dbsize() for server in self.servers), 0)
+
+    def test_hash_tag_pins_keys(self):
+        """Test keys sharing a hash tag share a shard; multi-key ops need one."""
+        client = self.cache.client
+        shards = {client.shard_name(f'throttle_{scope}_{{10.0.0.1}}') for scope in ('login', 'register', 'reset')}
+        self.assertEqual(len(shards), 1)
+        keys = [f'k{i}' for i in range(20)]
+        with self.assertRaises(ValueError):
+            client.sinter(*keys)
+
+    def test_one_shard_down_degrades_only_its_keys(self):
+        """Test an unreachable shard trips its own breaker only."""
+        down = self.servers[0]
+        down.stop()
+        client = self.cache.client
+        down_keys = [key for key in (f'key{i}' for i in range(100)) if client.shard_name(key) == down.url]
+        up_key = next(key for key in (f'key{i}' for i in range(100)) if client.shard_name(key) != down.url)
+        for key in down_keys[:3]:
+            self.cache.get(key)
+        self.assertTrue(client.degraded)
+        self.assertTrue(client.degraded_for(down_keys[0]))
+        self.assertFalse(client.degraded_for(up_key))
+
+        self.cache.set(up_key, 1)
+        self.assertEqual(self.by_url[client.shard_name(up_key)].dbsize(), 1)
+        stats = client.shard_stats()
+        self.assertIsNone(stats[down.url]['keys'])
+        self.assertEqual(stats[down.url]['state'], CircuitBreaker.OPEN)
+        self.assertGreaterEqual(stats[down.url]['ops'], 3)
+
+
+class LazySchemaTestCase(APITestCase):
+    """Test cases for deferred schema annotations and lazy docs views."""
+
+    def test_schema_view_includes_annotations(self):
+        """Test the lazily built schema view serves the annotated operations."""
+        response = self.client.get(reverse('schema'), HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(b'Register a new user', response.content)
+
+    @override_settings(STARTUP_OPTIMIZED=True)
+    def test_annotations_deferred_in_startup_optimized_mode(self):
+        """Test extend_schema only records annotations until they are applied."""
+        @schema.extend_schema(summary='Deferred')
+        class DeferredView(APIView):
+            def get(self, request):
+                pass
+
+        self.assertNotIn('schema', DeferredView.__dict__)
+        schema.apply_deferred_schemas()
+        self.assertIn('schema', DeferredView.__dict__)
+
+
+class ParseImporttimeTestCase(SimpleTestCase):
+    """Test cases for parsing -X importtime output."""
+
+    def test_parse(self):
+        """Test self times are summed and the header is skipped."""
+        output = (
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       100 |        100 |   json.decoder\n'
+            'import time:       250 |        350 | json\n'
+        )
+        total, modules = parse_importtime(output)
+        self.assertEqual(total, 350)
+        self.assertEqual(max(modules), (350, 250, 'json'))
+
+
+@skipUnless(settings.ADMIN_ENABLED, 'admin is disabled')
+class UserAdminTestCase(TestCase):
+    """Test cases for the keyset-paginated user admin."""
+
+    def setUp(self):
+        from .admin import UserAdmin, batched_update
+
+        self.UserAdmin = UserAdmin
+        self.batched_update = batched_update
+        self.admin_user = User.objects.create_superuser(
+            email='admin@example.com', full_name='Admin User', password='adminpassword123',
+        )
+        self.client.force_login(self.admin_user)
+        for i in range(5):
+            User.objects.create_user(email=f'user{i}@example.com', full_name=f'User {i}', password='password123')
+        self.changelist_url = reverse('admin:users_user_changelist')
+
+    def test_keyset_pagination(self):
+        """Test pages are addressed by the last id of the previous page."""
+        with unittest_mock.patch.object(self.UserAdmin, 'list_per_page', 4):
+            first = self.client.get(self.changelist_url)
+            self.assertEqual(first.status_code, 200)
+            ids = [user.pk for user in first.context['cl'].result_list]
+            self.assertEqual(ids, sorted(ids, reverse=True))
+            self.assertEqual(len(ids), 4)
+            self.assertEqual(first.context['cl'].next_cursor, ids[-1])
+
+            second = self.client.get(self.changelist_url, {'after': ids[-1]})
+            self.assertEqual(second.status_code, 200)
+            self.assertEqual(len(second.context['cl'].result_list), 2)
+            self.assertIsNone(second.context['cl'].next_cursor)
+            self.assertEqual(second.context['cl'].result_count, 6)
+
+    def test_search_by_email_prefix(self):
+        """Test searching matches email prefixes case-insensitively."""
+        response = self.client.get(self.changelist_url, {'q': 'USER3@'})
+        self.assertEqual([u.email for u in response.context['cl'].result_list], ['user3@example.com'])
+
+    def test_deactivate_action(self):
+        """Test the deactivate action updates the selection in batches."""
+        selected = list(User.objects.filter(email__startswith='user').values_list('pk', flat=True))
+        with unittest_mock.patch.object(self.UserAdmin, 'update_batch_size', 2):
+            response = self.client.post(self.changelist_url, {
+                'action': 'deactivate_users',
+                '_selected_action': selected,
+            })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(User.objects.filter(is_active=False).count(), 5)
+        self.assertTrue(User.objects.get(pk=self.admin_user.pk).is_active)
+
+    def test_batched_update(self):
+        """Test batched_update touches only matching rows and reports the count."""
+        updated = self.batched_update(User.objects.filter(full_name__startswith='User'), batch_size=2, is_staff=True)
+        self.assertEqual(updated, 5)
+        self.assertEqual(User.objects.filter(is_staff=True).count(), 6)
+
+
+@override_settings(USER_EXPORT={'SAFETY_LAG': 0})
+class UserExportTestCase(APITestCase):
+    """Test cases for the streaming user export."""
+
+    def setUp(self):
+        cache.clear()
+        self.export_url = reverse('user-export')
+        self.admin_user = User.objects.create_superuser(
+            email='admin@example.com', full_name='Admin User', password='adminpassword123',
+        )
+        for i in range(4):
+            User.objects.create_user(email=f'user{i}@example.com', full_name=f'User {i}', password='password123')
+
+    def read_export(self, params=None):
+        response = self.client.get(self.export_url, params or {})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        rows = [line for line in lines if 'next_token' not in line]
+        checkpoints = [line for line in lines if 'next_token' in line]
+        return rows, checkpoints
+
+    def test_export_requires_staff(self):
+        """Test non-staff users cannot export."""
+        self.client.force_authenticate(User.objects.get(email='user0@example.com'))
+        response = self.client.get(self.export_url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_export_streams_rows_with_checkpoints(self):
+        """Test every row is exported in update order with a checkpoint per chunk."""
+        self.client.force_authenticate(self.admin_user)
+        with unittest_mock.patch.object(UserExportView, 'chunk_size', 2):
+            rows, checkpoints = self.read_export()
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['email'], 'admin@example.com')
+        self.assertNotIn('password', rows[0])
+        self.assertEqual([c['complete'] for c in checkpoints], [False, False, True])
+        self.assertEqual(parse_token(checkpoints[-1]['next_token'])[1], rows[-1]['id'])
+
+    def test_resume_from_token(self):
+        """Test a continuation token resumes after its row and picks up later changes."""
+        self.client.force_authenticate(self.admin_user)
+        with unittest_mock.patch.object(UserExportView, 'chunk_size', 2):
+            _, checkpoints = self.read_export()
+            rows, _ = self.read_export({'token': checkpoints[0]['next_token']})
+        self.assertEqual([row['email'] for row in rows], [f'user{i}@example.com' for i in range(1, 4)])
+
+        final_token = checkpoints[-1]['next_token']
+        rows, checkpoints = self.read_export({'token': final_token})
+        self.assertEqual(rows, [])
+        self.assertEqual(checkpoints, [{'next_token': final_token, 'complete': True}])
+
+        user = User.objects.get(email='user1@example.com')
+        user.save(update_fields=['last_login'])
+        rows, _ = self.read_export({'token': final_token})
+        self.assertEqual([row['email'] for row in rows], ['user1@example.com'])
+
+    def test_invalid_cursor(self):
+        """Test tampered tokens and malformed since values are rejected."""
+        self.client.force_authenticate(self.admin_user)
+        self.assertEqual(self.client.get(self.export_url, {'token': 'abc'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.export_url, {'since': 'yesterday'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_since_filter(self):
+        """Test since only includes users updated at or after the given time."""
+        self.client.force_authenticate(self.admin_user)
+        changed = User.objects.get(email='user2@example.com')
+        changed.save()
+        rows, _ = self.read_export({'since': changed.updated_at.isoformat()})
+        self.assertEqual([row['email'] for row in rows], ['user2@example.com'])
+
+    def test_safety_lag_holds_back_recent_changes(self):
+        """Test users updated within the safety lag are left for a later run."""
+        self.client.force_authenticate(self.admin_user)
+        User.objects.filter(email='user3@example.com').update(
+            updated_at=timezone.now() - datetime.timedelta(seconds=120),
+        )
+        with self.settings(USER_EXPORT={'SAFETY_LAG': 60}):
+            rows, checkpoints = self.read_export()
+        self.assertEqual([row['email'] for row in rows], ['user3@example.com'])
+
+        rows, _ = self.read_export({'token': checkpoints[-1]['next_token']})
+        self.assertEqual(len(rows), 4)
+        self.assertNotIn('user3@example.com', [row['email'] for row in rows])
+
+    def test_renumbered_users_leave_tombstones(self):
+        """Test users re-numbered when sharding is turned on are exported under their new id with a tombstone for the old one."""
+        self.client.force_authenticate(self.admin_user)
+        _, checkpoints = self.read_export()
+        old_ids = dict(User.objects.values_list('email', 'pk'))
+        with self.settings(USER_SHARDING=SINGLE_SHARD):
+            rebalance('default')
+            rows, _ = self.read_export({'token': checkpoints[-1]['next_token']})
+        new_ids = dict(User.objects.values_list('email', 'pk'))
+
+        self.assertEqual({row['email']: row['id'] for row in rows if 'email' in row}, new_ids)
+        tombstones = [row for row in rows if row.get('deleted')]
+        self.assertEqual(
+            {row['id']: row['replaced_by'] for row in tombstones},
+            {old_ids[email]: new_ids[email] for email in old_ids},
+        )
+        self.assertEqual(set(tombstones[0]), {'id', 'deleted', 'replaced_by', 'updated_at'})
+
+    def test_command_writes_gzip(self):
+        """Test the management command writes a gzip-compressed export."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'users.ndjson.gz')
+            call_command('export_users', '--output', path, '--chunk-size', '3', stderr=open(os.devnull, 'w'))
+            with gzip.open(path, 'rt') as f:
+                lines = [json.loads(line) for line in f]
+        self.assertEqual(len([line for line in lines if 'email' in line]), 5)
+        self.assertTrue(lines[-1]['complete'])
+
+
+def _hold_admission_slot(admission, ready):
+    admission.try_enter()
+    ready.set()
+    time.sleep(60)
+
+
+class AdmissionClassTestCase(SimpleTestCase):
+    """Test cases for the shared-memory admission limiter."""
+
+    def setUp(self):
+        self.admission = AdmissionClass('test', limit=1, queue=1, timeout=0.1, retry_after=1)
+
+    def test_limit_and_queue(self):
+        """Test requests beyond the limit queue, and beyond the queue are rejected."""
+        self.assertEqual(self.admission.try_enter(), ADMITTED)
+        self.assertEqual(self.admission.try_enter(), QUEUED)
+        self.assertEqual(self.admission.try_enter(), REJECTED)
+        self.assertFalse(self.admission.wait(time.monotonic() + 0.05))
+        self.assertEqual(self.admission.waiting, 0)
+
+    def test_queued_request_gets_released_slot(self):
+        """Test a waiter is admitted as soon as the running request leaves."""
+        self.admission.try_enter()
+        self.assertEqual(self.admission.try_enter(), QUEUED)
+        threading.Timer(0.05, self.admission.leave).start()
+        self.assertTrue(self.admission.wait(time.monotonic() + 5))
+        self.assertEqual((self.admission.active, self.admission.waiting), (1, 0))
+
+    def test_limit_is_shared_with_forked_workers(self):
+        """Test a slot taken in a forked process counts here and is freed by reap()."""
+        context = multiprocessing.get_context('fork')
+        ready = context.Event()
+        worker = context.Process(target=_hold_admission_slot, args=(self.admission, ready), daemon=True)
+        worker.start()
+        try:
+            self.assertTrue(ready.wait(10))
+            self.assertEqual(self.admission.active, 1)
+            self.assertEqual(self.admission.try_enter(), QUEUED)
+            worker.kill()
+            worker.join()
+            self.assertEqual(self.admission.reap(worker.pid), 1)
+            self.assertTrue(self.admission.wait(time.monotonic() + 1))
+        finally:
+            worker.kill()
+
+
+ADMISSION_TEST_SETTINGS = {
+    'ENABLED': True,
+    'DEFAULT_CLASS': 'light',
+    'CLASSES': {
+        'hashing': {'PATHS': ['/api/users/login/'], 'LIMIT': 1, 'QUEUE': 1, 'TIMEOUT': 0.5, 'RETRY_AFTER': 3},
+        'light': {'LIMIT': 10, 'QUEUE': 0},
+    },
+}
+
+
+@csrf_exempt
+async def slow_login(request):
+    await asyncio.sleep(0.1)
+    return HttpResponse()
+
+
+# URLconf of the admission tests that go through the ASGI handler.
+urlpatterns = [path('api/users/login/', slow_login)]
+
+
+@override_settings(ADMISSION_CONTROL=ADMISSION_TEST_SETTINGS)
+class AdmissionControlMiddlewareTestCase(SimpleTestCase):
+    """Test cases for the admission-control middleware."""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_rejects_when_queue_is_full(self):
+        """Test a full class is rejected with 503 while other classes still run."""
+        def view(request):
+            return HttpResponse()
+
+        middleware = AdmissionControlMiddleware(view)
+        hashing = middleware.classes['hashing']
+        hashing.try_enter()
+        hashing.try_enter()
+        try:
+            response = middleware(self.factory.post('/api/users/login/'))
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '3')
+
+            response = middleware(self.factory.get('/api/users/export/'))
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('admission;desc="light"', response['Server-Timing'])
+        finally:
+            hashing.reap(os.getpid())
+
+    @override_settings(ROOT_URLCONF=__name__, ADMISSION_CONTROL=dict(ADMISSION_TEST_SETTINGS, CLASSES={
+        'hashing': dict(ADMISSION_TEST_SETTINGS['CLASSES']['hashing'], TIMEOUT=5),
+        'light': ADMISSION_TEST_SETTINGS['CLASSES']['light'],
+    }))
+    def test_async_requests_wait_in_queue(self):
+        """Test queued requests under the ASGI handler wait on the event loop, not in a worker thread."""
+        application = get_asgi_application()
+
+        async def post(path):
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+                'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'',
+                'headers': [(b'host', b'testserver')], 'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+            }
+            communicator = ApplicationCommunicator(application, scope)
+            await communicator.send_input({'type': 'http.request', 'body': b''})
+            start = await communicator.receive_output(5)
+            await communicator.receive_output(5)
+            await communicator.wait(5)
+            return start['status'], {name.decode().lower(): value.decode() for name, value in start['headers']}
+
+        async def run():
+            return await asyncio.gather(*(post('/api/users/login/') for _ in range(3)))
+
+        with (
+            # Adapted to sync mode, the middleware would block a thread in wait().
+            unittest_mock.patch.object(AdmissionClass, 'wait', side_effect=AssertionError('blocked')),
+            # Rows buffered by earlier tests would be written when these requests finish.
+            unittest_mock.patch('users.audit._trail', None),
+            unittest_mock.patch('users.tokens._queue', None),
+            self.assertLogs('django.request', 'ERROR'),  # the 503
+        ):
+            first, second, third = asyncio.run(run())
+        self.assertEqual([first[0], second[0], third[0]], [200, 200, 503])
+        waited_ms = float(second[1]['server-timing'].rsplit('dur=', 1)[1])
+        self.assertGreaterEqual(waited_ms, 50)
+
+    def test_streaming_response_holds_slot_until_streamed(self):
+        """Test a streaming response keeps its slot until exhausted or closed."""
+        def view(request):
+            return StreamingHttpResponse(iter([b'a', b'b']))
+
+        middleware = AdmissionControlMiddleware(view)
+        light = middleware.classes['light']
+        response = middleware(self.factory.get('/api/users/export/'))
+        self.assertEqual(light.active, 1)
+        self.assertEqual(b''.join(response), b'ab')
+        self.assertEqual(light.active, 0)
+        response.close()
+        self.assertEqual(light.active, 0)
+
+        response = middleware(self.factory.get('/api/users/export/'))
+        response.close()  # client went away before the first chunk
+        self.assertEqual(light.active, 0)
+
+    def test_async_streaming_response_holds_slot_until_streamed(self):
+        """Test an async streaming response keeps its slot until exhausted."""
+        async def content():
+            yield b'a'
+            yield b'b'
+
+        async def view(request):
+            return StreamingHttpResponse(content())
+
+        middleware = AdmissionControlMiddleware(view)
+        light = middleware.classes['light']
+
+        async def run():
+            response = await middleware(self.factory.get('/api/users/export/'))
+            self.assertEqual(light.active, 1)
+            return b''.join([chunk async for chunk in response])
+
+        self.assertEqual(asyncio.run(run()), b'ab')
+        self.assertEqual(light.active, 0)
+
+
+class IdempotencyTestCase(APITestCase):
+    """Test cases for Idempotency-Key handling."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='test@example.com', full_name='Test User', password='oldpassword123')
+
+    def test_registration_replay(self):
+        """Test a retried registration replays the first response without creating a user."""
+        url = reverse('user-register')
+        payload = {'full_name': 'John Doe', 'email': 'john@example.com', 'password': 'securepassword123'}
+        first = self.client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        with unittest_mock.patch('users.serializers.User.set_password') as set_password:
+            second = self.client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY='abc')
+        set_password.assert_not_called()
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(User.objects.filter(email='john@example.com').count(), 1)
+
+    def test_forgot_password_replay_returns_same_token(self):
+        """Test a retried forgot-password request does not issue a second token."""
+        url = reverse('forgot-password')
+        first = self.client.post(url, {'email': 'test@example.com'}, format='json', HTTP_IDEMPOTENCY_KEY='k1')
+        second = self.client.post(url, {'email': 'test@example.com'}, format='json', HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEqual(second.data['reset_token'], first.data['reset_token'])
+
+        other = self.client.post(url, {'email': 'test@example.com'}, format='json', HTTP_IDEMPOTENCY_KEY='k2')
+        self.assertNotIn('Idempotent-Replayed', other)
+
+    def test_different_body_is_not_replayed(self):
+        """Test the same key with a different body runs the request."""
+        url = reverse('forgot-password')
+        self.client.post(url, {'email': 'test@example.com'}, format='json', HTTP_IDEMPOTENCY_KEY='k1')
+        response = self.client.post(url, {'email': 'other@example.com'}, format='json', HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertNotIn('Idempotent-Replayed', response)
+
+    def test_invalid_key(self):
+        """Test overlong keys are rejected."""
+        response = self.client.post(
+            reverse('forgot-password'), {'email': 'test@example.com'}, format='json', HTTP_IDEMPOTENCY_KEY='x' * 256,
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_concurrent_duplicates_wait_for_first(self):
+        """Test duplicates arriving while the first request runs wait for its response."""
+        calls = []
+
+        def handler():
+            calls.append(1)
+            time.sleep(0.2)
+            return Response({'ok': len(calls)}, status=status.HTTP_200_OK)
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(run_idempotent('idempotency:test:concurrent', handler)))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r.data for r in results], [{'ok': 1}] * 3)
+        self.assertEqual(sum(1 for r in results if r.has_header('Idempotent-Replayed')), 2)
+
+    def test_expired_lock_is_not_released_for_its_new_owner(self):
+        """Test a handler outliving its lock does not delete a duplicate's lock."""
+        key = 'idempotency:test:expired'
+
+        def handler():
+            # The lock expired and a duplicate took it over.
+            cache.delete(f'{key}:lock')
+            cache.add(f'{key}:lock', 'duplicate', timeout=60)
+            return Response({'ok': True}, status=status.HTTP_200_OK)
+
+        run_idempotent(key, handler)
+        self.assertEqual(cache.get(f'{key}:lock'), 'duplicate')
+
+
+FAST_HASHER_PROFILE = {'ALGORITHM': 'pbkdf2_sha256', 'PBKDF2_ITERATIONS': 1000, 'SCRYPT_WORK_FACTOR': None}
+TUNED_HASHER_PROFILE = dict(FAST_HASHER_PROFILE, PBKDF2_ITERATIONS=2000)
+
+
+class PasswordHasherTestCase(APITestCase):
+    """Test cases for the hasher profile and rehash-on-login."""
+
+    def setUp(self):
+        cache.clear()
+        self.login_url = reverse('user-login')
+        with self.settings(PASSWORD_HASHER_PROFILE=FAST_HASHER_PROFILE):
+            self.user = User.objects.create_user(
+                email='test@example.com', full_name='Test User', password='testpassword123',
+            )
+
+    def iterations(self):
+        self.user.refresh_from_db()
+        return int(self.user.password.split('$')[1])
+
+    def test_profile_sets_iterations(self):
+        """Test the PBKDF2 iteration count comes from the settings profile."""
+        self.assertEqual(self.iterations(), 1000)
+        with self.settings(PASSWORD_HASHER_PROFILE=TUNED_HASHER_PROFILE):
+            self.assertEqual(get_hasher().iterations, 2000)
+            self.assertTrue(get_hasher().must_update(self.user.password))
+
+    @override_settings(PASSWORD_HASHER_PROFILE=TUNED_HASHER_PROFILE, PASSWORD_REHASH='sync')
+    def test_login_upgrades_outdated_hash(self):
+        """Test logging in re-hashes a password made with an outdated iteration count."""
+        response = self.client.post(
+            self.login_url, {'email': 'test@example.com', 'password': 'testpassword123'}, format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.iterations(), 2000)
+        self.assertTrue(self.user.check_password('testpassword123'))
+
+    @override_settings(PASSWORD_HASHER_PROFILE=TUNED_HASHER_PROFILE, PASSWORD_REHASH='deferred')
+    def test_deferred_rehash_is_off_the_request_path(self):
+        """Test the deferred mode hands the upgrade to the background queue."""
+        with unittest_mock.patch('users.hashers.get_rehash_queue') as get_rehash_queue:
+            self.assertTrue(self.user.check_password('testpassword123'))
+        get_rehash_queue.return_value.submit.assert_called_once()
+        self.assertEqual(self.iterations(), 1000)
+
+    @override_settings(PASSWORD_HASHER_PROFILE=TUNED_HASHER_PROFILE, PASSWORD_REHASH='sync')
+    def test_async_check_password_upgrades_outdated_hash(self):
+        """Test acheck_password goes through schedule_rehash too."""
+        self.assertTrue(async_to_sync(self.user.acheck_password)('testpassword123'))
+        self.assertEqual(self.iterations(), 2000)
+
+    def test_rehash_queue_is_bounded_and_deduplicated(self):
+        """Test pending upgrades are capped, one per user, and dropped beyond that."""
+        started, release = threading.Event(), threading.Event()
+
+        def slow_rehash(*args):
+            started.set()
+            release.wait(5)
+
+        queue = RehashQueue(max_pending=1)
+        with unittest_mock.patch('users.hashers.rehash_password', side_effect=slow_rehash) as rehash:
+            self.assertTrue(queue.submit(User, 1, 'old', 'password1'))
+            self.assertTrue(started.wait(5))
+            self.assertFalse(queue.submit(User, 1, 'old', 'password1'))
+            self.assertTrue(queue.submit(User, 2, 'old', 'password2'))
+            self.assertFalse(queue.submit(User, 2, 'old', 'password2'))
+            self.assertFalse(queue.submit(User, 3, 'old', 'password3'))
+            release.set()
+            self.assertTrue(queue.join(5))
+        self.assertEqual([c.args[1] for c in rehash.call_args_list], [1, 2])
+        self.assertEqual(
+            queue.stats.snapshot(),
+            {'queued': 2, 'deduplicated': 2, 'dropped': 1, 'rehashed': 2, 'failed': 0},
+        )
+
+    def test_rehash_does_not_overwrite_newer_password(self):
+        """Test an upgrade is dropped when the password changed in the meantime."""
+        old_encoded = self.user.password
+        User.objects.filter(pk=self.user.pk).update(password=make_password('newpassword123'))
+        self.assertFalse(rehash_password(User, self.user.pk, old_encoded, 'testpassword123'))
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('newpassword123'))
+
+    def test_with_cost(self):
+        """Test calibration probes override the profile's cost parameter."""
+        probe = with_cost(PBKDF2PasswordHasher(), 1234)
+        self.assertEqual(probe.iterations, 1234)
+        self.assertIn('$1234$', probe.encode('password', probe.salt()))
+
+
+def _spin(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+class StackSamplerTestCase(SimpleTestCase):
+    """Test cases for the sampling profiler and the profile ring buffer."""
+
+    def test_samples_running_thread(self):
+        """Test the sampler records the stack of the registered thread."""
+        sampler = StackSampler(interval=0.001)
+        sampler.start(threading.get_ident())
+        _spin(0.1)
+        counts = sampler.stop(threading.get_ident())
+        self.assertGreater(sum(counts.values()), 10)
+        self.assertTrue(any(stack.endswith('users.tests:_spin') for stack in counts))
+
+    def test_store_keeps_newest_files(self):
+        """Test the ring buffer deletes the oldest profiles beyond its size."""
+        with tempfile.TemporaryDirectory() as directory:
+            store = ProfileStore(directory, max_files=3)
+            paths = [store.write_folded('GET-user-login', 5, {'a;b': 1}) for _ in range(5)]
+            self.assertEqual(sorted(os.listdir(directory)), sorted(os.path.basename(p) for p in paths[2:]))
+
+
+class SoakTestCase(SimpleTestCase):
+    """Test cases for the soak test's memory sampling and growth detection."""
+
+    def test_detect_growth(self):
+        """Test only steady growth beyond the threshold is flagged."""
+        self.assertEqual(detect_growth([100, 110, 110, 130, 150], threshold=40), 50)
+        self.assertIsNone(detect_growth([100, 110, 110, 130, 150], threshold=60))
+        self.assertIsNone(detect_growth([100, 200, 120, 210, 150], threshold=40))
+        self.assertIsNone(detect_growth([100, 200], threshold=40))
+
+    def test_parse_mix(self):
+        """Test traffic mixes are parsed and unknown scenarios rejected."""
+        self.assertEqual(parse_mix('login=3, reset'), {'login': 3.0, 'reset': 1.0})
+        with self.assertRaises(ValueError):
+            parse_mix('logout=1')
+
+    def test_process_sampling(self):
+        """Test RSS and child processes are read from /proc."""
+        if not os.path.isdir('/proc/self'):
+            self.skipTest('needs /proc')
+        child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+        self.addCleanup(child.wait)
+        self.addCleanup(child.kill)
+        self.assertIn(child.pid, child_pids(os.getpid()))
+        self.assertGreater(rss_kb(os.getpid()), 0)
+
+    def test_heap_snapshots_report_growth(self):
+        """Test snapshots record traced size and the growing allocation site."""
+        leak = []
+        with tempfile.TemporaryDirectory() as directory:
+            snapshotter = HeapSnapshotter(directory, interval=3600, frames=5)
+            snapshotter.start()
+            self.addCleanup(tracemalloc.stop)
+            self.addCleanup(snapshotter.stop)
+            snapshotter.dump()
+            leak.extend(bytearray(1024) for _ in range(1000))
+            snapshotter.dump()
+            (pid, series), = list_snapshots(directory).items()
+            self.assertEqual(pid, os.getpid())
+            self.assertGreater(series[1][1] - series[0][1], 1000 * 1024)
+            growth = top_growth(series[0][2], series[1][2], limit=1)
+            self.assertEqual(growth[0].traceback[-1].filename, __file__)
+
+
+class ProfilingMiddlewareTestCase(APITestCase):
+    """Test cases for sampled request profiling."""
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(lambda: [os.remove(os.path.join(self.directory, n)) for n in os.listdir(self.directory)])
+        self.url = reverse('forgot-password')
+        self.payload = {'email': 'nobody@example.com'}
+
+    def profiling(self, **overrides):
+        config = dict(settings.PROFILING, DIR=self.directory, SAMPLE_RATE=0.0, INTERVAL=0.001)
+        config.update(overrides)
+        return self.settings(PROFILING=config)
+
+    def test_signed_header_forces_profile(self):
+        """Test a request with a valid token is profiled and a forged one is not."""
+        with self.profiling():
+            response = self.client.post(self.url, self.payload, format='json', HTTP_X_PROFILE_TOKEN=make_token())
+            self.assertIn('X-Profile-Id', response)
+            self.assertTrue(response['X-Profile-Id'].endswith('.folded'))
+            self.assertIn('POST-forgot-password', response['X-Profile-Id'])
+
+            response = self.client.post(self.url, self.payload, format='json', HTTP_X_PROFILE_TOKEN='forged')
+            self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_sample_rate_and_cprofile_fallback(self):
+        """Test sampled requests are profiled with cProfile when configured."""
+        with self.profiling(SAMPLE_RATE=1.0, MODE='cprofile'):
+            response = self.client.post(self.url, self.payload, format='json')
+        self.assertTrue(response['X-Profile-Id'].endswith('.pstats'))
+
+    def test_overlapping_cprofile_requests(self):
+        """Test a request overlapping a cProfile'd one is served unprofiled instead of failing."""
+        entered, release = threading.Event(), threading.Event()
+
+        def view(request):
+            if request.path_info.endswith('/slow/'):
+                entered.set()
+                release.wait(5)
+            return HttpResponse()
+
+        factory = RequestFactory()
+        with self.profiling(SAMPLE_RATE=1.0, MODE='cprofile'):
+            middleware = ProfilingMiddleware(view)
+        responses = {}
+        slow = threading.Thread(
+            target=lambda: responses.setdefault('slow', middleware(factory.get('/api/users/slow/'))),
+        )
+        slow.start()
+        entered.wait(5)
+        try:
+            overlapping = middleware(factory.get('/api/users/fast/'))
+        finally:
+            release.set()
+            slow.join()
+        self.assertEqual(overlapping.status_code, 200)
+        self.assertNotIn('X-Profile-Id', overlapping)
+        self.assertTrue(responses['slow']['X-Profile-Id'].endswith('.pstats'))
+        self.assertIn('X-Profile-Id', middleware(factory.get('/api/users/fast/')))
+
+    def test_report_merges_profiles_by_endpoint(self):
+        """Test profile_report writes one merged folded file per endpoint."""
+        store = ProfileStore(self.directory, max_files=10)
+        store.write_folded('POST-user-login', 300, {'view;hash': 3, 'view;db': 1})
+        store.write_folded('POST-user-login', 200, {'view;hash': 2})
+        store.write_folded('GET-user-export', 50, {'view;stream': 1})
+        output = tempfile.mkdtemp()
+        out = io.StringIO()
+        call_command('profile_report', '--dir', self.directory, '--output', output, '--endpoint', 'login', stdout=out)
+        with open(os.path.join(output, 'POST-user-login.folded')) as f:
+            self.assertEqual(f.read(), 'view;hash 5\nview;db 1\n')
+        self.assertEqual(os.listdir(output), ['POST-user-login.folded'])
+        self.assertIn('2 profiles', out.getvalue())
+
+
+class PasswordPolicyTestCase(APITestCase):
+    """Test cases for the password policy on registration and reset."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_blocklist_file(self):
+        """Test a compiled blocklist matches normalized passwords."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'blocklist.bin')
+            self.assertEqual(write_blocklist(['hunter2', 'Hunter2', 'letmein'], path), 2)
+            blocklist = Blocklist.open(path)
+            self.assertEqual(len(blocklist), 2)
+            self.assertIn(' HUNTER2', blocklist)
+            self.assertNotIn('hunter3', blocklist)
+
+            with open(path, 'wb') as f:
+                f.write(b'not a blocklist')
+            with self.assertRaises(ImproperlyConfigured):
+                Blocklist.open(path)
+
+    def test_registration_rejects_weak_passwords(self):
+        """Test registration rejects common passwords and ones similar to the user's details."""
+        url = reverse('user-register')
+        for password in ('password123', 'jane.doe1'):
+            response = self.client.post(url, {
+                'full_name': 'Jane Doe', 'email': 'jane.doe@example.com', 'password': password,
+            }, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn('password', response.data)
+        self.assertFalse(User.objects.exists())
+
+    def test_reset_rejects_weak_password(self):
+        """Test a reset to a common password leaves the old one in place."""
+        user = User.objects.create_user(email='jane@example.com', full_name='Jane Doe', password='oldpassword123')
+        cache.set('pwd-reset-654321', user.pk, timeout=600)
+        response = self.client.post(reverse('reset-password'), {
+            'token': '654321', 'new_password': 'password123',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('new_password', response.data)
+        user.refresh_from_db()
+        self.assertTrue(user.check_password('oldpassword123'))
+
+
+class EventLogTestCase(APITestCase):
+    """Test cases for the queued JSON event log."""
+
+    def test_full_queue_drops_and_counts(self):
+        """Test records beyond capacity are dropped, counted and reported in one batch."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.log')
+            handler = EventQueueHandler(filename=path, capacity=10)
+            handler.setFormatter(JSONFormatter())
+            logger = logging.getLogger('users.tests.eventlog')
+            logger.addHandler(handler)
+            logger.propagate = False
+            logger.setLevel(logging.WARNING)
+            self.addCleanup(logger.setLevel, logging.NOTSET)
+            self.addCleanup(logger.removeHandler, handler)
+
+            with unittest_mock.patch.object(handler, 'start'):  # hold the listener back
+                for i in range(12):
+                    logger.warning('event %d', i, extra={'n': i})
+            handler.start()
+            handler.close()
+
+            stats = handler.stats.snapshot()
+            self.assertEqual((stats['enqueued'], stats['dropped']), (10, 2))
+            self.assertEqual((stats['written'], stats['batches']), (11, 1))
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual([line.get('n') for line in lines[:10]], list(range(10)))
+            self.assertEqual(lines[0]['message'], 'event 0')
+            self.assertEqual(lines[-1]['message'], 'Dropped 2 log records: queue full')
+
+    @override_settings(EVENT_LOG={
+        'ACCESS_LOG': True, 'ACCESS_SAMPLE_RATE': 0.0, 'ACCESS_SAMPLE_RATES': {'user-login': 1.0},
+    })
+    def test_access_log_sampling_per_endpoint(self):
+        """Test only endpoints with a non-zero sample rate are logged."""
+        with self.assertLogs('users.access', 'INFO') as logs:
+            self.client.post(reverse('forgot-password'), {'email': 'nobody@example.com'}, format='json')
+            self.client.post(reverse('user-login'), {'email': 'nobody@example.com'}, format='json')
+        self.assertEqual(len(logs.records), 1)
+        record = logs.records[0]
+        self.assertEqual((record.view, record.status, record.sample_rate), ('user-login', 400, 1.0))
+
+    def test_auth_events(self):
+        """Test login and reset flows emit auth events without raw email addresses."""
+        cache.clear()
+        user = User.objects.create_user(email='jane@example.com', full_name='Jane Doe', password='oldpassword123')
+        with self.assertLogs('users.auth', 'INFO') as logs:
+            self.client.post(reverse('user-login'), {'email': 'jane@example.com', 'password': 'wrong'}, format='json')
+            response = self.client.post(reverse('forgot-password'), {'email': 'jane@example.com'}, format='json')
+            self.client.post(reverse('reset-password'), {
+                'token': response.data['reset_token'], 'new_password': 'newpassword123',
+            }, format='json')
+        self.assertEqual(
+            [record.event for record in logs.records],
+            ['login_failed', 'reset_issued', 'reset_consumed'],
+        )
+        self.assertEqual(logs.records[1].user_id, user.pk)
+        self.assertNotIn('jane@example.com', JSONFormatter().format(logs.records[0]))
+
+
+class AuditTrailTestCase(APITestCase):
+    """Test cases for the batched auth audit trail."""
+
+    def setUp(self):
+        cache.clear()
+        self.request = RequestFactory().post('/', REMOTE_ADDR='10.0.0.1')
+        self.request.request_id = 'req-1'
+
+    def test_buffer_bounded_and_flushed_in_batches(self):
+        """Test events beyond the buffer size are dropped and the rest written per batch."""
+        stats = AuditStats()
+        trail = AuditTrail(MemoryBuffer(5, stats), batch_size=2, flush_interval=60, stats=stats)
+        for _ in range(7):
+            trail.record(AuthAuditEvent.Event.LOGIN_FAILED, self.request, email='Jane@example.com')
+        self.assertFalse(AuthAuditEvent.objects.exists())
+        self.assertTrue(trail.due())
+
+        self.assertEqual(trail.flush(), 5)
+        snapshot = stats.snapshot()
+        self.assertEqual((snapshot['dropped'], snapshot['batches']), (2, 3))
+        event = AuthAuditEvent.objects.first()
+        self.assertEqual((event.ip, event.request_id, event.user_id), ('10.0.0.1', 'req-1', None))
+        self.assertEqual(len(event.email_digest), 16)
+
+    def test_flush_thread_writes_without_requests(self):
+        """Test the flush thread writes due events although no request finishes."""
+        stats = AuditStats()
+        trail = AuditTrail(MemoryBuffer(10, stats), batch_size=10, flush_interval=0.05, stats=stats, flush_thread=True)
+        self.addCleanup(setattr, trail, 'flush_interval', 3600)  # let the thread idle afterwards
+        written = threading.Event()
+        with unittest_mock.patch('users.audit.write_rows', side_effect=lambda rows, using: written.set()) as write:
+            trail.record(AuthAuditEvent.Event.LOGIN_FAILED, self.request)
+            self.assertTrue(written.wait(5))
+        self.assertEqual(len(write.call_args.args[0]), 1)
+
+    def test_redis_buffer(self):
+        """Test the Redis buffer round-trips rows through one shared list."""
+        with FakeRedisServer() as server:
+            backend = RedisCache(server.url, {'OPTIONS': {'CLIENT_CLASS': 'users.cache.ResilientClient'}})
+            buffer = RedisBuffer(100, AuditStats(), cache=backend)
+            rows = [make_row(AuthAuditEvent.Event.REGISTERED, self.request) for _ in range(3)]
+            for row in rows:
+                buffer.add(row)
+            self.assertEqual(server.dbsize(), 1)
+            self.assertEqual(buffer.take(2), rows[:2])
+            self.assertEqual(buffer.take(2), rows[2:])
+            self.assertEqual(server.dbsize(), 0)
+
+    def test_views_record_events_with_request_ids(self):
+        """Test auth views record audit events tagged with the request id."""
+        response = self.client.post(reverse('user-register'), {
+            'full_name': 'Jane Doe', 'email': 'jane@example.com', 'password': 'securepassword123',
+        }, format='json', HTTP_X_REQUEST_ID='register-1')
+        self.assertEqual(response['X-Request-ID'], 'register-1')
+        response = self.client.post(reverse('user-login'), {
+            'email': 'jane@example.com', 'password': 'securepassword123',
+        }, format='json', HTTP_X_REQUEST_ID='bad id!')
+        login_request_id = response['X-Request-ID']
+        self.assertRegex(login_request_id, r'^[0-9a-f]{32}$')
+
+        get_audit_trail().flush()
+        user = User.objects.get(email='jane@example.com')
+        events = AuthAuditEvent.objects.filter(user_id=user.pk).order_by('id')
+        self.assertEqual(
+            [(event.event, event.request_id) for event in events],
+            [('registered', 'register-1'), ('login_succeeded', login_request_id)],
+        )
+
+    def test_paginated_by_user_and_time(self):
+        """Test the audit endpoint pages a user's events newest first."""
+        now = timezone.now()
+        rows = [
+            (now - datetime.timedelta(minutes=i), 'login_failed', user_id, None, '10.0.0.1', f'r{user_id}-{i}')
+            for user_id in (1, 2) for i in range(5)
+        ]
+        write_rows(rows)
+        admin = User.objects.create_superuser(email='admin@example.com', full_name='Admin', password='adminpassword123')
+        url = reverse('audit-events')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.force_authenticate(admin)
+        seen = []
+        page = self.client.get(url, {'user_id': 1, 'page_size': 2}).data
+        while True:
+            seen.extend(event['request_id'] for event in page['results'])
+            if not page['next']:
+                break
+            page = self.client.get(page['next']).data
+        self.assertEqual(seen, [f'r1-{i}' for i in range(5)])
+
+        since = (now - datetime.timedelta(minutes=2, seconds=30)).isoformat()
+        response = self.client.get(url, {'user_id': 2, 'since': since})
+        self.assertEqual([event['request_id'] for event in response.data['results']], ['r2-0', 'r2-1', 'r2-2'])
+        self.assertEqual(self.client.get(url, {'until': 'yesterday'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_retention_without_partitions(self):
+        """Test old events are deleted in batches where partitions are unavailable."""
+        now = timezone.now()
+        write_rows([(now - datetime.timedelta(days=days), 'registered', 1, None, None, None) for days in (1, 30, 400)])
+        self.assertEqual(delete_before(now - datetime.timedelta(days=10), batch_size=1), 2)
+        self.assertEqual(AuthAuditEvent.objects.count(), 1)
+
+
+SINGLE_SHARD = dict(settings.USER_SHARDING, SHARDS=['default'], PREVIOUS_SHARDS=[])
+
+
+class UserShardingTestCase(APITestCase):
+    """Test cases for sharding users by email address."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_ids_encode_email_bucket(self):
+        """Test user ids carry the bucket of the email, whatever its case."""
+        bucket = email_bucket('Jane@Example.com ')
+        self.assertEqual(bucket, email_bucket('jane@example.com'))
+        pk = make_user_id(12345, 3, bucket)
+        self.assertEqual(id_bucket(pk), bucket)
+        self.assertTrue(is_sharded_id(pk, 'jane@example.com'))
+        self.assertFalse(is_sharded_id(make_user_id(12345, 3, (bucket + 1) % 1024), 'jane@example.com'))
+
+    def test_adding_a_shard_moves_a_share_of_buckets(self):
+        """Test a third shard takes about a third of the buckets, all from the other two."""
+        before = ShardMap(['users_0', 'users_1'])
+        after = ShardMap(['users_0', 'users_1', 'users_2'], previous=['users_0', 'users_1'])
+        moved = [bucket for bucket, owner in enumerate(after.owners) if owner != before.owners[bucket]]
+        self.assertTrue(250 < len(moved) < 430)
+        self.assertEqual({after.owners[bucket] for bucket in moved}, {'users_2'})
+        self.assertEqual(
+            [bucket for bucket, previous in enumerate(after.previous_owners) if previous is not None], moved,
+        )
+
+        pk = make_user_id(1, 0, email_bucket('jane@example.com'))
+        self.assertEqual(after.route({'email__iexact': 'jane@example.com'}), after.route({'pk': str(pk)}))
+        self.assertIsNone(after.route({'is_active': True}))
+
+    @override_settings(USER_SHARDING=SINGLE_SHARD)
+    def test_registered_users_get_sharded_ids(self):
+        """Test registration allocates ids encoding the email bucket, and login finds the user."""
+        response = self.client.post(reverse('user-register'), {
+            'full_name': 'Jane Doe', 'email': 'jane@example.com', 'password': 'securepassword123',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        user = User.objects.get(email='jane@example.com')
+        self.assertTrue(is_sharded_id(user.pk, user.email))
+
+        response = self.client.post(reverse('user-login'), {
+            'email': 'jane@example.com', 'password': 'securepassword123',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        user.email = 'other@example.com'
+        with self.assertRaises(ValueError):
+            user.save()
+
+    def test_rebalance_renumbers_existing_users(self):
+        """Test enabling sharding gives existing users sharded ids and keeps their tokens."""
+        user = User.objects.create_user(email='jane@example.com', full_name='Jane Doe', password='securepassword123')
+        refresh = RefreshToken.for_user(user)
+        with self.settings(USER_SHARDING=SINGLE_SHARD):
+            self.assertEqual(rebalance('default'), {'default': 1, 'conflicts': 0})
+            self.assertEqual(rebalance('default'), {})
+            moved = User.objects.get(email='jane@example.com')
+        self.assertNotEqual(moved.pk, user.pk)
+        self.assertTrue(is_sharded_id(moved.pk, moved.email))
+        self.assertEqual(moved.outstandingtoken_set.get().jti, refresh['jti'])
+
+    def test_rebalance_keeps_audit_history_of_renumbered_users(self):
+        """Test the audit events of a re-numbered user follow it to its new id."""
+        user = User.objects.create_user(email='jane@example.com', full_name='Jane Doe', password='securepassword123')
+        other = User.objects.create_user(email='john@example.com', full_name='John Doe', password='securepassword123')
+        for event_user in (user, user, other, None):
+            AuthAuditEvent.objects.create(
+                created_at=timezone.now(), event=AuthAuditEvent.Event.LOGIN_SUCCEEDED,
+                user_id=event_user and event_user.pk,
+            )
+        with self.settings(USER_SHARDING=SINGLE_SHARD):
+            rebalance('default')
+            moved = User.objects.get(email='jane@example.com')
+            moved_other = User.objects.get(email='john@example.com')
+        self.assertEqual(AuthAuditEvent.objects.filter(user_id=moved.pk).count(), 2)
+        self.assertEqual(AuthAuditEvent.objects.filter(user_id=moved_other.pk).count(), 1)
+        self.assertFalse(AuthAuditEvent.objects.filter(user_id__in=[user.pk, other.pk]).exists())
+        self.assertEqual(AuthAuditEvent.objects.filter(user_id=None).count(), 1)
+
+    def test_rebalance_keeps_memberships_of_renumbered_users(self):
+        """Test re-numbering a user in place keeps its groups and permissions."""
+        user = User.objects.create_user(email='jane@example.com', full_name='Jane Doe', password='securepassword123')
+        user.groups.add(Group.objects.create(name='support'))
+        user.user_permissions.add(Permission.objects.get(codename='change_user'))
+        with self.settings(USER_SHARDING=SINGLE_SHARD):
+            rebalance('default')
+            moved = User.objects.get(email='jane@example.com')
+        self.assertEqual(list(moved.groups.values_list('name', flat=True)), ['support'])
+        self.assertTrue(moved.has_perm('users.change_user'))
+
+
+TWO_SHARDS = dict(settings.USER_SHARDING, SHARDS=['users_0', 'users_1'], PREVIOUS_SHARDS=[])
+HAS_SHARD_DATABASES = set(TWO_SHARDS['SHARDS']) <= set(settings.DATABASES)
+
+
+@skipUnless(HAS_SHARD_DATABASES, 'Needs the users_0 and users_1 databases of auth_service.test_settings')
+@override_settings(
+    USER_SHARDING=TWO_SHARDS,
+    DATABASE_ROUTERS=['users.sharding.UserShardRouter'],
+    TOKEN_ISSUER=dict(settings.TOKEN_ISSUER, WRITE_BEHIND=False),
+)
+class UserShardDatabasesTestCase(TransactionTestCase):
+    """Test cases for users sharded over two real databases."""
+
+    # The test runner sets up the databases of skipped classes too.
+    databases = {'default', *TWO_SHARDS['SHARDS']} if HAS_SHARD_DATABASES else {'default'}
+
+    def setUp(self):
+        cache.clear()
+        shard_map = get_shard_map()
+        self.emails = {alias: [] for alias in shard_map.shards}
+        for i in range(100):
+            email = f'user{i}@example.com'
+            self.emails[shard_map.db_for_email(email)].append(email)
+
+    def register(self, email):
+        return self.client.post(reverse('user-register'), {
+            'full_name': 'Jane Doe', 'email': email, 'password': 'securepassword123',
+        }, format='json')
+
+    def login(self, email):
+        return self.client.post(reverse('user-login'), {'email': email, 'password': 'securepassword123'}, format='json')
+
+    def test_register_and_login_on_each_shard(self):
+        """Test users are stored on the shard of their email, and lookups and logins are routed there."""
+        for alias, other in (('users_0', 'users_1'), ('users_1', 'users_0')):
+            email = self.emails[alias][0]
+            self.assertEqual(UserShardRouter().db_for_write(User, instance=User(email=email)), alias)
+            self.assertEqual(self.register(email).status_code, status.HTTP_201_CREATED)
+            self.assertTrue(User.objects.using(alias).filter(email=email).exists())
+            self.assertFalse(User.objects.using(other).filter(email=email).exists())
+            self.assertFalse(User.objects.using('default').exists())
+
+            user = User.objects.get(email=email)
+            self.assertEqual(user._state.db, alias)
+            self.assertEqual(User.objects.get(pk=user.pk)._state.db, alias)
+            response = self.login(email)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            jti = SimpleJWTRefreshToken(response.data['refresh'])['jti']
+            self.assertEqual(OutstandingToken.objects.using(alias).get(jti=jti).user_id, user.pk)
+
+    def test_fan_out_queries_every_shard(self):
+        """Test fan_out runs a query on each shard in its own thread."""
+        for alias, count in (('users_0', 3), ('users_1', 2)):
+            for email in self.emails[alias][:count]:
+                User.objects.create_user(email=email, full_name='Jane Doe', password='securepassword123')
+        self.assertEqual(fan_out(lambda alias: User.objects.using(alias).count()), {'users_0': 3, 'users_1': 2})
+
+    @skipUnless(settings.ADMIN_ENABLED, 'admin is disabled')
+    def test_admin_lists_users_of_every_shard(self):
+        """Test the admin change list merges the users of both shards by descending id."""
+        admin_user = User.objects.create_superuser(
+            email=self.emails['users_0'][0], full_name='Admin User', password='adminpassword123',
+        )
+        for email in self.emails['users_0'][1:3] + self.emails['users_1'][:3]:
+            User.objects.create_user(email=email, full_name='Jane Doe', password='securepassword123')
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse('admin:users_user_changelist'))
+        self.assertEqual(response.status_code, 200)
+        users = response.context['cl'].result_list
+        self.assertEqual({user._state.db for user in users}, {'users_0', 'users_1'})
+        self.assertEqual([user.pk for user in users], sorted((user.pk for user in users), reverse=True))
+        self.assertEqual(response.context['cl'].result_count, 6)
+
+    def test_rebalance_onto_a_new_shard(self):
+        """Test adding a shard: lookups fall back to the previous layout until users are moved with their tokens."""
+        with self.settings(USER_SHARDING=dict(TWO_SHARDS, SHARDS=['users_0'])):
+            for email in self.emails['users_0'][:2] + self.emails['users_1'][:3]:
+                self.register(email)
+        self.assertEqual(User.objects.using('users_0').count(), 5)
+        moving = User.objects.using('users_0').get(email=self.emails['users_1'][0])
+        revoked = RefreshToken.for_user(moving)
+        BlacklistedToken.objects.using('users_0').create(
+            token=OutstandingToken.objects.using('users_0').get(jti=revoked['jti']),
+        )
+
+        with self.settings(USER_SHARDING=dict(TWO_SHARDS, PREVIOUS_SHARDS=['users_0'])):
+            # Not moved yet: found on users_0 through USER_SHARDS_PREVIOUS.
+            self.assertEqual(User.objects.get(email=moving.email).pk, moving.pk)
+            self.assertEqual(self.login(moving.email).status_code, status.HTTP_200_OK)
+
+            self.assertEqual(rebalance('users_0'), {'users_1': 3, 'conflicts': 0})
+            self.assertEqual(rebalance('users_0'), {})
+            self.assertEqual(User.objects.using('users_0').count(), 2)
+            self.assertFalse(OutstandingToken.objects.using('users_0').filter(user_id=moving.pk).exists())
+
+            moved = User.objects.get(email=moving.email)
+            self.assertEqual((moved._state.db, moved.pk), ('users_1', moving.pk))
+            self.assertEqual(moved.outstandingtoken_set.count(), 2)
+            self.assertTrue(
+                BlacklistedToken.objects.using('users_1').filter(token__jti=revoked['jti']).exists(),
+            )
+            self.assertEqual(self.login(moving.email).status_code, status.HTTP_200_OK)
+
+    def test_rebalance_moves_memberships(self):
+        """Test a user moved to another database keeps its groups, their permissions and its own permissions."""
+        with self.settings(USER_SHARDING=dict(TWO_SHARDS, SHARDS=['users_0'])):
+            self.register(self.emails['users_1'][0])
+        moving = User.objects.using('users_0').get()
+        group = Group.objects.using('users_0').create(name='support')
+        group.permissions.add(Permission.objects.using('users_0').get(codename='view_user'))
+        moving.groups.add(group)
+        moving.user_permissions.add(Permission.objects.using('users_0').get(codename='change_user'))
+
+        with self.settings(USER_SHARDING=dict(TWO_SHARDS, PREVIOUS_SHARDS=['users_0'])):
+            self.assertEqual(rebalance('users_0'), {'users_1': 1, 'conflicts': 0})
+            moved = User.objects.get(email=moving.email)
+        self.assertEqual(moved._state.db, 'users_1')
+        self.assertEqual(moved.groups.get().name, 'support')
+        self.assertEqual(list(moved.groups.get().permissions.values_list('codename', flat=True)), ['view_user'])
+        self.assertTrue(moved.has_perm('users.change_user'))
+        self.assertFalse(User.groups.through.objects.using('users_0').exists())
+
+
+class TokenIssuerTestCase(APITestCase):
+    """Test cases for the prepared JWT issuer and write-behind outstanding tokens."""
+
+    def setUp(self):
+        cache.clear()
+        get_outstanding_queue().flush()
+        self.user = User.objects.create_user(
+            email='test@example.com', full_name='Test User', password='testpassword123',
+        )
+
+    def test_tokens_match_simplejwt(self):
+        """Test the issuer signs byte-identical tokens to simplejwt's for the same time and ids."""
+        now = datetime.datetime(2026, 1, 2, 3, 4, 5, 678000, tzinfo=datetime.timezone.utc)
+        jtis = [unittest_mock.Mock(hex=f'{i:032x}') for i in range(2)]
+        with unittest_mock.patch('rest_framework_simplejwt.tokens.aware_utcnow', return_value=now), \
+                unittest_mock.patch('rest_framework_simplejwt.tokens.uuid4', side_effect=jtis), \
+                unittest_mock.patch('users.tokens.uuid.uuid4', side_effect=jtis):
+            expected = super(BlacklistMixin, SimpleJWTRefreshToken).for_user(self.user)
+            expected_pair = (str(expected), str(expected.access_token))
+            refresh, access, jti, exp = get_token_issuer().issue(self.user, now.timestamp())
+        self.assertEqual((refresh, access), expected_pair)
+        self.assertEqual((jti, exp), (expected['jti'], expected['exp']))
+
+    def test_login_records_outstanding_token(self):
+        """Test login tokens authenticate, and their outstanding row is written within the transaction."""
+        response = self.client.post(reverse('user-login'), {
+            'email': 'test@example.com', 'password': 'testpassword123',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        authentication = JWTAuthentication()
+        self.assertEqual(authentication.get_user(authentication.get_validated_token(response.data['access'])), self.user)
+        refresh = SimpleJWTRefreshToken(response.data['refresh'])
+        self.assertEqual(OutstandingToken.objects.get(user=self.user).jti, refresh['jti'])
+        self.assertEqual(len(get_outstanding_queue()), 0)
+
+    def test_queue_bounded_and_idempotent(self):
+        """Test a full queue writes inline and already recorded tokens are skipped."""
+        stats = IssuerStats()
+        queue = OutstandingTokenQueue(batch_size=2, flush_interval=60, max_pending=2, stats=stats)
+        tokens = [RefreshToken.for_user(self.user) for _ in range(3)]
+        OutstandingToken.objects.all().delete()
+        for token in tokens:
+            queue.add('default', OutstandingToken(
+                user=self.user, jti=token['jti'], token=str(token),
+                created_at=token.current_time, expires_at=timezone.now(),
+            ))
+        self.assertEqual(OutstandingToken.objects.count(), 1)
+        self.assertTrue(queue.due())
+        self.assertEqual(queue.flush(), 2)
+        self.assertEqual(OutstandingToken.objects.count(), 3)
+        self.assertEqual(queue.write('default', [OutstandingToken.objects.first()]), 1)
+        self.assertEqual(OutstandingToken.objects.count(), 3)
+        snapshot = stats.snapshot()
+        self.assertEqual((snapshot['queued'], snapshot['inline_writes'], snapshot['written']), (2, 1, 3))
+
+    @override_settings(TOKEN_ISSUER=dict(settings.TOKEN_ISSUER, ENABLED=False))
+    def test_disabled_issuer_uses_simplejwt(self):
+        """Test logins fall back to simplejwt's path, writing the outstanding row inline."""
+        self.assertIsNone(get_token_issuer())
+        response = self.client.post(reverse('user-login'), {
+            'email': 'test@example.com', 'password': 'testpassword123',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            OutstandingToken.objects.get(user=self.user).jti, SimpleJWTRefreshToken(response.data['refresh'])['jti'],
+        )
+
+
+class TokenWriteBehindTestCase(TransactionTestCase):
+    """Test cases for outstanding tokens written after the response."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='test@example.com', full_name='Test User', password='testpassword123',
+        )
+
+    def test_login_writes_outstanding_token_behind(self):
+        """Test the outstanding row of a login is queued, then written in a batch."""
+        response = self.client.post(reverse('user-login'), {
+            'email': 'test@example.com', 'password': 'testpassword123',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        refresh = SimpleJWTRefreshToken(response.data['refresh'])
+        self.assertFalse(OutstandingToken.objects.exists())
+
+        self.assertEqual(get_outstanding_queue().flush(), 1)
+        self.assertEqual(OutstandingToken.objects.get(user=self.user).jti, refresh['jti'])
+        refresh.blacklist()
+        with self.assertRaises(TokenError):
+            SimpleJWTRefreshToken(response.data['refresh'])
+
+    def test_flush_thread_writes_without_requests(self):
+        """Test the flush thread writes due rows although no request finishes."""
+        queue = OutstandingTokenQueue(batch_size=10, flush_interval=0.05, max_pending=10, flush_thread=True)
+        self.addCleanup(setattr, queue, 'flush_interval', 3600)  # let the thread idle afterwards
+        token = RefreshToken.for_user(self.user)
+        OutstandingToken.objects.all().delete()
+        queue.add('default', OutstandingToken(
+            user=self.user, jti=token['jti'], token=str(token), created_at=token.current_time, expires_at=timezone.now(),
+        ))
+        deadline = time.monotonic() + 5
+        while not OutstandingToken.objects.exists() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(OutstandingToken.objects.get().jti, token['jti'])
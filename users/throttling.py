@@ -1,7 +1,115 @@
+import threading
+
 from rest_framework.throttling import SimpleRateThrottle
 
+from .cache import Counters, LocalCache, is_degraded
+from .eventlog import log_auth_event
+
+
+class TokenBucket:
+    """
+    Token bucket holding up to ``capacity`` tokens, refilled continuously
+    so that ``capacity`` tokens are regained every ``duration`` seconds.
+    """
+
+    def __init__(self, capacity, duration, now):
+        self.capacity = capacity
+        self.rate = capacity / duration
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def consume(self, now):
+        """
+        Take one token if available.
+
+        Returns:
+            bool: True if the request is allowed
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait(self):
+        """Seconds until the next token becomes available."""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class ThrottleStats(Counters):
+    """Decisions taken by local token buckets while Redis was degraded."""
+
+    FIELDS = ('local_allowed', 'local_denied')
+
+
+_buckets = LocalCache(max_entries=10000, default_timeout=24 * 60 * 60)
+_buckets_lock = threading.Lock()
+degraded_stats = ThrottleStats()
+
+
+def reset_local_buckets():
+    """
+    Forget the degraded-mode token buckets of this process.
+
+    Called by ``cache.clear()``, so clearing the cache resets every throttle
+    whether its state lives in Redis or, while degraded, in this process.
+    """
+    with _buckets_lock:
+        _buckets.clear()
+    degraded_stats.reset()
+
+
+class DegradableRateThrottle(SimpleRateThrottle):
+    """
+    ``SimpleRateThrottle`` that falls back to per-process token buckets.
+
+    While the cache reports itself as degraded (Redis circuit open), the
+    request history is not read from or written to the cache. Each worker
+    then enforces the rate on its own, so limits are approximate (up to one
+    full rate per worker) but the check never blocks on Redis. Denied
+    requests are logged as ``throttled`` auth events.
+
+    Keys carry the client ident as a hash tag, so with a sharded cache all
+    throttle state of one client lives on one shard and only clients on a
+    degraded shard fall back.
+    """
+    cache_format = 'throttle_%(scope)s_{%(ident)s}'
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+        if is_degraded(self.cache, self.key):
+            allowed = self.allow_local()
+        else:
+            allowed = super().allow_request(request, view)
+        if not allowed:
+            log_auth_event('throttled', request, scope=self.scope)
+        return allowed
+
+    def allow_local(self):
+        now = self.timer()
+        with _buckets_lock:
+            hit, bucket = _buckets.get(self.key)
+            if not hit:
+                bucket = TokenBucket(self.num_requests, self.duration, now)
+                _buckets.set(self.key, bucket, timeout=self.duration)
+            allowed = bucket.consume(now)
+            self._local_wait = None if allowed else bucket.wait()
+        degraded_stats.incr('local_allowed' if allowed else 'local_denied')
+        return allowed
+
+    def wait(self):
+        local_wait = getattr(self, '_local_wait', None)
+        if local_wait is not None:
+            return local_wait
+        return super().wait()
+
 
-class LoginThrottle(SimpleRateThrottle):
+class LoginThrottle(DegradableRateThrottle):
     """
     Rate limiting for login attempts.
     
@@ -14,10 +122,10 @@ class LoginThrottle(SimpleRateThrottle):
         """
         Generate cache key based on user IP address.
         """
-        return self.get_ident(request)
+        return self.cache_format % {'scope': self.scope, 'ident': self.get_ident(request)}
 
 
-class PasswordResetThrottle(SimpleRateThrottle):
+class PasswordResetThrottle(DegradableRateThrottle):
     """
     Rate limiting for password reset requests.
     
@@ -30,10 +138,10 @@ class PasswordResetThrottle(SimpleRateThrottle):
         """
         Generate cache key based on user IP address.
         """
-        return self.get_ident(request)
+        return self.cache_format % {'scope': self.scope, 'ident': self.get_ident(request)}
 
 
-class PasswordResetConfirmThrottle(SimpleRateThrottle):
+class PasswordResetConfirmThrottle(DegradableRateThrottle):
     """
     Rate limiting for password reset confirmations.
     
@@ -46,10 +154,10 @@ class PasswordResetConfirmThrottle(SimpleRateThrottle):
         """
         Generate cache key based on user IP address.
         """
-        return self.get_ident(request)
+        return self.cache_format % {'scope': self.scope, 'ident': self.get_ident(request)}
 
 
-class RegistrationThrottle(SimpleRateThrottle):
+class RegistrationThrottle(DegradableRateThrottle):
     """
     Rate limiting for user registration.
     
@@ -62,4 +170,4 @@ class RegistrationThrottle(SimpleRateThrottle):
         """
         Generate cache key based on user IP address.
         """
-        return self.get_ident(request)
+        return self.cache_format % {'scope': self.scope, 'ident': self.get_ident(request)}
@@ -0,0 +1,378 @@
+import atexit
+import base64
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import jwt
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, IntegrityError, connections, transaction
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.state import token_backend
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken
+from rest_framework_simplejwt.tokens import AccessToken, BlacklistMixin, RefreshToken as BaseRefreshToken
+from rest_framework_simplejwt.utils import datetime_from_epoch, get_md5_hash_password
+
+from .cache import Counters
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshToken(BaseRefreshToken):
+    """
+    ``RefreshToken`` recording its ``OutstandingToken`` on the user's database.
+
+    simplejwt creates the row through the default manager, i.e. on
+    ``default``; with sharded users the row, which references the user, must
+    go to the user's shard instead.
+    """
+
+    @classmethod
+    def for_user(cls, user):
+        # Build the token without BlacklistMixin.for_user, which writes the row.
+        token = super(BlacklistMixin, cls).for_user(user)
+        OutstandingToken.objects.db_manager(user._state.db).create(
+            user=user,
+            jti=token[api_settings.JTI_CLAIM],
+            token=str(token),
+            created_at=token.current_time,
+            expires_at=datetime_from_epoch(token['exp']),
+        )
+        return token
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+class IssuerStats(Counters):
+    """Per-process counters of token issuance and outstanding-token writes."""
+
+    FIELDS = ('issued', 'queued', 'written', 'batches', 'inline_writes', 'dropped', 'write_errors')
+
+
+issuer_stats = IssuerStats()
+
+
+class OutstandingTokenQueue:
+    """
+    Per-process write-behind queue of ``OutstandingToken`` rows.
+
+    ``add()`` only appends; ``flush_if_due()``, run when each request
+    finishes (after the response is sent), writes the pending rows with one
+    ``bulk_create`` per database once ``batch_size`` are pending or the
+    oldest is ``flush_interval`` seconds old. When ``max_pending`` rows are
+    waiting, the caller writes its row inline instead, so a stalled flush
+    slows logins down rather than losing rows. Batches that fail to write
+    go back to the queue, except for rows the database rejects (e.g. for a
+    user deleted in the meantime), which are dropped.
+
+    With ``flush_thread``, a background thread started on the first row in
+    each process also flushes due rows, so they are written even when no
+    further request finishes. Rows still queued when the process is killed
+    are lost: at most ``flush_interval`` seconds of logins (plus the time a
+    write takes) while the database is reachable.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_pending, stats=issuer_stats, flush_thread=False):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.stats = stats
+        self.flush_thread = flush_thread
+        self.reset_after_fork()
+
+    def reset_after_fork(self):
+        # Rows queued before fork are the parent's to write, and the flush
+        # thread does not survive fork; the child starts its own.
+        self._rows = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, alias, token):
+        with self._lock:
+            if len(self._rows) < self.max_pending:
+                self._rows.append((alias, token))
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+                self.stats.incr('queued')
+                if self.flush_thread and self._flusher is None:
+                    self._flusher = threading.Thread(
+                        target=self._flush_periodically, name='outstanding-token-flush', daemon=True,
+                    )
+                    self._flusher.start()
+                return
+        self.stats.incr('inline_writes')
+        token.save(using=alias, force_insert=True)
+
+    def _flush_periodically(self):
+        while True:
+            oldest = self._oldest
+            wait = self.flush_interval if oldest is None else oldest + self.flush_interval - time.monotonic()
+            time.sleep(max(0, wait))
+            if not self.due():
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.warning('Outstanding token flush thread failed', exc_info=True)
+            finally:
+                connections.close_all()
+
+    def due(self):
+        return len(self._rows) >= self.batch_size or (
+            self._oldest is not None and time.monotonic() - self._oldest >= self.flush_interval
+        )
+
+    def flush_if_due(self):
+        if self.due():
+            self.flush()
+
+    def flush(self):
+        """
+        Write all queued rows.
+
+        Returns:
+            int: Number of rows written
+        """
+        if not self._flush_lock.acquire(blocking=False):
+            return 0  # another thread is flushing
+        written = 0
+        try:
+            with self._lock:
+                rows, self._rows, self._oldest = self._rows, [], None
+            by_alias = {}
+            for alias, token in rows:
+                by_alias.setdefault(alias, []).append(token)
+            for alias, tokens in by_alias.items():
+                for start in range(0, len(tokens), self.batch_size):
+                    batch = tokens[start:start + self.batch_size]
+                    try:
+                        written += self.write(alias, batch)
+                    except DatabaseError:
+                        logger.warning('Could not write %d outstanding tokens', len(batch), exc_info=True)
+                        self.stats.incr('write_errors')
+                        self.put_back(alias, tokens[start:])
+                        break
+        finally:
+            self._flush_lock.release()
+        return written
+
+    def write(self, alias, tokens):
+        try:
+            with transaction.atomic(using=alias):
+                # A token blacklisted before its row was written already has one.
+                OutstandingToken.objects.using(alias).bulk_create(tokens, ignore_conflicts=True)
+            written = len(tokens)
+        except IntegrityError:
+            written = 0
+            for token in tokens:
+                try:
+                    with transaction.atomic(using=alias):
+                        OutstandingToken.objects.using(alias).bulk_create([token], ignore_conflicts=True)
+                    written += 1
+                except IntegrityError:
+                    logger.warning('Dropped outstanding token %s for user %s', token.jti, token.user_id)
+                    self.stats.incr('dropped')
+        self.stats.incr('written', written)
+        self.stats.incr('batches')
+        return written
+
+    def put_back(self, alias, tokens):
+        with self._lock:
+            room = max(0, self.max_pending - len(self._rows))
+            if room < len(tokens):
+                self.stats.incr('dropped', len(tokens) - room)
+            self._rows[:0] = [(alias, token) for token in tokens[:room]]
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+
+
+class TokenIssuer:
+    """
+    Issues login refresh/access token pairs without simplejwt's generic path.
+
+    ``RefreshToken.for_user`` followed by ``.access_token`` builds two claim
+    dicts from settings, JSON-encodes a header and a payload per token, keys
+    a new HMAC per token and writes the ``OutstandingToken`` row inline.
+    Here the header segment, the JSON fragments of the payloads and the
+    keyed HMAC state are prepared once; a pair costs two short string
+    builds, two base64 encodings and two copies of the keyed HMAC. The
+    tokens carry the same claims, in the same order, as simplejwt's.
+
+    Only HMAC algorithms without a custom ``JSON_ENCODER`` are supported;
+    see ``TokenIssuer.supports()``.
+    """
+
+    def __init__(self, backend, access_lifetime, refresh_lifetime, jwt_settings=api_settings):
+        self.access_lifetime = access_lifetime.total_seconds()
+        self.refresh_lifetime = refresh_lifetime.total_seconds()
+        self.user_id_field = jwt_settings.USER_ID_FIELD
+        self.revoke_claim = jwt_settings.REVOKE_TOKEN_CLAIM if jwt_settings.CHECK_REVOKE_TOKEN else None
+
+        algorithm = jwt.PyJWS().get_algorithm_by_name(backend.algorithm)
+        self._mac = hmac.new(algorithm.prepare_key(backend.signing_key), digestmod=algorithm.hash_alg)
+        header = json.dumps({'typ': 'JWT', 'alg': backend.algorithm}, separators=(',', ':'), sort_keys=True)
+        self._header = b64encode(header.encode()) + b'.'
+
+        # Claims in simplejwt's order: type, exp, iat, jti, user id, revoke
+        # claim, then the audience and issuer added by the token backend.
+        def name(claim):
+            return json.dumps(claim) + ':'
+
+        type_claim = name(jwt_settings.TOKEN_TYPE_CLAIM)
+        self._access_prefix = '{' + type_claim + json.dumps(AccessToken.token_type) + ',"exp":'
+        self._refresh_prefix = '{' + type_claim + json.dumps(RefreshToken.token_type) + ',"exp":'
+        self._iat = ',"iat":'
+        self._jti = ',' + name(jwt_settings.JTI_CLAIM) + '"'
+        self._user_id = '",' + name(jwt_settings.USER_ID_CLAIM)
+        self._revoke = ',' + name(self.revoke_claim) if self.revoke_claim else None
+        suffix = ''
+        if backend.audience is not None:
+            suffix += ',"aud":' + json.dumps(backend.audience, separators=(',', ':'))
+        if backend.issuer is not None:
+            suffix += ',"iss":' + json.dumps(backend.issuer)
+        self._suffix = suffix + '}'
+
+    @staticmethod
+    def supports(backend, jwt_settings=api_settings):
+        """Whether tokens signed by ``backend`` with ``jwt_settings`` can be issued here."""
+        return (
+            backend.algorithm in ('HS256', 'HS384', 'HS512')
+            and bool(backend.signing_key)
+            and backend.json_encoder is None
+            and None not in (jwt_settings.TOKEN_TYPE_CLAIM, jwt_settings.JTI_CLAIM, jwt_settings.USER_ID_CLAIM)
+        )
+
+    def sign(self, payload):
+        signing_input = self._header + b64encode(payload.encode())
+        mac = self._mac.copy()
+        mac.update(signing_input)
+        return (signing_input + b'.' + b64encode(mac.digest())).decode()
+
+    def issue(self, user, now=None):
+        """
+        Issue a refresh/access pair for ``user``.
+
+        Returns:
+            tuple: ``(refresh, access, refresh jti, refresh exp)``, the
+            tokens as strings
+        """
+        now = time.time() if now is None else now
+        iat = str(int(now))
+        claims = self._user_id + json.dumps(str(getattr(user, self.user_id_field)))
+        if self._revoke:
+            claims += self._revoke + json.dumps(get_md5_hash_password(user.password))
+        claims += self._suffix
+        refresh_exp = int(now + self.refresh_lifetime)
+        refresh_jti = uuid.uuid4().hex
+        refresh = self.sign(
+            self._refresh_prefix + str(refresh_exp) + self._iat + iat + self._jti + refresh_jti + claims
+        )
+        access = self.sign(
+            self._access_prefix + str(int(now + self.access_lifetime)) + self._iat + iat
+            + self._jti + uuid.uuid4().hex + claims
+        )
+        issuer_stats.incr('issued')
+        return refresh, access, refresh_jti, refresh_exp
+
+
+_issuers = {}
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _queue_lock
+    _queue_lock = threading.Lock()
+    issuer_stats.reset()
+    if _queue is not None:
+        _queue.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_token_issuer():
+    """
+    The ``TokenIssuer`` for the current simplejwt settings, or None when
+    ``TOKEN_ISSUER['ENABLED']`` is off or the settings are not supported.
+    """
+    # Like simplejwt's token classes, use the token backend and lifetimes
+    # captured when they were imported; claim names follow the settings.
+    if not settings.TOKEN_ISSUER['ENABLED'] or not TokenIssuer.supports(token_backend):
+        return None
+    key = (
+        token_backend, AccessToken.lifetime, RefreshToken.lifetime,
+        api_settings.TOKEN_TYPE_CLAIM, api_settings.JTI_CLAIM, api_settings.USER_ID_FIELD,
+        api_settings.USER_ID_CLAIM, api_settings.CHECK_REVOKE_TOKEN, api_settings.REVOKE_TOKEN_CLAIM,
+    )
+    issuer = _issuers.get(key)
+    if issuer is None:
+        issuer = _issuers[key] = TokenIssuer(*key[:3])
+    return issuer
+
+
+def get_outstanding_queue():
+    """Return the process-wide ``OutstandingTokenQueue`` configured by ``TOKEN_ISSUER``."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            config = settings.TOKEN_ISSUER
+            _queue = OutstandingTokenQueue(
+                config['BATCH_SIZE'], config['FLUSH_INTERVAL'], config['MAX_PENDING'],
+                flush_thread=config['FLUSH_THREAD'],
+            )
+            atexit.register(_queue.flush)
+        return _queue
+
+
+def record_outstanding(user, token, jti, exp, created_at):
+    """
+    Record a refresh token in the outstanding token list on the user's
+    database, through the write-behind queue when ``TOKEN_ISSUER`` enables it.
+    """
+    row = OutstandingToken(
+        user_id=user.pk, jti=jti, token=token, created_at=created_at, expires_at=datetime_from_epoch(exp),
+    )
+    alias = user._state.db or DEFAULT_DB_ALIAS
+    # Inside a transaction (e.g. ATOMIC_REQUESTS) the row is written with
+    # it, since a queued row could outlive a rollback of its user.
+    if settings.TOKEN_ISSUER['WRITE_BEHIND'] and not connections[alias].in_atomic_block:
+        get_outstanding_queue().add(alias, row)
+    else:
+        row.save(using=alias, force_insert=True)
+
+
+def issue_pair(user):
+    """
+    Issue a refresh/access pair for a user who just logged in.
+
+    Returns:
+        tuple: ``(refresh, access)`` as strings
+    """
+    issuer = get_token_issuer()
+    if issuer is None:
+        refresh = RefreshToken.for_user(user)
+        return str(refresh), str(refresh.access_token)
+    now = time.time()
+    refresh, access, jti, exp = issuer.issue(user, now)
+    record_outstanding(user, refresh, jti, exp, datetime.fromtimestamp(now, timezone.utc))
+    return refresh, access
+
+
+def flush_if_due(**kwargs):
+    """``request_finished`` receiver writing queued outstanding tokens when due."""
+    if _queue is not None:
+        _queue.flush_if_due()
@@ -1,11 +1,15 @@
 
 
 from django.urls import path
-from .views import UserRegistrationView, UserLoginView, ForgotPasswordView, ResetPasswordView
+from .views import (
+    AuditEventListView, UserRegistrationView, UserLoginView, ForgotPasswordView, ResetPasswordView, UserExportView,
+)
 
 urlpatterns = [
     path('register/', UserRegistrationView.as_view(), name='user-register'),
     path('login/', UserLoginView.as_view(), name='user-login'),
     path('forgot-password/', ForgotPasswordView.as_view(), name='forgot-password'),
     path('reset-password/', ResetPasswordView.as_view(), name='reset-password'),
+    path('export/', UserExportView.as_view(), name='user-export'),
+    path('audit/', AuditEventListView.as_view(), name='audit-events'),
 ]
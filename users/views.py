@@ -1,6 +1,12 @@
 from rest_framework import generics, permissions, status, generics
-from .models import User
-from .serializers import UserRegistrationSerializer, ForgotPasswordSerializer, ResetPasswordSerializer, UserLoginSerializer
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.views import APIView
+from .models import AuthAuditEvent, User
+from .serializers import (
+    AuthAuditEventSerializer, UserRegistrationSerializer, ForgotPasswordSerializer, ResetPasswordSerializer,
+    UserLoginSerializer,
+)
 from rest_framework_simplejwt.views import TokenObtainPairView
 import random
 from django.core.cache import cache
@@ -8,15 +14,31 @@ from django.conf import settings
 from django.utils import timezone
 from rest_framework.response import Response
 from django.contrib.auth.hashers import make_password
-from drf_spectacular.utils import extend_schema, OpenApiParameter
+from django.http import StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.gzip import gzip_page
 from drf_spectacular.types import OpenApiTypes
+from .audit import record_audit_event
+from .eventlog import log_auth_event
+from .idempotency import idempotent
+from .export import (
+    DEFAULT_CHUNK_SIZE, InvalidExportCursor, export_lines, export_queryset, parse_since, tombstone_queryset,
+)
+from .schema import extend_schema
 from .throttling import LoginThrottle, PasswordResetThrottle, PasswordResetConfirmThrottle, RegistrationThrottle
 
 
+IDEMPOTENCY_KEY_PARAMETER = (
+    'Idempotency-Key', OpenApiTypes.STR, 'header', False,
+    'Optional client-generated key. Retries with the same key and body replay the first response.',
+)
+
+
 @extend_schema(
     summary="Register a new user",
     description="Create a new user account with email, full name, and password.",
     request=UserRegistrationSerializer,
+    parameters=[IDEMPOTENCY_KEY_PARAMETER],
     responses={
         201: UserRegistrationSerializer,
         400: OpenApiTypes.OBJECT,
@@ -36,11 +58,20 @@ class UserRegistrationView(generics.CreateAPIView):
     Allows new users to create an account by providing their full name, email, and password.
     The email must be unique across all users.
     Rate limited to 10 registrations per hour per IP address.
+    Retries carrying the same Idempotency-Key replay the first response.
     """
     queryset = User.objects.all()
     serializer_class = UserRegistrationSerializer
     throttle_classes = [RegistrationThrottle]
 
+    @idempotent
+    def post(self, request, *args, **kwargs):
+        return super().post(request, *args, **kwargs)
+
+    def perform_create(self, serializer):
+        user = serializer.save()
+        record_audit_event(AuthAuditEvent.Event.REGISTERED, self.request, user=user)
+
 
 @extend_schema(
     summary="User login",
@@ -74,11 +105,30 @@ class UserLoginView(TokenObtainPairView):
     permission_classes = [permissions.AllowAny]
     throttle_classes = [LoginThrottle]
 
+    def get_serializer(self, *args, **kwargs):
+        # Kept so post() can read the authenticated user.
+        self.serializer = super().get_serializer(*args, **kwargs)
+        return self.serializer
+
+    def post(self, request, *args, **kwargs):
+        email = request.data.get('email') if hasattr(request.data, 'get') else None
+        try:
+            response = super().post(request, *args, **kwargs)
+        except AuthenticationFailed:
+            log_auth_event('login_failed', request, email=email)
+            record_audit_event(AuthAuditEvent.Event.LOGIN_FAILED, request, email=email)
+            raise
+        user = getattr(self.serializer, 'user', None)
+        log_auth_event('login_succeeded', request, user=user, email=email)
+        record_audit_event(AuthAuditEvent.Event.LOGIN_SUCCEEDED, request, user=user)
+        return response
+
 
 @extend_schema(
     summary="Request password reset",
     description="Send a password reset token to the user's email address.",
     request=ForgotPasswordSerializer,
+    parameters=[IDEMPOTENCY_KEY_PARAMETER],
     responses={
         200: {
             'type': 'object',
@@ -108,10 +158,12 @@ class ForgotPasswordView(generics.GenericAPIView):
     Generates a reset token and stores it in cache for 10 minutes.
     In production, this would send the token via email.
     Rate limited to 3 requests per hour per IP address.
+    Retries carrying the same Idempotency-Key replay the first response.
     """
     serializer_class = ForgotPasswordSerializer
     throttle_classes = [PasswordResetThrottle]
 
+    @idempotent
     def post(self, request):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -119,9 +171,12 @@ class ForgotPasswordView(generics.GenericAPIView):
         try:
             user = User.objects.get(email=email)
         except User.DoesNotExist:
+            log_auth_event('reset_unknown_email', request, email=email)
             return Response({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
         token = str(random.randint(100000, 999999))
         cache.set(f'pwd-reset-{token}', user.pk, timeout=600)
+        log_auth_event('reset_issued', request, user=user)
+        record_audit_event(AuthAuditEvent.Event.RESET_REQUESTED, request, user=user)
         # In production, token would be sent via email
         return Response({'reset_token': token}, status=status.HTTP_200_OK)
 
@@ -130,6 +185,7 @@ class ForgotPasswordView(generics.GenericAPIView):
     summary="Reset password",
     description="Reset user password using the reset token.",
     request=ResetPasswordSerializer,
+    parameters=[IDEMPOTENCY_KEY_PARAMETER],
     responses={
         200: {
             'type': 'object',
@@ -159,20 +215,124 @@ class ResetPasswordView(generics.GenericAPIView):
     Validates the reset token and updates the user's password.
     The token expires after 10 minutes.
     Rate limited to 10 attempts per hour per IP address.
+    Retries carrying the same Idempotency-Key replay the first response.
     """
     serializer_class = ResetPasswordSerializer
     throttle_classes = [PasswordResetConfirmThrottle]
 
+    @idempotent
     def post(self, request):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         token = serializer.validated_data['token']
         new_password = serializer.validated_data['new_password']
-        user_id = cache.get(f'pwd-reset-{token}')
-        if not user_id:
+        user = serializer.validated_data['user']
+        if user is None:
+            log_auth_event('reset_rejected', request)
             return Response({'error': 'Invalid or expired token.'}, status=status.HTTP_400_BAD_REQUEST)
-        user = User.objects.get(pk=user_id)
         user.password = make_password(new_password)
         user.save()
         cache.delete(f'pwd-reset-{token}')
+        log_auth_event('reset_consumed', request, user=user)
+        record_audit_event(AuthAuditEvent.Event.PASSWORD_CHANGED, request, user=user)
         return Response({'message': 'Password reset successful.'}, status=status.HTTP_200_OK)
+
+
+@extend_schema(
+    summary="Export users",
+    description=(
+        "Stream users as NDJSON ordered by last modification. Lines with a `next_token` key are "
+        "checkpoints; pass the last one as `token` to resume, or the final one to fetch only "
+        "users changed since this export. Ids retired when users were sharded appear as "
+        "`{\"id\": ..., \"deleted\": true, \"replaced_by\": ...}` lines. "
+        "Responses are gzip-compressed when the client accepts it."
+    ),
+    parameters=[
+        ('since', OpenApiTypes.DATETIME, 'query', False, 'Only users updated at or after this time'),
+        ('token', OpenApiTypes.STR, 'query', False, 'Continuation token from a previous export'),
+    ],
+    responses={
+        (200, 'application/x-ndjson'): OpenApiTypes.STR,
+        400: OpenApiTypes.OBJECT,
+        403: OpenApiTypes.OBJECT,
+    },
+    tags=['Administration']
+)
+@method_decorator(gzip_page, name='dispatch')
+class UserExportView(APIView):
+    """
+    API endpoint for exporting users to the data warehouse.
+
+    Streams rows from a server-side cursor, so the response size is not
+    bounded by memory. Restricted to staff users.
+    """
+    permission_classes = [permissions.IsAdminUser]
+    chunk_size = DEFAULT_CHUNK_SIZE
+
+    def get(self, request):
+        since = request.query_params.get('since')
+        token = request.query_params.get('token')
+        try:
+            since = parse_since(since) if since else None
+            queryset = export_queryset(since=since, token=token)
+            tombstones = tombstone_queryset(since=since, token=token)
+        except InvalidExportCursor as exc:
+            raise ValidationError({'error': str(exc)})
+        return StreamingHttpResponse(
+            export_lines(queryset, chunk_size=self.chunk_size, token=token, tombstones=tombstones),
+            content_type='application/x-ndjson',
+        )
+
+
+class AuditEventPagination(CursorPagination):
+    page_size = 100
+    max_page_size = 1000
+    page_size_query_param = 'page_size'
+    ordering = ('-created_at', '-id')
+
+
+@extend_schema(
+    summary="List audit events",
+    description=(
+        "Audit trail of registrations, logins, reset requests and password changes, newest first. "
+        "Follow `next` to page; each page is an index range scan on (user_id, created_at, id) "
+        "or (created_at, id)."
+    ),
+    parameters=[
+        ('user_id', OpenApiTypes.INT, 'query', False, 'Only events of this user'),
+        ('since', OpenApiTypes.DATETIME, 'query', False, 'Only events at or after this time'),
+        ('until', OpenApiTypes.DATETIME, 'query', False, 'Only events before this time'),
+    ],
+    responses={
+        200: AuthAuditEventSerializer(many=True),
+        400: OpenApiTypes.OBJECT,
+        403: OpenApiTypes.OBJECT,
+    },
+    tags=['Administration']
+)
+class AuditEventListView(generics.ListAPIView):
+    """
+    API endpoint for reading the auth audit trail.
+
+    Cursor-paginated, so deep pages cost the same as the first one.
+    Restricted to staff users.
+    """
+    permission_classes = [permissions.IsAdminUser]
+    serializer_class = AuthAuditEventSerializer
+    pagination_class = AuditEventPagination
+
+    def get_queryset(self):
+        queryset = AuthAuditEvent.objects.all()
+        params = self.request.query_params
+        if params.get('user_id'):
+            try:
+                queryset = queryset.filter(user_id=int(params['user_id']))
+            except ValueError:
+                raise ValidationError({'user_id': 'Expected an integer.'})
+        for param, lookup in (('since', 'created_at__gte'), ('until', 'created_at__lt')):
+            if params.get(param):
+                try:
+                    queryset = queryset.filter(**{lookup: parse_since(params[param])})
+                except InvalidExportCursor:
+                    raise ValidationError({param: 'Expected an ISO 8601 date or datetime.'})
+        return queryset